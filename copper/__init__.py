@@ -8,7 +8,10 @@ import copper.viz.base as plot
 
 import copper.utils.transforms as transform
 import copper.utils.frame
+import copper.utils.sketch
+import copper.utils.scoring
 import copper.utils.ml
+import copper.utils.inference
 import copper.utils.r
 
 from copper.core.config import Project
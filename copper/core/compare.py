@@ -1,14 +1,289 @@
 from __future__ import division
+import time
+import pickle
+import tracemalloc
 import copper
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
+from sklearn.base import clone, is_classifier
 from sklearn.metrics import auc
 from sklearn import cross_validation
 from sklearn.metrics import roc_curve
-from sklearn.metrics import confusion_matrix
 from sklearn.metrics import mean_squared_error
+from sklearn.externals.joblib import Parallel, delayed
+
+
+def _threshold_counts(y_true, scores):
+    '''
+    Sorts the scores of each row once and calculates the cumulative true and
+    false positives when predicting positive every score >= cutoff.
+
+    Parameters
+    ----------
+        y_true: np.array of booleans (n_rows)
+        scores: np.array (n_clfs x n_rows)
+
+    Returns
+    -------
+        sorted scores, true positives, false positives (n_clfs x n_rows) and
+        a boolean mask with the last position of every distinct score
+    '''
+    order = np.argsort(-scores, axis=1, kind='mergesort')
+    rows = np.arange(len(scores))[:, np.newaxis]
+    cutoffs = scores[rows, order]
+    tp = np.cumsum(y_true[order], axis=1)
+    fp = np.arange(1, scores.shape[1] + 1) - tp
+    last = np.ones(cutoffs.shape, dtype=bool)
+    last[:, :-1] = cutoffs[:, :-1] != cutoffs[:, 1:]
+    return cutoffs, tp, fp, last
+
+
+# ------------------------------------------------------------------------------
+#                    METRICS (module level so they can be pickled)
+# ------------------------------------------------------------------------------
+
+def _accuracy(clf, X_test=None, y_test=None):
+    return clf.score(X_test, y_test)
+
+def _auc(clf, X_test=None, y_test=None):
+    probas = clf.predict_proba(X_test)
+    fpr, tpr, thresholds = roc_curve(y_test, probas[:, 1])
+    return auc(fpr, tpr)
+
+def _mse(clf, X_test=None, y_test=None):
+    y_pred = clf.predict(X_test)
+    return mean_squared_error(y_test, y_pred)
+
+def _rmsle(clf, X_test=None, y_test=None):
+    y_pred = clf.predict(X_test)
+    return copper.utils.ml.rmsle(y_test, y_pred)
+
+# name: (function, ascending)
+_METRICS = {'accuracy': (_accuracy, False),
+           'auc': (_auc, False),
+           'mse': (_mse, True),
+           'rmsle': (_rmsle, True)}
+
+def _fit_score(clf, X_train, y_train, X_test, y_test, fnc):
+    '''
+    Fits a classifier and scores it, used by the parallel jobs
+    '''
+    start = time.time()
+    clf.fit(X_train, y_train)
+    fit_time = time.time() - start
+    return clf, fnc(clf, X_test=X_test, y_test=y_test), fit_time
+
+# Number of counts (resamples x rows) of each block of bootstrap resamples
+BOOTSTRAP_BLOCK_SIZE = 2 ** 22
+
+def _bootstrap_weights(n, n_iter, random_state=None):
+    '''
+    Draws n_iter resamples (with replacement) of n rows, generated in blocks
+    of about BOOTSTRAP_BLOCK_SIZE counts so the memory does not grow with
+    n_iter. The resamples are the same for any block size.
+
+    Returns
+    -------
+        generator of np.array (block x n), number of times each row is on
+        each resample
+    '''
+    rng = np.random.RandomState(random_state)
+    block = max(BOOTSTRAP_BLOCK_SIZE // n, 1)
+    for start in range(0, n_iter, block):
+        size = min(block, n_iter - start)
+        index = rng.randint(0, n, (size, n)) + np.arange(size)[:, np.newaxis] * n
+        yield np.bincount(index.ravel(), minlength=size * n).reshape((size, n))
+
+def _auc_groups(scores, positive):
+    '''
+    Sorts the scores once for _weighted_auc
+
+    Returns
+    -------
+        (order of the scores, start of each group of tied scores,
+            positive sorted by score)
+    '''
+    order = np.argsort(scores, kind='mergesort')
+    starts = np.append(0, np.nonzero(np.diff(scores[order]))[0] + 1)
+    return order, starts, positive[order]
+
+def _weighted_auc(groups, weights):
+    '''
+    Area under the ROC curve for every row of weights (resamples),
+    ties count as half.
+
+    Parameters
+    ----------
+        groups: result of _auc_groups(scores, positive)
+        weights: np.array (n_iter x n)
+
+    Returns
+    -------
+        np.array (n_iter)
+    '''
+    order, starts, positive = groups
+    w = weights[:, order]
+    pos_w = np.add.reduceat(w * positive, starts, axis=1)
+    neg_w = np.add.reduceat(w * ~positive, starts, axis=1)
+    neg_below = np.cumsum(neg_w, axis=1) - neg_w
+    area = (pos_w * (neg_below + 0.5 * neg_w)).sum(axis=1)
+    return area / (pos_w.sum(axis=1) * neg_w.sum(axis=1))
+
+def _label_positions(labels, values):
+    '''
+    Positions of values on the sorted array labels, raises ValueError when
+    a value is not one of the labels
+    '''
+    values = np.asarray(values)
+    pos = np.searchsorted(labels, values).clip(0, len(labels) - 1)
+    unknown = labels[pos] != values
+    if unknown.any():
+        raise ValueError('Unknown labels: %s' % list(np.unique(values[unknown])))
+    return pos
+
+def _iter_chunks(data, chunksize, metadata=None):
+    '''
+    Generates Datasets of at most chunksize rows from a Dataset, a csv file
+    or an iterable of Datasets/DataFrames
+    '''
+    if type(data) is copper.Dataset:
+        frames = (data.frame[i:i + chunksize]
+                            for i in range(0, len(data), chunksize))
+    elif type(data) is str:
+        frames = copper.read_csv(data, chunksize=chunksize)
+    else:
+        frames = data
+
+    for frame in frames:
+        if type(frame) is copper.Dataset:
+            yield frame
+        else:
+            ds = copper.Dataset(frame)
+            if metadata is not None:
+                ds.match(metadata)
+            yield ds
+
+
+class MetricAccumulator(object):
+    '''
+    Accumulates confusion counts, squared errors and histograms of the
+    predicted probabilities of several classifiers, so the metrics can be
+    calculated chunk by chunk with bounded memory.
+    Accumulators of different chunks (or workers) can be merged.
+
+    Parameters
+    ----------
+        clfs: list, names of the classifiers
+        labels: list, values of the target. None (e.g. regressors) to not
+                    count the confusion matrices
+        target: target value to consider positive for the AUC
+        bins: int, number of bins of the score histograms for the AUC
+    '''
+
+    def __init__(self, clfs, labels=None, target=1, bins=1000):
+        self.clfs = list(clfs)
+        self.labels = None if labels is None else np.unique(labels)
+        self.target = target
+        self.bins = bins
+        k = len(self.clfs)
+        self.n = 0
+        self.cms = None
+        if self.labels is not None:
+            n = len(self.labels)
+            self.cms = np.zeros((k, n, n), dtype=np.int64)
+        self.se = np.zeros(k)
+        self.sle = np.zeros(k)
+        self.pos_hist = np.zeros((k, bins), dtype=np.int64)
+        self.neg_hist = np.zeros((k, bins), dtype=np.int64)
+
+    def update(self, y_true, y_pred, probas=None):
+        '''
+        Adds a chunk of predictions
+
+        Parameters
+        ----------
+            y_true: np.array (n_rows)
+            y_pred: np.array (n_clfs x n_rows), predictions
+            probas: np.array (n_clfs x n_rows), probabilities of target
+
+        Raises ValueError if y_true or y_pred have values not in self.labels
+        '''
+        k = len(self.clfs)
+        if self.labels is not None:
+            n = len(self.labels)
+            true_pos = _label_positions(self.labels, y_true)
+            pred_pos = _label_positions(self.labels, y_pred)
+            flat = (np.arange(k)[:, np.newaxis] * n + true_pos) * n + pred_pos
+            self.cms += np.bincount(flat.ravel(), minlength=k * n * n).reshape((k, n, n))
+        self.n += len(y_true)
+
+        self.se += np.power(y_pred - y_true, 2).sum(axis=1)
+        self.sle += np.power(np.log1p(y_pred) - np.log1p(y_true), 2).sum(axis=1)
+
+        if probas is not None:
+            bin_pos = (np.nan_to_num(probas) * self.bins).astype(int).clip(0, self.bins - 1)
+            flat = np.arange(k)[:, np.newaxis] * self.bins + bin_pos
+            is_pos = y_true == self.target
+            size = k * self.bins
+            self.pos_hist += np.bincount(flat[:, is_pos].ravel(), minlength=size).reshape((k, self.bins))
+            self.neg_hist += np.bincount(flat[:, ~is_pos].ravel(), minlength=size).reshape((k, self.bins))
+
+    def merge(self, other):
+        '''
+        Adds the counts of other accumulator of the same classifiers
+        '''
+        self.n += other.n
+        if self.cms is not None:
+            self.cms += other.cms
+        self.se += other.se
+        self.sle += other.sle
+        self.pos_hist += other.pos_hist
+        self.neg_hist += other.neg_hist
+        return self
+
+    def accuracy(self):
+        if self.cms is None:
+            return pd.Series(np.nan, index=self.clfs, name='Accuracy')
+        correct = np.diagonal(self.cms, axis1=1, axis2=2).sum(axis=1)
+        return pd.Series(correct / self.n, index=self.clfs, name='Accuracy')
+
+    def mse(self):
+        return pd.Series(self.se / self.n, index=self.clfs, name='Mean Squared Error')
+
+    def rmsle(self):
+        return pd.Series(np.sqrt(self.sle / self.n), index=self.clfs, name='RMSLE')
+
+    def auc(self):
+        '''
+        Area under the ROC curve from the histograms, ties inside each bin
+        count as half (exact when the probabilities have less than bins values)
+        '''
+        pos = self.pos_hist[:, ::-1]
+        neg = self.neg_hist[:, ::-1]
+        pos_above = np.cumsum(pos, axis=1) - pos
+        area = (neg * (pos_above + 0.5 * pos)).sum(axis=1)
+        total = pos.sum(axis=1) * neg.sum(axis=1)
+        return pd.Series(area / total, index=self.clfs, name='Area Under the Curve')
+
+    def cm(self, clf):
+        '''
+        Return a pandas.DataFrame version of the accumulated confusion matrix
+        '''
+        if self.cms is None:
+            raise ValueError('The confusion matrices are not counted without labels')
+        cm = self.cms[self.clfs.index(clf)]
+        return pd.DataFrame(cm, index=self.labels, columns=self.labels)
+
+    def frame(self):
+        '''
+        Returns a DataFrame with all the metrics of all the classifiers
+        '''
+        ans = pd.DataFrame(index=self.clfs)
+        for metric in [self.accuracy(), self.auc(), self.mse(), self.rmsle()]:
+            ans[metric.name] = metric
+        return ans
 
 
 class ModelComparison():
@@ -27,6 +302,13 @@ class ModelComparison():
         self.y_train = None
         self.X_test  = None
         self.y_test = None
+        self.track_memory = False
+        self._costs = {}
+        self._sizes = {}
+        self._cache = {}
+        self._cache_X = None
+        self.refit_every = None
+        self._stale = {}
 
     # --------------------------------------------------------------------------
     #                               PROPERTIES
@@ -59,6 +341,8 @@ class ModelComparison():
         Adds a new classifier
         '''
         self._clfs[name] = clf
+        self._invalidate(name)
+        self._record_size(name)
 
     def add_clfs(self, clfs, prefix):
         '''
@@ -72,39 +356,135 @@ class ModelComparison():
         Removes a classifier
         '''
         del self._clfs[name]
+        self._invalidate(name)
+        self._sizes.pop(name, None)
+        for key in [key for key in self._costs if key[0] == name]:
+            del self._costs[key]
 
     def clear_clfs(self):
         '''
         Removes all classifiers
         '''
         self._clfs = {}
+        self._costs = {}
+        self._sizes = {}
+        self._cache = {}
+        self._stale = {}
+
+    def _names(self):
+        '''
+        Names of the classifiers, without loading the classifiers of a
+        ModelComparison loaded with copper.load
+        '''
+        return pd.Index(list(self._clfs.keys()))
 
     def list_clfs(self):
         '''
-        Generates a Series with all the classifiers
+        Generates a Series with all the classifiers. The classifiers of a
+        ModelComparison loaded with copper.load are loaded when listed: use
+        copper.load(filepath, clf=name) to load only one
 
         Returns
         -------
             pandas.Series
         '''
         clfs = list(self._clfs.keys())
-        values = list(self._clfs.values())
+        values = [self._clfs[name] for name in clfs]
         # func = lambda x: str(type(x))[8:-2]
         # return pd.Series(values, index=clfs).apply(func)
         return pd.Series(values, index=clfs)
 
     clfs = property(list_clfs, None)
 
+    def save(self, filename):
+        '''
+        Saves the ModelComparison on the project data folder, the arrays are
+        saved as memory-mappable files. Load it with copper.load
+
+        Parameters
+        ----------
+            filename: str, e.g.: 'models.mc'
+        '''
+        if not filename.endswith('.mc'):
+            filename = filename + '.mc'
+        copper.save(self, filename)
+
     # --------------------------------------------------------------------------
     #                            Scikit-learn API
     # --------------------------------------------------------------------------
 
-    def fit(self):
+    def fit(self, clfs=None):
+        '''
+        Fit the classifiers
+
+        Parameters
+        ----------
+            clfs: list, of classifiers to fit, default all
+        '''
+        if clfs is None:
+            clfs = self._names()
+        for clf_name in clfs:
+            clf = self._clfs[clf_name]
+            self._measure(clf_name, 'Fit', len(self.X_train), clf.fit,
+                                                self.X_train, self.y_train)
+            self._invalidate(clf_name)
+            self._record_size(clf_name)
+            self._stale[clf_name] = 0
+
+    def add_train(self, ds):
         '''
-        Fit all the classifiers
+        Adds new rows to the training set and updates the classifiers.
+        The rows are encoded with the columns of the current training set.
+        Classifiers with partial_fit are updated only with the new rows.
+        The others are fitted on the complete training set every
+        self.refit_every calls, if refit_every is None they are not fitted
+        (use fit(clfs=[...]) when needed).
+        Only the cached predictions of the updated classifiers are discarded.
+
+        Parameters
+        ----------
+            ds: copper.Dataset, with the new rows
+
+        Returns
+        -------
+            pandas.Series with the update of each classifier:
+                partial_fit, fit or pending (number of pending updates)
         '''
-        for clf_name in self.clfs.index:
-            self._clfs[clf_name].fit(self.X_train, self.y_train)
+        if self.X_train is None:
+            self.set_train(ds)
+            self.fit()
+            return pd.Series('fit', index=self._names(), name='Update')
+
+        X = self._encode_chunk(ds)
+        y = copper.transform.target2ml(ds).values
+        self.X_train = np.vstack((self.X_train, X))
+        self.y_train = np.append(self.y_train, y)
+        self.target_labels = list(set(self.y_train))
+        classes = np.unique(self.y_train)
+
+        clfs = list(self._names())
+        ans = []
+        for clf_name in clfs:
+            clf = self._clfs[clf_name]
+            if hasattr(clf, 'partial_fit'):
+                if is_classifier(clf):
+                    fnc = lambda: clf.partial_fit(X, y, classes=classes)
+                else:
+                    fnc = lambda: clf.partial_fit(X, y)
+                self._measure(clf_name, 'Partial fit', len(X), fnc)
+                self._invalidate(clf_name)
+                self._record_size(clf_name)
+                ans.append('partial_fit')
+                continue
+
+            self._stale[clf_name] = self._stale.get(clf_name, 0) + 1
+            if self.refit_every is not None and \
+                                self._stale[clf_name] >= self.refit_every:
+                self.fit(clfs=[clf_name])
+                ans.append('fit')
+            else:
+                ans.append('pending (%d)' % self._stale[clf_name])
+        return pd.Series(ans, index=clfs, name='Update')
 
     def predict(self, ds=None, clfs=None):
         '''
@@ -120,7 +500,7 @@ class ModelComparison():
             pandas.DataFrame with the predictions
         '''
         if clfs is None:
-            clfs = self.clfs.index
+            clfs = self._names()
         if ds is not None:
             X_test = copper.transform.inputs2ml(ds).values
         else:
@@ -129,7 +509,8 @@ class ModelComparison():
         ans = pd.DataFrame(index=range(len(X_test)))
         for clf_name in clfs:
             clf = self._clfs[clf_name]
-            scores = clf.predict(X_test)
+            scores = self._measure(clf_name, 'Predict', len(X_test),
+                                                        clf.predict, X_test)
             new = pd.Series(scores, index=ans.index, name=clf_name, dtype=int)
             ans = ans.join(new)
         return ans
@@ -147,7 +528,7 @@ class ModelComparison():
             pandas.DataFrame with the predicted probabilities
         '''
         if clfs is None:
-            clfs = self.clfs.index
+            clfs = self._names()
         if ds is not None:
             X_test = copper.transform.inputs2ml(ds).values
         else:
@@ -156,7 +537,8 @@ class ModelComparison():
         ans = pd.DataFrame(index=range(len(X_test)))
         for clf_name in clfs:
             clf = self._clfs[clf_name]
-            probas = clf.predict_proba(X_test)
+            probas = self._measure(clf_name, 'Predict proba', len(X_test),
+                                                    clf.predict_proba, X_test)
             for val in range(np.shape(probas)[1]):
                 new = pd.Series(probas[:,val], index=ans.index)
                 new.name = '%s [%d]' % (clf_name, val)
@@ -165,19 +547,19 @@ class ModelComparison():
 
     def cutoff_predict(self, target=0, cutoff=0.5, ds=None, clfs=None):
         if clfs is None:
-            clfs = self.clfs.index
+            clfs = self._names()
 
         # Create a list with the indexes of the target columns
         index = self.target_labels.index(target)
         num_options = len(self.target_labels)
         target_cols = [index]
-        for row in self.clfs[1:]:
+        for row in self._names()[1:]:
             target_cols.append(target_cols[-1] + num_options)
         
         # Get all the probabilities and get only the columns with target=target
         probas = self.predict_proba(ds=ds, clfs=clfs)
         probas = probas[probas.columns[target_cols]]
-        probas.columns = self.clfs.index
+        probas.columns = self._names()
         
         for col in probas.columns:
             probas[col][probas[col] < cutoff] = 0
@@ -185,6 +567,163 @@ class ModelComparison():
             # break
         return probas
 
+    def _target_probas(self, target=1, clfs=None):
+        '''
+        Stacks the predicted probabilities of target of the classifiers
+
+        Returns
+        -------
+            (list of clf names, np.array (n_clfs x n_rows))
+        '''
+        if clfs is None:
+            clfs = list(self._names())
+        probas = []
+        for clf_name in clfs:
+            clf = self._clfs[clf_name]
+            ans = self._measure(clf_name, 'Predict proba', len(self.X_test),
+                                            clf.predict_proba, self.X_test)
+            # the columns follow the classes of each classifier
+            probas.append(ans[:, list(clf.classes_).index(target)])
+        return clfs, np.vstack(probas)
+
+    def threshold_sweep(self, target=1, clfs=None):
+        '''
+        Calculates the confusion counts, precision, recall, false positive rate
+        and profit (using self.costs) for every distinct cutoff of the
+        predicted probabilities of target. Each classifier predicts once.
+
+        Parameters
+        ----------
+            target: target value to consider positive
+            clfs: list, of classifiers, default all
+
+        Returns
+        -------
+            python dictionary of pandas.DataFrame, one for each classifier
+        '''
+        clfs, probas = self._target_probas(target=target, clfs=clfs)
+        cutoffs, tp, fp, last = _threshold_counts(self.y_test == target, probas)
+        pos = (self.y_test == target).sum()
+        neg = len(self.y_test) - pos
+        costs = np.asarray(self.costs, dtype=float)
+
+        cols = ['Cutoff', 'TP', 'FP', 'TN', 'FN', 'Precision', 'Recall',
+                                                    'FP Rate', 'Profit']
+        ans = {}
+        for i, clf_name in enumerate(clfs):
+            c_tp = np.append(0, tp[i, last[i]])
+            c_fp = np.append(0, fp[i, last[i]])
+            frame = pd.DataFrame(index=range(len(c_tp)), columns=cols)
+            frame['Cutoff'] = np.append(np.inf, cutoffs[i, last[i]])
+            frame['TP'] = c_tp
+            frame['FP'] = c_fp
+            frame['TN'] = neg - c_fp
+            frame['FN'] = pos - c_tp
+            frame['Precision'] = c_tp / np.maximum(c_tp + c_fp, 1)
+            frame['Recall'] = c_tp / pos
+            frame['FP Rate'] = c_fp / neg
+            frame['Profit'] = c_tp * costs[1, 1] - c_fp * costs[0, 1]
+            ans[clf_name] = frame
+        return ans
+
+    def optimal_cutoff(self, target=1, clfs=None, ascending=False):
+        '''
+        Finds the cutoff that maximizes the profit (using self.costs)
+        of each classifier
+
+        Parameters
+        ----------
+            target: target value to consider positive
+            clfs: list, of classifiers, default all
+            ascending: boolean, sort the DataFrame on this direction
+
+        Returns
+        -------
+            pandas.DataFrame
+        '''
+        sweeps = self.threshold_sweep(target=target, clfs=clfs)
+        cols = ['Cutoff', 'Profit', 'Precision', 'Recall']
+        clfs = list(sweeps.keys())
+        values = []
+        for clf_name in clfs:
+            sweep = sweeps[clf_name]
+            best = sweep['Profit'].values.argmax()
+            values.append([sweep[col].values[best] for col in cols])
+        ans = pd.DataFrame(values, index=clfs, columns=cols)
+        return ans.sort_index(by='Profit', ascending=ascending)
+
+
+    # --------------------------------------------------------------------------
+    #                               COSTS REPORT
+    # --------------------------------------------------------------------------
+
+    def _measure(self, clf_name, operation, rows, fnc, *args):
+        '''
+        Calls fnc(*args) and records the wall time, cpu time and, if
+        self.track_memory is True, the peak memory of the call (traced
+        allocations: python and numpy, not native code). Tracing slows
+        down the calls so it is disabled by default.
+        '''
+        tracing = self.track_memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        start, start_cpu = time.time(), time.process_time()
+        try:
+            ans = fnc(*args)
+        finally:
+            wall = time.time() - start
+            cpu = time.process_time() - start_cpu
+            peak = np.nan
+            if tracing:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+        self._costs[(clf_name, operation)] = (wall, cpu, peak, rows)
+        return ans
+
+    def _record_size(self, clf_name):
+        '''
+        Stores the size (bytes, pickled) of a classifier when it is added or
+        fitted, so costs_report does not pickle (or load) every classifier
+        '''
+        self._sizes[clf_name] = len(pickle.dumps(self._clfs[clf_name],
+                                                    pickle.HIGHEST_PROTOCOL))
+
+    def costs_report(self, clfs=None):
+        '''
+        Generates a DataFrame with the wall time, cpu time (seconds) and peak
+        memory (bytes, NaN unless self.track_memory) of the last call of each
+        operation (fit, predict, predict_proba and metrics) of each
+        classifier, and the size (bytes, pickled) of each classifier when it
+        was added or last fitted.
+        Has the same index as the metrics so it can be joined with them.
+
+        Parameters
+        ----------
+            clfs: list, of classifiers, default all
+
+        Returns
+        -------
+            pandas.DataFrame
+        '''
+        if clfs is None:
+            clfs = list(self._names())
+
+        operations = []
+        for clf_name, operation in self._costs:
+            if operation not in operations:
+                operations.append(operation)
+
+        ans = pd.DataFrame(index=clfs)
+        for operation in operations:
+            values = np.array([self._costs.get((clf_name, operation),
+                            (np.nan,) * 4) for clf_name in clfs], dtype=float)
+            ans['%s time' % operation] = values[:, 0]
+            ans['%s CPU time' % operation] = values[:, 1]
+            ans['%s peak memory' % operation] = values[:, 2]
+            if operation != 'Fit':
+                ans['%s time per 10k rows' % operation] = values[:, 0] / values[:, 3] * 10000
+        ans['Model size'] = [self._sizes.get(clf_name, np.nan) for clf_name in clfs]
+        return ans
 
     # --------------------------------------------------------------------------
     #                               METRICS
@@ -195,12 +734,13 @@ class ModelComparison():
         '''
         # TODO: generate custom error when X_test is missing
         if clfs is None:
-            clfs = self.clfs.index
+            clfs = self._names()
 
         ans = pd.Series(index=clfs, name=name)
         for clf_name in clfs:
             clf = self._clfs[clf_name]
-            ans[clf_name] = fnc(clf, X_test=self.X_test, y_test=self.y_test)
+            ans[clf_name] = self._measure(clf_name, name, len(self.X_test),
+                                            fnc, clf, self.X_test, self.y_test)
         return ans.order(ascending=ascending)
 
     def accuracy(self, **args):
@@ -215,10 +755,7 @@ class ModelComparison():
         -------
             pandas.Series with the accuracy
         '''
-        def fnc (clf, X_test=None, y_test=None):
-            return clf.score(X_test, y_test)
-
-        return self._metric_wrapper(fnc, name='Accuracy', **args)
+        return self._metric_wrapper(_accuracy, name='Accuracy', **args)
 
     def auc(self, **args):
         '''
@@ -232,12 +769,7 @@ class ModelComparison():
         -------
             pandas.Series with the Area under the Curve
         '''
-        def fnc (clf, X_test=None, y_test=None):
-            probas = clf.predict_proba(X_test)
-            fpr, tpr, thresholds = roc_curve(y_test, probas[:, 1])
-            return auc(fpr, tpr)
-
-        return self._metric_wrapper(fnc, name='Area Under the Curve', **args)
+        return self._metric_wrapper(_auc, name='Area Under the Curve', **args)
 
     def mse(self, **args):
         '''
@@ -251,11 +783,7 @@ class ModelComparison():
         -------
             pandas.Series with the Mean Squared Error
         '''
-        def fnc (clf, X_test=None, y_test=None):
-            y_pred = clf.predict(X_test)
-            return mean_squared_error(y_test, y_pred)
-
-        return self._metric_wrapper(fnc, name='Mean Squared Error', ascending=True, **args)
+        return self._metric_wrapper(_mse, name='Mean Squared Error', ascending=True, **args)
 
 
     def rmsle(self, **args):
@@ -270,11 +798,7 @@ class ModelComparison():
         -------
             pandas.Series with the RMSLE
         '''
-        def fnc (clf, X_test=None, y_test=None):
-            y_pred = clf.predict(X_test)
-            return copper.utils.ml.rmsle(y_test, y_pred)
-
-        return self._metric_wrapper(fnc, name='RMSLE', ascending=True, **args)
+        return self._metric_wrapper(_rmsle, name='RMSLE', ascending=True, **args)
 
     def _cv_metric_wrapper(self, fnc, name='', cv=3, ascending=False):
         ''' Wraper to not repeat code on all the possible crossvalidated metrics
@@ -315,6 +839,301 @@ class ModelComparison():
         return self._cv_metric_wrapper(fnc, name='CV Accuracy', **args)
 
 
+    # --------------------------------------------------------------------------
+    #                            STREAMING METRICS
+    # --------------------------------------------------------------------------
+
+    def _encode_chunk(self, ds):
+        '''
+        Encodes a Dataset using the same columns as the training inputs,
+        categories not present on the chunk are filled with 0
+        '''
+        transformed = copper.transform.inputs2ml(ds)
+        if self.feature_labels is not None:
+            transformed = transformed.reindex(columns=self.feature_labels)
+        return transformed.fillna(0).values
+
+    def evaluate_chunks(self, data, chunksize=100000, metadata=None, target=1,
+                                                    bins=1000, clfs=None):
+        '''
+        Predicts data in chunks with every classifier and accumulates the
+        metrics, only one chunk is in memory at any time.
+        Note: the target should be numerical so every chunk has the same values
+
+        Parameters
+        ----------
+            data: copper.Dataset, str path of a csv file (on the project data
+                        folder) or iterable of copper.Dataset/pandas.DataFrame
+            chunksize: int, number of rows of each chunk
+            metadata: copper.Dataset, used to set the roles and types of
+                        every chunk, default is data when is a Dataset
+            target: target value to consider positive for the AUC
+            bins: int, number of bins of the score histograms for the AUC
+            clfs: list, of classifiers to evaluate, default all. If any is
+                        a regressor only the squared errors are accumulated
+
+        Returns
+        -------
+            MetricAccumulator, use frame() to get the metrics
+        '''
+        if clfs is None:
+            clfs = list(self._names())
+        if metadata is None and type(data) is copper.Dataset:
+            metadata = data
+        labels = None
+        if all(is_classifier(self._clfs[clf_name]) for clf_name in clfs):
+            labels = sorted(self.target_labels)
+
+        acc = MetricAccumulator(clfs, labels, target=target, bins=bins)
+        for ds in _iter_chunks(data, chunksize, metadata):
+            X = self._encode_chunk(ds)
+            y = copper.transform.target2ml(ds).values
+            y_pred = np.vstack([self._clfs[clf_name].predict(X)
+                                                    for clf_name in clfs])
+            probas = np.zeros(y_pred.shape)
+            probas[:] = np.nan
+            for i, clf_name in enumerate(clfs if labels is not None else []):
+                clf = self._clfs[clf_name]
+                try:
+                    col = list(clf.classes_).index(target)
+                    probas[i] = clf.predict_proba(X)[:, col]
+                except AttributeError:
+                    pass # Is OK, some models do not have predict_proba
+            acc.update(y, y_pred, probas)
+        return acc
+
+    # --------------------------------------------------------------------------
+    #                                BOOTSTRAP
+    # --------------------------------------------------------------------------
+
+    def _invalidate(self, clf_name):
+        '''
+        Discards the cached predictions of a classifier
+        '''
+        for key in [key for key in self._cache if key[0] == clf_name]:
+            del self._cache[key]
+
+    def _cached(self, clf_name, method):
+        '''
+        Returns the predictions (method='predict') or the probabilities
+        (method='predict_proba') of a classifier on self.X_test.
+        Each classifier predicts only once while X_test does not change.
+        '''
+        if self._cache_X is not self.X_test:
+            self._cache = {}
+            self._cache_X = self.X_test
+        key = (clf_name, method)
+        if key not in self._cache:
+            operation = 'Predict' if method == 'predict' else 'Predict proba'
+            fnc = getattr(self._clfs[clf_name], method)
+            self._cache[key] = self._measure(clf_name, operation,
+                                        len(self.X_test), fnc, self.X_test)
+        return self._cache[key]
+
+    def _bootstrap(self, metric='accuracy', n_iter=1000, clfs=None,
+                                                        random_state=None):
+        '''
+        Calculates the metric of the classifiers on n_iter resamples of the
+        cached test predictions. Each block of resamples is drawn once and
+        used for all the classifiers.
+
+        Returns
+        -------
+            (list of clf names, np.array (n_clfs) metric on the test set,
+                np.array (n_clfs x n_iter) metric on each resample)
+        '''
+        if clfs is None:
+            clfs = list(self._names())
+        y = self.y_test
+        n = len(y)
+        blocks = _bootstrap_weights(n, n_iter, random_state=random_state)
+        ones = np.ones((1, n))
+
+        if metric == 'auc':
+            positive = y == 1
+            groups = [_auc_groups(self._cached(clf_name, 'predict_proba')[:, 1],
+                                                positive) for clf_name in clfs]
+            point = np.array([_weighted_auc(g, ones)[0] for g in groups])
+            reps = np.hstack([np.vstack([_weighted_auc(g, weights)
+                                for g in groups]) for weights in blocks])
+            return clfs, point, reps
+
+        y_pred = np.vstack([self._cached(clf_name, 'predict') for clf_name in clfs])
+        if metric == 'accuracy':
+            values = (y_pred == y).astype(float)
+        elif metric == 'mse':
+            values = np.power(y_pred - y, 2)
+        elif metric == 'rmsle':
+            values = np.power(np.log1p(y_pred) - np.log1p(y), 2)
+        elif metric == 'profit':
+            costs = np.asarray(self.costs, dtype=float)
+            values = ((y_pred == 1) & (y == 1)) * costs[1, 1] - \
+                                    ((y_pred == 1) & (y == 0)) * costs[0, 1]
+        else:
+            raise ValueError('Unknown metric: %s' % metric)
+
+        point = np.dot(values, ones.T)[:, 0]
+        reps = np.hstack([np.dot(values, weights.T) for weights in blocks])
+        if metric != 'profit':
+            point, reps = point / n, reps / n
+        if metric == 'rmsle':
+            point, reps = np.sqrt(point), np.sqrt(reps)
+        return clfs, point, reps
+
+    def bootstrap_ci(self, metric='accuracy', n_iter=1000, alpha=0.05,
+                                clfs=None, random_state=None, ascending=None):
+        '''
+        Confidence intervals of a metric resampling the test predictions,
+        the classifiers are not fitted again and predict only once.
+
+        Parameters
+        ----------
+            metric: str, one of: accuracy, auc, mse, rmsle, profit
+            n_iter: int, number of resamples
+            alpha: float, the interval covers 1 - alpha
+            clfs: list, of classifiers, default all
+            random_state: int, seed of the resamples
+            ascending: boolean, sort the DataFrame on this direction,
+                        default depends on the metric
+
+        Returns
+        -------
+            pandas.DataFrame with the metric, the lower and upper limits and
+            the standard deviation of the resamples
+        '''
+        clfs, point, reps = self._bootstrap(metric=metric, n_iter=n_iter,
+                                    clfs=clfs, random_state=random_state)
+        ans = pd.DataFrame(index=clfs)
+        ans[metric] = point
+        ans['Lower'] = np.percentile(reps, 100 * alpha / 2, axis=1)
+        ans['Upper'] = np.percentile(reps, 100 * (1 - alpha / 2), axis=1)
+        ans['Std'] = reps.std(axis=1)
+        if ascending is None:
+            ascending = metric in ('mse', 'rmsle')
+        return ans.sort_index(by=metric, ascending=ascending)
+
+    def bootstrap_compare(self, clf1, clf2, metric='accuracy', n_iter=1000,
+                                            alpha=0.05, random_state=None):
+        '''
+        Paired comparison of two classifiers: both classifiers are evaluated
+        on the same resamples of the test predictions.
+
+        Parameters
+        ----------
+            clf1, clf2: str, classifier identifiers
+            metric: str, one of: accuracy, auc, mse, rmsle, profit
+            n_iter: int, number of resamples
+            alpha: float, the interval covers 1 - alpha
+
+        Returns
+        -------
+            pandas.Series with the difference (clf1 - clf2) of the metric,
+            the limits of its interval and the fraction of resamples where
+            the difference is <= 0
+        '''
+        clfs, point, reps = self._bootstrap(metric=metric, n_iter=n_iter,
+                            clfs=[clf1, clf2], random_state=random_state)
+        diffs = reps[0] - reps[1]
+        cols = ['Difference', 'Lower', 'Upper', 'P(Difference <= 0)']
+        values = [point[0] - point[1],
+                  np.percentile(diffs, 100 * alpha / 2),
+                  np.percentile(diffs, 100 * (1 - alpha / 2)),
+                  np.mean(diffs <= 0)]
+        return pd.Series(values, index=cols, name='%s - %s' % (clf1, clf2))
+
+    def ensemble_selection(self, metric='accuracy', n_iter=50, init_size=1,
+                                                                clfs=None):
+        '''
+        Greedy forward selection of a weighted AverageBag from the
+        classifiers using their cached probabilities on the testing set
+        (used as validation set).
+        See copper.utils.ml.ensemble_selection
+
+        Parameters
+        ----------
+            metric: str, one of: accuracy, logloss, mse, auc
+            n_iter: int, number of classifiers added
+            clfs: list, of classifiers of the library, default all
+
+        Returns
+        -------
+            (copper.AverageBag, pandas.Series with the metric on each iteration)
+        '''
+        if clfs is None:
+            clfs = list(self._names())
+        probas = np.array([self._cached(clf_name, 'predict_proba')
+                                                    for clf_name in clfs])
+        y = np.searchsorted(np.unique(self.y_train), self.y_test)
+        return copper.utils.ml.ensemble_selection([self._clfs[clf_name]
+                            for clf_name in clfs], probas, y, metric=metric,
+                            n_iter=n_iter, init_size=init_size)
+
+    # --------------------------------------------------------------------------
+    #                                 RACING
+    # --------------------------------------------------------------------------
+
+    def race(self, metric='accuracy', min_size=0.1, keep=0.5, refit=True,
+                                                n_jobs=1, random_state=None):
+        '''
+        Successive halving: fits all the classifiers on a small subsample of
+        the training set, scores them on the testing set, keeps the best
+        fraction and repeats on larger (nested) subsamples until one remains.
+        The classifiers of each round are fitted in parallel using clones.
+
+        Parameters
+        ----------
+            metric: str, one of: accuracy, auc, mse, rmsle
+            min_size: float, fraction of the training set of the first round
+            keep: float, between 0 and 1 (exclusive), fraction of the
+                        classifiers kept after each round (at least one is
+                        dropped), the subsample grows by 1/keep each round
+            refit: boolean, True to fit the winner on the full training set
+            n_jobs: int, number of parallel jobs, -1 for all cpus
+            random_state: int, seed of the subsamples
+
+        Returns
+        -------
+            (str winner, pandas.DataFrame with the elimination history,
+                pandas.Series with the time (seconds) of each round)
+        '''
+        if not 0 < keep < 1:
+            raise ValueError('keep should be between 0 and 1')
+        fnc, ascending = _METRICS[metric]
+        rng = np.random.RandomState(random_state)
+        perm = rng.permutation(len(self.X_train))
+        size = max(int(min_size * len(perm)), 2)
+
+        candidates = list(self._names())
+        history = []
+        times = []
+        i = 0
+        while len(candidates) > 1:
+            rows = perm[:size]
+            start = time.time()
+            results = Parallel(n_jobs=n_jobs)(delayed(_fit_score)(
+                        clone(self._clfs[clf_name]),
+                        self.X_train[rows], self.y_train[rows],
+                        self.X_test, self.y_test, fnc) for clf_name in candidates)
+            times.append(time.time() - start)
+
+            scores = pd.Series([r[1] for r in results], index=candidates)
+            n_keep = int(np.ceil(len(candidates) * keep))
+            n_keep = min(n_keep, len(candidates) - 1)
+            kept = list(scores.order(ascending=ascending).index[:n_keep])
+            for clf_name, (clf, score, fit_time) in zip(candidates, results):
+                history.append([i, len(rows), clf_name, score, fit_time,
+                                                        clf_name in kept])
+            candidates = kept
+            size = min(int(np.ceil(size / keep)), len(perm))
+            i = i + 1
+
+        winner = candidates[0]
+        if refit:
+            self.fit(clfs=[winner])
+        cols = ['Round', 'Train size', 'Classifier', 'Score', 'Fit time', 'Kept']
+        times = pd.Series(times, name='Round time')
+        return winner, pd.DataFrame(history, columns=cols), times
+
     # --------------------------------------------------------------------------
     #                          Sampling / Crossvalidation
     # --------------------------------------------------------------------------
@@ -351,6 +1170,40 @@ class ModelComparison():
     #                            CONFUSION MATRIX
     # --------------------------------------------------------------------------
 
+    def _cm_tensor(self, clfs=None):
+        '''
+        Calculates the confusion matrixes of all the classifiers at once.
+        The predictions are stacked and counted with a single bincount.
+
+        Parameters
+        ----------
+            clfs: list or str, of the classifiers to calculate the cm
+
+        Returns
+        -------
+            (list of clf names, np.array of labels,
+                np.array (n_clfs x n_labels x n_labels) of counts)
+        '''
+        if clfs is None:
+            clfs = list(self._clfs.keys())
+        elif type(clfs) is str:
+            clfs = [clfs]
+        else:
+            clfs = list(clfs)
+
+        y_pred = np.vstack([self._measure(clf_name, 'Predict',
+                len(self.X_test), self._clfs[clf_name].predict, self.X_test)
+                for clf_name in clfs])
+        labels = np.unique(np.concatenate((self.y_test, y_pred.ravel())))
+        n = len(labels)
+        true_pos = np.searchsorted(labels, self.y_test)
+        pred_pos = np.searchsorted(labels, y_pred)
+        clf_pos = np.arange(len(clfs))[:, np.newaxis]
+
+        flat = (clf_pos * n + true_pos) * n + pred_pos
+        counts = np.bincount(flat.ravel(), minlength=len(clfs) * n * n)
+        return clfs, labels, counts.reshape((len(clfs), n, n))
+
     def _cm(self, clfs=None):
         '''
         Calculates the confusion matrixes of the classifiers
@@ -363,18 +1216,8 @@ class ModelComparison():
         -------
             python dictionary
         '''
-        if clfs is None:
-            clfs = self._clfs.keys()
-        else :
-            if type(clfs) is str:
-                clfs = [clfs]
-
-        ans = {}
-        for clf_name in clfs:
-            clf = self._clfs[clf_name]
-            y_pred = clf.predict(self.X_test)
-            ans[clf_name] = confusion_matrix(self.y_test, y_pred)
-        return ans
+        clfs, labels, cms = self._cm_tensor(clfs=clfs)
+        return dict(zip(clfs, cms))
 
     def cm(self, clf):
         '''
@@ -384,9 +1227,8 @@ class ModelComparison():
         ----------
             clf: str, classifier identifier
         '''
-        cm = self._cm(clfs=clf)[clf]
-        values = set(self.y_test)
-        return pd.DataFrame(cm, index=values, columns=values)
+        clfs, labels, cms = self._cm_tensor(clfs=clf)
+        return pd.DataFrame(cms[0], index=labels, columns=labels)
 
     def cm_table(self, values=None, ascending=False):
         '''
@@ -407,20 +1249,17 @@ class ModelComparison():
         elif type(values) is int:
             values = [values]
 
-        cm_s = self._cm()
-        ans = pd.DataFrame(index=cm_s.keys())
-        zeros = np.zeros((len(ans), 3))
+        clfs, labels, cms = self._cm_tensor()
+        labels = list(labels)
+        predicted = cms.sum(axis=1)
+        diagonal = np.diagonal(cms, axis1=1, axis2=2)
 
+        ans = pd.DataFrame(index=clfs)
         for value in values:
-            cols = ['Predicted %d\'s' % value, 'Correct %d\'s' % value,
-                                    'Rate %d\'s' % value]
-            n_ans = pd.DataFrame(zeros ,index=cm_s.keys(), columns=cols)
-            for clf_name in cm_s.keys():
-                cm = cm_s[clf_name]
-                n_ans['Predicted %d\'s' % value][clf_name] = cm[:,value].sum()
-                n_ans['Correct %d\'s' % value][clf_name] = cm[value,value].sum()
-                n_ans['Rate %d\'s' % value][clf_name] = cm[value,value].sum() / cm[:,value].sum()
-            ans = ans.join(n_ans)
+            i = labels.index(value)
+            ans['Predicted %d\'s' % value] = predicted[:, i]
+            ans['Correct %d\'s' % value] = diagonal[:, i]
+            ans['Rate %d\'s' % value] = diagonal[:, i] / predicted[:, i]
         return ans.sort_index(by='Rate %d\'s' % value, ascending=ascending)
 
     def cm_falses(self):
@@ -431,6 +1270,39 @@ class ModelComparison():
     #                                 COSTS
     # --------------------------------------------------------------------------
 
+    def _cost_tensor(self, costs=None):
+        '''
+        Returns the cost matrix (or matrixes) as a 3D array
+        (n_costs x 2 x 2), default is [self.costs]
+        '''
+        if costs is None:
+            costs = self.costs
+        costs = np.asarray(costs, dtype=float)
+        if costs.ndim == 2:
+            costs = costs[np.newaxis]
+        return costs
+
+    def _profit_tensor(self, costs=None):
+        '''
+        Calculates the loss, revenue and profit of every classifier for
+        every cost matrix contracting the confusion tensor with the costs
+
+        Returns
+        -------
+            (list of clf names, loss, revenue, profit) each array is
+                                                        (n_clfs x n_costs)
+        '''
+        costs = self._cost_tensor(costs)
+        clfs, labels, cms = self._cm_tensor()
+        cms = cms[:, :2, :2]
+        loss_w = np.zeros_like(costs)
+        loss_w[:, 0, 1] = costs[:, 0, 1]
+        revenue_w = np.zeros_like(costs)
+        revenue_w[:, 1, 1] = costs[:, 1, 1]
+        loss = np.einsum('kij,mij->km', cms, loss_w)
+        revenue = np.einsum('kij,mij->km', cms, revenue_w)
+        return clfs, loss, revenue, revenue - loss
+
     def profit(self, by='Profit', ascending=False):
         '''
         Calculates the Revenue of using the classifiers.
@@ -445,18 +1317,28 @@ class ModelComparison():
         -------
             pandas.DataFrame
         '''
-        cm_s = self._cm()
+        clfs, loss, revenue, profit = self._profit_tensor()
         cols = ['Loss from False Positive', 'Revenue', 'Profit']
-        ans = pd.DataFrame(np.zeros((len(cm_s.keys()), 3)), index=cm_s.keys(), columns=cols)
+        values = np.column_stack((loss[:, 0], revenue[:, 0], profit[:, 0]))
+        ans = pd.DataFrame(values, index=clfs, columns=cols)
+        return ans.sort_index(by=by, ascending=ascending)
 
-        for clf in ans.index:
-            cm = cm_s[clf]
-            ans['Loss from False Positive'][clf] = cm[0,1] * self.costs[0][1]
-            ans['Revenue'][clf] = cm[1,1] * self.costs[1][1]
-            ans['Profit'][clf] = ans['Revenue'][clf] - \
-                                        ans['Loss from False Positive'][clf]
+    def profit_sensitivity(self, costs):
+        '''
+        Calculates the profit of the classifiers for many cost matrixes at
+        once, useful for sensitivity analysis of self.costs.
+        The classifiers predict only once.
 
-        return ans.sort_index(by=by, ascending=ascending)
+        Parameters
+        ----------
+            costs: list of cost matrixes or np.array (n_costs x 2 x 2)
+
+        Returns
+        -------
+            pandas.DataFrame, one row per classifier, one column per cost matrix
+        '''
+        clfs, loss, revenue, profit = self._profit_tensor(costs=costs)
+        return pd.DataFrame(profit, index=clfs)
 
     def oportunity_cost(self, ascending=False):
         '''
@@ -471,12 +1353,13 @@ class ModelComparison():
         -------
             pandas.DataFrame
         '''
-        cm_s = self._cm()
-        ans = pd.Series(index=cm_s.keys(), name='Oportuniy cost')
-
-        for clf in ans.index:
-            cm = cm_s[clf]
-            ans[clf] = cm[1,0] * self.costs[1][0] + cm[0,1] * self.costs[0][1]
+        costs = self._cost_tensor()[0]
+        weights = np.zeros_like(costs)
+        weights[1, 0] = costs[1, 0]
+        weights[0, 1] = costs[0, 1]
+        clfs, labels, cms = self._cm_tensor()
+        values = np.einsum('kij,ij->k', cms[:, :2, :2], weights)
+        ans = pd.Series(values, index=clfs, name='Oportuniy cost')
         return ans.order(ascending=ascending)
 
     def cost_no_ml(self, ascending=False):
@@ -495,11 +1378,7 @@ class ModelComparison():
         cols = ['Expense', 'Revenue', 'Net revenue']
         ans = pd.Series(index=cols, name='Costs of not using ML')
 
-        # TODO: replace for bincount
-        # counts = np.bincount(self.y_test)
-        counts = []
-        counts.append(len(self.y_test[self.y_test == 0]))
-        counts.append(len(self.y_test[self.y_test == 1]))
+        counts = np.bincount(self.y_test.astype(int), minlength=2)
         ans['Expense'] = counts[0] * self.costs[1][0]
         ans['Revenue'] = counts[1] * self.costs[1][1]
         ans['Net revenue'] = ans['Revenue'] - ans['Expense']
@@ -1,15 +1,84 @@
 from __future__ import division
+import hashlib
 import copper
 import numpy as np
 import pandas as pd
 
 from sklearn import decomposition
+from sklearn import cross_validation
 from sklearn.metrics import accuracy_score
 from sklearn.base import clone, BaseEstimator
+from sklearn.externals.joblib import Parallel, delayed
+from copper.utils import parallel
+
+def _fit_member(clf, X, y, rows=None, features=None, oob=False):
+    '''
+    Fits a member of a bag on the rows and features (index arrays) of X.
+    If oob is True also predicts the probabilities of the rows not used.
+    '''
+    X_m = X if rows is None else X[rows]
+    y_m = y if rows is None else y[rows]
+    if features is not None:
+        X_m = X_m[:, features]
+    clf.fit(X_m, y_m)
+
+    if not oob:
+        return clf, None, None
+    out = np.ones(len(X), dtype=bool)
+    out[rows] = False
+    out = np.nonzero(out)[0]
+    X_o = X[out] if features is None else X[out][:, features]
+    return clf, out, clf.predict_proba(X_o)
+
+def _oob_average(results, classes, n):
+    '''
+    Averages the out-of-bag probabilities of the results of _fit_member
+    for each of the n rows, rows never out-of-bag are nan.
+
+    Returns
+    -------
+        (probabilities (n x classes), boolean mask of the predicted rows)
+    '''
+    total = np.zeros((n, len(classes)))
+    counts = np.zeros(n)
+    for clf, out, probas in results:
+        cols = np.searchsorted(classes, clf.classes_)
+        total[out[:, np.newaxis], cols] += probas
+        counts[out] += 1
+    predicted = counts > 0
+    total[predicted] /= counts[predicted][:, np.newaxis]
+    total[~predicted] = np.nan
+    return total, predicted
 
 class Bag(BaseEstimator):
-    def __init__(self, clfs=None):
+    '''
+    Base of the ensembles of classifiers
+
+    Parameters
+    ----------
+        clfs: list or pandas.Series of classifiers
+        n_jobs: int, number of members fitted in parallel, -1 for all cpus
+        bootstrap: boolean, fit each member on a bootstrap sample of the rows
+        max_features: float, fraction of the features of each member,
+                        default None: all the features
+        oob_score: boolean, only with bootstrap: calculate the out-of-bag
+                        probabilities (oob_decision_function_) and accuracy
+                        (oob_score_) averaging the members
+        random_state: int, seed of the samples
+        batch_size: int, number of rows predicted at once, default all
+    '''
+    def __init__(self, clfs=None, n_jobs=1, bootstrap=False, max_features=None,
+                        oob_score=False, random_state=None, batch_size=None):
         self.clfs = []
+        self.n_jobs = n_jobs
+        self.batch_size = batch_size
+        self.bootstrap = bootstrap
+        self.max_features = max_features
+        self.oob_score = oob_score
+        self.random_state = random_state
+        self.features_ = []
+        self.classes_ = None
+        self.n_features_ = None
         if clfs is not None:
             self.add_clf(clfs)
 
@@ -23,250 +92,471 @@ class Bag(BaseEstimator):
             self.clfs.append(new)
 
     def fit(self, X, y):
+        rng = np.random.RandomState(self.random_state)
+        n, p = X.shape
+        self.classes_ = np.unique(y)
+        self.n_features_ = p
+
+        samples = []
         for clf in self.clfs:
-            clf.fit(X, y)
+            rows, features = None, None
+            if self.bootstrap:
+                rows = rng.randint(0, n, n)
+            if self.max_features is not None:
+                k = max(int(self.max_features * p), 1)
+                features = np.sort(rng.permutation(p)[:k])
+            samples.append((rows, features))
+        self.features_ = [features for rows, features in samples]
+
+        oob = self.bootstrap and self.oob_score
+        if self.n_jobs != 1:
+            X, y = parallel.shared(X, y)
+        results = Parallel(n_jobs=self.n_jobs)(delayed(_fit_member)(
+                        clf, X, y, rows, features, oob)
+                        for clf, (rows, features) in zip(self.clfs, samples))
+        self.clfs = [clf for clf, out, probas in results]
+
+        if oob:
+            total, predicted = _oob_average(results, self.classes_, n)
+            self.oob_decision_function_ = total
+            y_oob = self.classes_[np.argmax(total[predicted], axis=1)]
+            self.oob_score_ = accuracy_score(y[predicted], y_oob)
+        return self
+
+    def _member_proba(self, i, X):
+        '''
+        Predicted probabilities of the member i using its features
+        '''
+        features = self.features_[i] if i < len(self.features_) else None
+        if features is not None:
+            X = X[:, features]
+        return self.clfs[i].predict_proba(X)
+
+    def _classes(self, X):
+        '''
+        Classes of the bag: learned on fit, if the bag was not fitted (the
+        members were fitted before) the classes of the members
+        '''
+        if getattr(self, 'classes_', None) is None:
+            if all(hasattr(clf, 'classes_') for clf in self.clfs):
+                self.classes_ = np.unique(np.concatenate(
+                                    [clf.classes_ for clf in self.clfs]))
+            else:
+                self.classes_ = np.arange(self._member_proba(0, X[:1]).shape[1])
+        return self.classes_
+
+    def _fill_member(self, i, X, out):
+        '''
+        Writes the probabilities of the member i on out (rows x classes)
+        '''
+        probas = self._member_proba(i, X)
+        if probas.shape[1] == out.shape[1]:
+            out[:] = probas
+        else:
+            # The member did not see all the classes
+            out[:] = 0
+            out[:, np.searchsorted(self.classes_, self.clfs[i].classes_)] = probas
+
+    def proba_tensor(self, X, out=None):
+        '''
+        Predicted probabilities of all the members, the members predict in
+        parallel (threads) writing on the same preallocated array
+
+        Parameters
+        ----------
+            X: np.array
+            out: np.array (members x rows x classes) to reuse, optional
+
+        Returns
+        -------
+            np.array (members x rows x classes)
+        '''
+        shape = (len(self.clfs), len(X), len(self._classes(X)))
+        if out is None:
+            out = np.empty(shape)
+        Parallel(n_jobs=self.n_jobs, backend='threading')(
+                        delayed(self._fill_member)(i, X, out[i])
+                        for i in range(len(self.clfs)))
+        return out
+
+    def _reduce(self, probas):
+        '''
+        Combines the probabilities of the members (members x rows x classes)
+        into the probabilities of the bag (rows x classes), default the
+        average
+        '''
+        return probas.mean(axis=0)
+
+    def predict(self, X):
+        probas = self.predict_proba(X)
+        return self.classes_[np.argmax(probas, axis=1)]
+
+    def predict_proba(self, X):
+        '''
+        Predicts in batches of self.batch_size rows (default all) reusing
+        the same array for the probabilities of the members
+        '''
+        n = len(X)
+        # at least 1: an empty X gives an empty (0 x classes) array
+        batch_size = max(1, n if self.batch_size is None else self.batch_size)
+        ans = np.empty((n, len(self._classes(X))))
+        buffer = np.empty((len(self.clfs), min(batch_size, n), ans.shape[1]))
+        for start in range(0, n, batch_size):
+            X_b = X[start:start + batch_size]
+            probas = self.proba_tensor(X_b, out=buffer[:, :len(X_b)])
+            ans[start:start + len(X_b)] = self._reduce(probas)
+        return ans
 
     def score(self, X, y):
         y_pred = self.predict(X)
         return accuracy_score(y, y_pred)
 
+    def export(self):
+        '''
+        Compiles the bag into a NumPy only version for scoring.
+        See copper.utils.inference
+        '''
+        return copper.utils.inference.export(self)
+
 
 class AverageBag(Bag):
     '''
-    Implementation idea:
-    for each classifier 
-        for each option e.g.: (0,1,2)
-            sum each predicted probability
-    divide by the number of clfs
-    '''
-        
-    def predict(self, X):
-        return np.argmax(self.predict_proba(X), axis=1)
+    Average of the predicted probabilities of the classifiers
 
-    def predict_proba(self, X):
-        num_options = len(self.clfs[0].predict_proba(X[:1])[0])
-        ans = np.zeros((len(X), num_options))
-        for clf in self.clfs:
-            probas = clf.predict_proba(X)
-            for i in range(num_options):
-                ans[:, i] = ans[:, i] + probas[:,i]
-        ans = ans / len(self.clfs)
-        return ans
+    Parameters
+    ----------
+        weights: list, weight of each classifier, default all the same
+    '''
+    def __init__(self, clfs=None, weights=None, n_jobs=1, bootstrap=False,
+                        max_features=None, oob_score=False, random_state=None,
+                        batch_size=None):
+        self.weights = weights
+        super().__init__(clfs, n_jobs=n_jobs, bootstrap=bootstrap,
+                            max_features=max_features, oob_score=oob_score,
+                            random_state=random_state, batch_size=batch_size)
+
+    def _reduce(self, probas):
+        if self.weights is None:
+            return probas.mean(axis=0)
+        weights = np.asarray(self.weights, dtype=float)
+        return np.tensordot(weights / weights.sum(), probas, axes=1)
 
 class MaxProbaBag(Bag):
     '''
-    Create a big array with all the predicted probabilities for 
-    each classifier.
-
-    Calculate the max of each row and find the classifier that
-    has that probability
-
-    Iterate over the big array and slice each row to create the ans
-    ''' 
-    def predict(self, X):
-        return np.argmax(self.predict_proba(X), axis=1)
+    For each row use the probabilities of the classifier that has the
+    max probability (of any option), on ties the first classifier
+    '''
 
-    def predict_proba(self, X):
-        num_options = len(self.clfs[0].predict_proba(X[:1])[0])
-       
-        groups = []
-        for i, clf in enumerate(self.clfs):
-            groups.append((i*num_options, i*num_options+num_options))
-        # print(groups)
-       
-        predictions = np.zeros((len(X), num_options*len(self.clfs)))
-        predictions[:] = np.nan
-        for i, clf in enumerate(self.clfs):
-            probas = clf.predict_proba(X) 
-            predictions[:, groups[i][0]:groups[i][1]] = probas
-            # break
-        # print(predictions)
-
-        ans = np.zeros((len(X), num_options))
-        max_pos = np.argmax(predictions, axis=1)
-        max_clf = np.floor(max_pos / num_options)
-        for i, row in enumerate(predictions):
-            g = int(max_clf[i])
-            ans[i, ] = predictions[i, groups[g][0]:groups[g][1]]
-        # print(ans)
-        return ans
+    def _reduce(self, probas):
+        best = np.argmax(probas.max(axis=2), axis=0)
+        return probas[best, np.arange(probas.shape[1])]
 
 class PriorityBag(Bag):
-    def __init__(self, range=0.1, clfs=None):
+    '''
+    For each row use the probabilities of the first classifier (in order)
+    with a probability bigger than 0.5 + range, if no classifier is that
+    sure use the first classifier
+    '''
+    def __init__(self, range=0.1, clfs=None, n_jobs=1, bootstrap=False,
+                        max_features=None, oob_score=False, random_state=None,
+                        batch_size=None):
         self.range = range
-        super().__init__(clfs)
+        super().__init__(clfs, n_jobs=n_jobs, bootstrap=bootstrap,
+                            max_features=max_features, oob_score=oob_score,
+                            random_state=random_state, batch_size=batch_size)
 
-    def predict(self, X):
-        return np.argmax(self.predict_proba(X), axis=1)
+    def _reduce(self, probas):
+        # argmax of all False is 0: the first classifier
+        first = np.argmax(probas.max(axis=2) > 0.5 + self.range, axis=0)
+        return probas[first, np.arange(probas.shape[1])]
 
-    def predict_proba(self, X):
-        num_options = len(self.clfs[0].predict_proba(X[:1])[0])
-
-        # create a list of the group columns
-        groups = []
-        for i, option in enumerate(self.clfs):
-            groups.append((i*num_options, i*num_options+num_options))
-        # print(groups)
-
-        # create a huge matrix with all the predictions
-        num_cols = num_options * len(self.clfs)
-        predictions = np.zeros((len(X), num_cols))
-        predictions[:] = np.nan
-        for i, clf in enumerate(self.clfs):
-            predictions[:, groups[i][0]:groups[i][1]] = clf.predict_proba(X)
-            # break
-        # print(predictions)
-
-        ans = np.zeros((len(X), num_options))
-        for i, row in enumerate(predictions):
-            for group in groups:
-                g = row[group[0]:group[1]]
-                m = np.max(g)
-                if m > 0.5 + self.range:
-                    ans[i, :] = g
-                    break
-                elif group == groups[-1]:
-                    g = row[group[0]:group[1]]
-                    ans[i, :] = row[groups[0][0]:groups[0][1]]
-                    # ans[i, :] = -1
-        # print(ans)
-        return ans
+def _fit_fold(i, clf, X, y, train, test):
+    '''
+    Fits a clone of the member i on the train rows and predicts the
+    probabilities of the test rows
+    '''
+    clf = clone(clf)
+    clf.fit(X[train], y[train])
+    return i, test, clf.classes_, clf.predict_proba(X[test])
+
+class StackBag(Bag):
+    '''
+    Stacking: a meta classifier (meta_clf) is fitted on the out-of-fold
+    predicted probabilities of the members.
+    The (member, fold) fits run in parallel processes over a single
+    memory-mapped copy of X/y, then the members are fitted on all the data
+    also in parallel.
+
+    Parameters
+    ----------
+        clfs: list or pandas.Series of classifiers
+        meta_clf: classifier cloned and fitted (meta_clf_) on the
+                        probabilities of the members, default LogisticRegression
+        cv: int, number of (stratified) folds
+        n_jobs: int, number of parallel jobs, -1 for all cpus
+        batch_size: int, number of rows predicted at once, default all
+    '''
+    def __init__(self, clfs=None, meta_clf=None, cv=3, n_jobs=1,
+                                                            batch_size=None):
+        super().__init__(clfs, n_jobs=n_jobs, batch_size=batch_size)
+        self.meta_clf = meta_clf
+        self.cv = cv
+
+    def _meta_features(self, probas):
+        '''
+        (members x rows x classes) -> (rows x members * classes)
+        '''
+        return probas.transpose((1, 0, 2)).reshape((probas.shape[1], -1))
+
+    def fit(self, X, y):
+        self.classes_ = np.unique(y)
+        self.n_features_ = X.shape[1]
+        self.features_ = []
+        meta_clf = self.meta_clf
+        if meta_clf is None:
+            from sklearn.linear_model import LogisticRegression
+            meta_clf = LogisticRegression()
+        self.meta_clf_ = clone(meta_clf)
+        if self.n_jobs != 1:
+            X, y = parallel.shared(X, y)
+
+        folds = list(cross_validation.StratifiedKFold(y, n_folds=self.cv))
+        results = Parallel(n_jobs=self.n_jobs)(delayed(_fit_fold)(
+                        i, clf, X, y, train, test)
+                        for i, clf in enumerate(self.clfs)
+                        for train, test in folds)
+
+        oof = np.zeros((len(self.clfs), len(X), len(self.classes_)))
+        for i, test, classes, probas in results:
+            cols = np.searchsorted(self.classes_, classes)
+            oof[i, test[:, np.newaxis], cols] = probas
+        self.meta_clf_.fit(self._meta_features(oof), y)
+
+        results = Parallel(n_jobs=self.n_jobs)(delayed(_fit_member)(clf, X, y)
+                                                    for clf in self.clfs)
+        self.clfs = [clf for clf, out, probas in results]
+        return self
+
+    def _reduce(self, probas):
+        return self.meta_clf_.predict_proba(self._meta_features(probas))
+
+def _fit_segment(clf, X, y):
+    clf.fit(X, y)
+    return clf
 
 class SplitWrapper(BaseEstimator):
-    def __init__(self, base_clf, ds_labels, variable, models={}):
+    '''
+    Fits a classifier for each option (segment) of a categorical variable,
+    or for each combination of options of several variables (nested split).
+    Each row is routed once to the classifier of its segment, the segments
+    are fitted (processes) and predicted (threads) in parallel.
+    Rows of a segment without training rows are predicted as NaN.
+
+    Parameters
+    ----------
+        base_clf: classifier to clone for each segment
+        ds_labels: copper.Dataset or list of the labels of the input columns
+        variable: str or list of str, categorical variable(s) to split on
+        n_jobs: int, number of parallel jobs, -1 for all cpus
+    '''
+    def __init__(self, base_clf, ds_labels, variable, models={}, n_jobs=1):
         self.base_clf = base_clf
         self.variable = variable
         self.remove_index = []
         self.models = models
+        self.n_jobs = n_jobs
 
         if type(ds_labels) is copper.Dataset:
             ds_labels = copper.transform.ml_input_labels(ds_labels)
         self.ds_labels = ds_labels
-        # print(self.ds_labels)
-        self.var_options = [col.split('#')[1] for col in ds_labels 
-                                            if col.startswith(variable+'#')]
-        self.var_indexes = [i for i, col in enumerate(ds_labels) 
-                                            if col.startswith(variable+'#')]
-        # print(self.var_options)
-        # print(self.var_indexes)
+
+        variables = [variable] if type(variable) is str else list(variable)
+        self.var_options = []
+        self.var_indexes = []
+        for var in variables:
+            self.var_options.append([col.split('#')[1] for col in ds_labels
+                                            if col.startswith(var + '#')])
+            self.var_indexes.append([i for i, col in enumerate(ds_labels)
+                                            if col.startswith(var + '#')])
+        removed = set(i for indexes in self.var_indexes for i in indexes)
+        self.keep_indexes = [i for i in range(len(ds_labels)) if i not in removed]
+
+    def _route(self, X):
+        '''
+        Returns the segment (int) of each row, the options of the variables
+        are combined as digits of a mixed radix number
+        '''
+        segments = np.zeros(len(X), dtype=int)
+        for options, indexes in zip(self.var_options, self.var_indexes):
+            segments = segments * len(options) + np.argmax(X[:, indexes], axis=1)
+        return segments
+
+    def _partition(self, X):
+        '''
+        Returns a list of (segment key, row indexes) of the segments of X
+        '''
+        segments = self._route(X)
+        order = np.argsort(segments, kind='mergesort')
+        counts = np.bincount(segments)
+        ends = np.cumsum(counts)
+        shape = [len(options) for options in self.var_options]
+
+        ans = []
+        for segment in np.nonzero(counts)[0]:
+            position = np.unravel_index(segment, shape)
+            key = tuple(options[p] for options, p in zip(self.var_options, position))
+            ans.append((key, order[ends[segment] - counts[segment]:ends[segment]]))
+        return ans
+
+    def _inputs(self, X, rows):
+        return X[np.ix_(rows, self.keep_indexes)]
 
     def fit(self, X, y):
-        self.models = {}
-        # print(self.variable, X.shape)
-        for option, index in zip(self.var_options, self.var_indexes):
-            var_cols = X[:, self.var_indexes]
-            col_with_1 = np.argmax(var_cols, axis=1)
-            col_with_1 = col_with_1 + self.var_indexes[0]
-            X_f = X[col_with_1 == index, :]
-            X_f = np.delete(X_f, self.var_indexes, 1)
-            y_f = y[col_with_1 == index, :]
-            # print(self.variable, X_f.shape, y_f.shape)
-            clf = clone(self.base_clf)
-            clf.fit(X_f, y_f)
-            # print(option, index)
-            # print(self.variable, X_f.shape, clf) ##
-            self.models[index] = clf
-            # return
+        self.classes_ = np.unique(y)
+        parts = self._partition(X)
+        clfs = Parallel(n_jobs=self.n_jobs)(delayed(_fit_segment)(
+                        clone(self.base_clf), self._inputs(X, rows), y[rows])
+                        for key, rows in parts)
+        self.models = dict((key, clf) for (key, rows), clf in zip(parts, clfs))
+        return self
+
+    def _predict_segment(self, key, X, rows, out, method):
+        if key not in self.models:
+            return
+        clf = self.models[key]
+        ans = getattr(clf, method)(self._inputs(X, rows))
+        if method == 'predict_proba':
+            cols = np.searchsorted(self.classes_, clf.classes_)
+            out[rows[:, np.newaxis], cols] = ans
+        else:
+            out[rows] = ans
+
+    def _predict(self, X, out, method, parts):
+        Parallel(n_jobs=self.n_jobs, backend='threading')(
+                    delayed(self._predict_segment)(key, X, rows, out, method)
+                    for key, rows in parts)
+        return out
 
     def predict(self, X):
-        X_f = np.delete(X, self.var_indexes, 1)
-
-        first_index = self.var_indexes[0]
-        predictions = np.zeros((len(X), len(self.var_options)))
-        predictions[:] = np.nan
-        for option, index in zip(self.var_options, self.var_indexes):
-            clf = self.models[index]
-            predictions[:, index - first_index] = clf.predict(X_f)
-            # break
-        # print(predictions)
-
-        # print(X.shape)
         ans = np.zeros((len(X)))
         ans[:] = np.nan
-        for option, index in zip(self.var_options, self.var_indexes):
-            var_cols = X[:, self.var_indexes]
-            col_with_1 = np.argmax(var_cols, axis=1)
-            col_with_1 = col_with_1 + self.var_indexes[0]
-            # print(ans[col_with_1 == index].shape)
-            ans[col_with_1 == index] = predictions[col_with_1 == index, index - first_index]
-            # break
-        # print(ans)
-        return ans
-        # return np.argmax(self.predict_proba(X), axis=1)
+        return self._predict(X, ans, 'predict', self._partition(X))
 
     def score(self, X, y):
         y_pred = self.predict(X)
         return accuracy_score(y, y_pred)
 
     def predict_proba(self, X):
-        X_f = np.delete(X, self.var_indexes, 1)
-
-        # create a list of the group columns
-        any_key = list(self.models.keys())[0]
-        any_clf = self.models[any_key]
-        num_options = len(any_clf.predict_proba(X_f[:1])[0])
-        groups = []
-        for i, option in enumerate(self.var_options):
-            groups.append((i*num_options, i*num_options+num_options))
-        # print(groups)
-
-        # create a huge matrix with all the predictions
-        num_cols = num_options * len(self.models)
-        predictions = np.zeros((len(X), num_cols))
-        predictions[:] = np.nan
-        for i, index in enumerate(self.var_indexes):
-            clf = self.models[index]
-            # print(clf.predict_proba(X_f).shape)
-            predictions[:, groups[i][0]:groups[i][1]] = clf.predict_proba(X_f)
-            # break
-        # print(predictions)
-
-        num_cols = len(self.models)
-        ans = np.zeros((len(X), num_options))
-        ans[:] = np.nan
-        for i, index in enumerate(self.var_indexes):
-            var_cols = X[:, self.var_indexes]
-            col_with_1 = np.argmax(var_cols, axis=1)
-            col_with_1 = col_with_1 + self.var_indexes[0]
-            # print(ans[col_with_1 == index].shape)
-            ans[col_with_1 == index] = predictions[col_with_1 == index, groups[i][0]:groups[i][1]]
-            # break
-        # print(ans)
-        return ans
+        ans = np.zeros((len(X), len(self.classes_)))
+        parts = self._partition(X)
+        nan_rows = np.ones(len(X), dtype=bool)
+        for key, rows in parts:
+            if key in self.models:
+                nan_rows[rows] = False
+        ans[nan_rows] = np.nan
+        return self._predict(X, ans, 'predict_proba', parts)
 
 class PCAWrapper(BaseEstimator):
-    def __init__(self, base_clf, n_components=None, **args):
+    '''
+    Fits a classifier on the PCA projection of the inputs
+
+    Parameters
+    ----------
+        base_clf: classifier to clone
+        n_components: int, number of components of the PCA
+        mode: str, 'full': PCA,
+                   'randomized': RandomizedPCA, faster for few components,
+                   'incremental': IncrementalPCA fitted in batches of
+                            batch_size rows, X can be a memory-mapped array
+                            that does not fit in memory
+        batch_size: int, rows fitted (incremental) and projected at once
+        cache: str, None (default): no cache, 'id': reuse the projection of
+                    the last X predicted if is the same array object (a
+                    buffer refilled in place, X[:] = chunk, returns the
+                    projection of the old data), 'hash': if the data, shape
+                    and dtype of X are the same (hash of the bytes). The
+                    cache is not pickled
+    '''
+    def __init__(self, base_clf, n_components=None, mode='full',
+                                    batch_size=10000, cache=None, **args):
         self.base_clf = base_clf
         self.n_components = n_components
+        self.mode = mode
+        self.batch_size = batch_size
+        self.cache = cache
         self.pca_model = None
+        self._cache_key = None
+        self._cache_X = None
+        self._cache_value = None
+
+    def _pca(self):
+        if self.mode == 'incremental':
+            return decomposition.IncrementalPCA(n_components=self.n_components,
+                                                    batch_size=self.batch_size)
+        elif self.mode == 'randomized':
+            return decomposition.RandomizedPCA(n_components=self.n_components)
+        return decomposition.PCA(n_components=self.n_components)
+
+    def _key(self, X):
+        if self.cache == 'hash':
+            sha = hashlib.sha1(str((X.shape, X.dtype.str)).encode('utf-8'))
+            sha.update(np.ascontiguousarray(X).view(np.uint8))
+            return sha.hexdigest()
+        return (id(X), X.shape, X.__array_interface__['data'][0])
+
+    def __getstate__(self):
+        # The cached projection (and the X it references) is not saved
+        state = self.__dict__.copy()
+        state['_cache_key'] = state['_cache_X'] = state['_cache_value'] = None
+        return state
+
+    def _project(self, X):
+        '''
+        Projects X in batches of batch_size rows into a float32 array
+        '''
+        n_components = self.pca_model.components_.shape[0]
+        ans = np.empty((len(X), n_components), dtype=np.float32)
+        for start in range(0, len(X), self.batch_size):
+            end = start + self.batch_size
+            ans[start:end] = self.pca_model.transform(X[start:end])
+        return ans
+
+    def transform(self, X):
+        '''
+        Projects X in batches of batch_size rows into a float32 array.
+        The projection of the last X predicted is cached
+        '''
+        if self.cache is not None:
+            key = self._key(X)
+            if key == self._cache_key:
+                return self._cache_value
+
+        ans = self._project(X)
+        if self.cache is not None:
+            # Keep a reference to X so its id is not reused
+            self._cache_key, self._cache_X, self._cache_value = key, X, ans
+        return ans
 
     def fit(self, X, y):
-        self.pca_model = decomposition.PCA(n_components=self.n_components)
-        self.pca_model.fit(X)
+        self._cache_key, self._cache_X, self._cache_value = None, None, None
+        self.pca_model = self._pca()
+        if self.mode == 'incremental':
+            for start in range(0, len(X), self.batch_size):
+                self.pca_model.partial_fit(X[start:start + self.batch_size])
+        else:
+            self.pca_model.fit(X)
         self.estimator = clone(self.base_clf)
-        _X = self.pca_model.transform(X)
-        self.estimator.fit(_X, y)
-    
+        # The training data is not cached: it would be kept (and pickled)
+        # with the fitted wrapper
+        self.estimator.fit(self._project(X), y)
+        return self
+
     def score(self, X, y):
         y_pred = self.predict(X)
         return accuracy_score(y, y_pred)
 
     def predict(self, X):
-        _X = self.pca_model.transform(X)
-        return self.estimator.predict(_X)
+        return self.estimator.predict(self.transform(X))
 
     def predict_proba(self, X):
-        _X = self.pca_model.transform(X)
-        return self.base_clf.predict_proba(_X)
-
-
-
-
-
-
-
-
-
-
-
-
+        return self.estimator.predict_proba(self.transform(X))
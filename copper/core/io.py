@@ -3,16 +3,25 @@ import os
 import io
 import json
 import pickle
+import shutil
 
 import copper
+import numpy as np
 import pandas as pd
 
-def load(filepath):
-    ''' Loads a pickled dataset
+def load(filepath, **args):
+    ''' Loads a pickled dataset, or a ModelComparison (.mc) or Bag (.bag)
+    saved with the numpy arrays as memory-mappable files
+
+    Parameters
+    ----------
+        clf: str, only for .mc: load and return only that classifier
+        mmap_mode: str, only for .mc and .bag: mode of numpy.load for the
+                        arrays, default 'r'. None to load them in memory
 
     Returns
     -------
-        copper.Dataset
+        copper.Dataset, copper.ModelComparison, copper.Bag or classifier
     '''
     if len(filepath.split('.')) == 1:
         filepath = filepath + '.ds'
@@ -21,6 +30,9 @@ def load(filepath):
         f = os.path.join(copper.project.data, filepath)
         pkl_file = open(f, 'rb')
         return pickle.load(pkl_file)
+    elif filepath.endswith('.mc') or filepath.endswith('.bag'):
+        f = os.path.join(copper.project.data, filepath)
+        return load_arrays(f, **args)
 
 def save(data, filename, to='', **args):
     ''' Saves a picke Dataset or a csv file
@@ -54,6 +66,9 @@ def save(data, filename, to='', **args):
         pickle.dump(data, output)
         output.close()
 
+    elif format == 'mc' or format == 'bag':
+        save_arrays(data, os.path.join(fp, filename))
+
 def read_csv(file_path, **args):
     ''' Reads a csv file into a pandas DataFrame
 
@@ -68,4 +83,155 @@ def read_csv(file_path, **args):
     file_path = os.path.join(copper.project.data, file_path)
     return pd.read_csv(file_path, **args)
 
+# ------------------------------------------------------------------------------
+#                 MEMORY-MAPPABLE MODELCOMPARISON / BAGS
+# ------------------------------------------------------------------------------
+
+# Arrays smaller than this (bytes) are pickled with the object
+MIN_ARRAY_NBYTES = 2 ** 16
+
+class _ArrayPickler(pickle.Pickler):
+    ''' Pickler that saves every big numpy array as a .npy file.
+    saved is shared between the files of the same folder so an array
+    referenced by several objects (e.g. X_train and a classifier) is
+    saved only once.
+    '''
+    def __init__(self, file, folder, saved):
+        pickle.Pickler.__init__(self, file, pickle.HIGHEST_PROTOCOL)
+        self.folder = folder
+        self.saved = saved
+
+    def persistent_id(self, obj):
+        # memmaps (arrays of a loaded object) are saved again as .npy files
+        if type(obj) not in (np.ndarray, np.memmap) or obj.dtype.hasobject or \
+                                        obj.nbytes < MIN_ARRAY_NBYTES:
+            return None
+        if id(obj) not in self.saved:
+            filename = '%d.npy' % len(self.saved)
+            np.save(os.path.join(self.folder, filename), obj)
+            # Keep a reference to obj so the id is not reused
+            self.saved[id(obj)] = (filename, obj)
+        return self.saved[id(obj)][0]
+
+class _ArrayUnpickler(pickle.Unpickler):
+    ''' Unpickler that loads the arrays saved by _ArrayPickler using
+    numpy.load(mmap_mode), each array is loaded only once
+    '''
+    def __init__(self, file, folder, loaded, mmap_mode='r'):
+        pickle.Unpickler.__init__(self, file)
+        self.folder = folder
+        self.loaded = loaded
+        self.mmap_mode = mmap_mode
+
+    def persistent_load(self, pid):
+        if pid not in self.loaded:
+            f = os.path.join(self.folder, pid)
+            self.loaded[pid] = np.load(f, mmap_mode=self.mmap_mode)
+        return self.loaded[pid]
+
+def _dump(obj, filepath, folder, saved):
+    with open(filepath, 'wb') as f:
+        _ArrayPickler(f, folder, saved).dump(obj)
+
+def _load(filepath, folder, loaded, mmap_mode):
+    with open(filepath, 'rb') as f:
+        return _ArrayUnpickler(f, folder, loaded, mmap_mode).load()
+
+class _LazyClfs(dict):
+    ''' dict of classifiers that loads each classifier the first time is used
+    '''
+    def __init__(self, folder, names, loaded, mmap_mode):
+        dict.__init__(self, [(name, None) for name in names])
+        self._files = dict((name, os.path.join(folder, 'clfs', '%d.pkl' % i))
+                                            for i, name in enumerate(names))
+        self._folder = os.path.join(folder, 'arrays')
+        self._loaded = loaded
+        self._mmap_mode = mmap_mode
+
+    def __getitem__(self, name):
+        if name in self._files:
+            clf = _load(self._files.pop(name), self._folder, self._loaded,
+                                                            self._mmap_mode)
+            dict.__setitem__(self, name, clf)
+        return dict.__getitem__(self, name)
+
+    def __setitem__(self, name, value):
+        self._files.pop(name, None)
+        dict.__setitem__(self, name, value)
+
+    def __delitem__(self, name):
+        self._files.pop(name, None)
+        dict.__delitem__(self, name)
+
+    def values(self):
+        return [self[name] for name in self.keys()]
+
+    def items(self):
+        return [(name, self[name]) for name in self.keys()]
+
+def save_arrays(data, folder):
+    ''' Saves a ModelComparison or a Bag into folder. The numpy arrays
+    (training/testing data and the arrays inside the classifiers) are saved
+    only once each as .npy files so they can be memory-mapped when loading.
+    Each classifier of a ModelComparison is saved on a different file.
+
+    Parameters
+    ----------
+        data: copper.ModelComparison or copper.Bag
+        folder: str, path of the folder
+    '''
+    tmp = folder + '.tmp'
+    if os.access(tmp, os.F_OK):
+        shutil.rmtree(tmp)
+    arrays = os.path.join(tmp, 'arrays')
+    os.makedirs(arrays)
+    saved = {}
+
+    if type(data) is copper.ModelComparison:
+        os.makedirs(os.path.join(tmp, 'clfs'))
+        names = list(data._clfs.keys())
+        attrs = dict((key, value) for key, value in data.__dict__.items()
+                                                        if key != '_clfs')
+        attrs['_clf_names'] = names
+        _dump(attrs, os.path.join(tmp, 'data.pkl'), arrays, saved)
+        for i, name in enumerate(names):
+            f = os.path.join(tmp, 'clfs', '%d.pkl' % i)
+            _dump(data._clfs[name], f, arrays, saved)
+    else:
+        _dump(data, os.path.join(tmp, 'data.pkl'), arrays, saved)
+
+    # Arrays memory-mapped from the old folder remain valid after removing it
+    if os.access(folder, os.F_OK):
+        shutil.rmtree(folder)
+    os.rename(tmp, folder)
+
+def load_arrays(folder, clf=None, mmap_mode='r'):
+    ''' Loads a ModelComparison or a Bag saved with save_arrays.
+    The classifiers of a ModelComparison are loaded when used.
+
+    Parameters
+    ----------
+        folder: str, path of the folder
+        clf: str, name of a classifier of a ModelComparison to load only it
+        mmap_mode: str, mode of numpy.load for the arrays, default 'r'
+                        (read only), None to load them in memory
+
+    Returns
+    -------
+        copper.ModelComparison, copper.Bag or a classifier
+    '''
+    arrays = os.path.join(folder, 'arrays')
+    loaded = {}
+    data = _load(os.path.join(folder, 'data.pkl'), arrays, loaded, mmap_mode)
+    if type(data) is not dict:
+        return data
+
+    names = data.pop('_clf_names')
+    clfs = _LazyClfs(folder, names, loaded, mmap_mode)
+    if clf is not None:
+        return clfs[clf]
 
+    mc = copper.ModelComparison()
+    mc.__dict__.update(data)
+    mc._clfs = clfs
+    return mc
@@ -19,6 +19,10 @@ class Dataset(dict):
     REJECTED = 'Reject'
     CATEGORY = 'Category'
 
+    # Cached missing values stats and the columns changed since calculated
+    _missing = None
+    _changed = frozenset()
+
     def __init__(self, data=None):
         '''
         Creates a new Dataset
@@ -74,6 +78,7 @@ class Dataset(dict):
             frame: pandas.DataFrame
         '''
         self._frame = frame
+        self._missing = None
         self.columns = self._frame.columns.values
         self.role = pd.Series(index=self.columns, name='Role', dtype=str)
         self.type = pd.Series(index=self.columns, name='Type', dtype=str)
@@ -89,7 +94,8 @@ class Dataset(dict):
             self.role[target_cols[0]] = self.TARGET
             self.role[target_cols[1:]] = self.REJECTED
 
-        rejected = self.percent_missing()[self.percent_missing() > 0.5].index
+        missing = self.missing_stats().percent()
+        rejected = missing[missing > 0.5].index
         self.role[rejected] = self.REJECTED
         self.role = self.role.fillna(value=self.INPUT) # Missing cols are Input
 
@@ -175,6 +181,7 @@ class Dataset(dict):
             if self.type[col] == self.NUMBER and \
                                         self._frame[col].dtype == object:
                 self._frame[col] = self._frame[col].apply(copper.transform.to_number)
+                self._changed = self._changed.union([col])
 
     def save(self, filename):
         copper.save(self, filename)
@@ -228,6 +235,7 @@ class Dataset(dict):
             for symbol in symbols:
                 new_cols[i] = ''.join(new_cols[i].split(symbol))
         self._frame.columns = new_cols
+        self._missing = None
         self.columns = new_cols
         self.role.index = new_cols
         self.type.index = new_cols
@@ -286,6 +294,7 @@ class Dataset(dict):
             for col in cols:
                 imputed = copper.r.imputeKNN(self._frame)
                 self._frame[col] = imputed[col]
+                self._changed = self._changed.union([col])
         elif value is not None:
             for col in cols:
                 if self.role[col] != self.REJECTED:
@@ -300,7 +309,8 @@ class Dataset(dict):
     #                                    STATS
     # --------------------------------------------------------------------------
 
-    def unique_values(self, role=None, type=None, ascending=False):
+    def unique_values(self, role=None, type=None, ascending=False,
+                                            approximate=False, error=0.01):
         '''
         Generetas a Series with the number of unique values of each column
         Note: Excludes NA
@@ -308,13 +318,42 @@ class Dataset(dict):
         Parameters
         ----------
             ascending: boolean, sort the returned Series on this direction
+            approximate: boolean, estimate the counts with HyperLogLog
+            error: float, relative standard error of the approximate counts
 
         Returns
         -------
             pandas.Series
         '''
         data = self.filter(role=role, type=type)
-        return copper.utils.frame.unique_values(data, ascending=ascending)
+        return copper.utils.frame.unique_values(data, ascending=ascending,
+                                        approximate=approximate, error=error)
+
+    def missing_stats(self, cooccurrence=False):
+        '''
+        Missing values statistics of the columns, calculated in a single pass
+        and cached until the frame is set or its columns are set through the
+        Dataset (only the changed columns are recalculated). Changes made
+        directly on the frame are not tracked: set it again.
+
+        Parameters
+        ----------
+            cooccurrence: boolean, also the rows where each pair of columns
+                            is missing together
+
+        Returns
+        -------
+            copper.utils.sketch.MissingStats
+        '''
+        stats = self._missing
+        if stats is None or (cooccurrence and not stats.track_pairs):
+            stats = copper.utils.sketch.MissingStats(cooccurrence=cooccurrence)
+            self._missing = stats.update(self._frame)
+            self._changed = frozenset()
+        elif self._changed:
+            stats.refresh(self._frame, list(self._changed))
+            self._changed = frozenset()
+        return stats
 
     def percent_missing(self, role=None, type=None, ascending=False):
         '''
@@ -476,6 +515,10 @@ class Dataset(dict):
         return self._frame[name]
 
     def __setitem__(self, name, value):
+        if name in self._frame.columns:
+            self._changed = self._changed.union([name])
+        else:
+            self._missing = None
         self._frame[name] = value
 
     def __len__(self):
@@ -12,6 +12,20 @@ class ModelComparison(CopperTest):
         suite = unittest.TestSuite()
         suite.addTest(ModelComparison('test_models_list'))
         suite.addTest(ModelComparison('test_transformations'))
+        suite.addTest(ModelComparison('test_cm_tensor'))
+        suite.addTest(ModelComparison('test_threshold_sweep'))
+        suite.addTest(ModelComparison('test_evaluate_chunks'))
+        suite.addTest(ModelComparison('test_race'))
+        suite.addTest(ModelComparison('test_add_train'))
+        suite.addTest(ModelComparison('test_costs_report'))
+        suite.addTest(ModelComparison('test_save_load'))
+        suite.addTest(ModelComparison('test_bag_fit'))
+        suite.addTest(ModelComparison('test_bag_reduce'))
+        suite.addTest(ModelComparison('test_split_wrapper'))
+        suite.addTest(ModelComparison('test_pca_wrapper'))
+        suite.addTest(ModelComparison('test_stack_bag'))
+        suite.addTest(ModelComparison('test_export'))
+        suite.addTest(ModelComparison('test_bootstrap_ci'))
         return suite
         
     def test_models_list(self):
@@ -119,6 +133,584 @@ class ModelComparison(CopperTest):
         mc.train = train
         self.assertEqual(mc.X_train.shape, (5,4))
 
+    def test_cm_tensor(self):
+        ''' Tests that the stacked confusion matrixes and cost tables match
+        the values of each classifier
+        '''
+        from sklearn import tree
+        from sklearn.naive_bayes import GaussianNB
+        from sklearn.metrics import confusion_matrix
+        np.random.seed(123)
+        X = np.random.randn(200, 4)
+        y = (X[:, 0] + np.random.randn(200) > 0).astype(float)
+
+        mc = copper.ModelComparison()
+        mc.X_train, mc.y_train = X[:100], y[:100]
+        mc.X_test, mc.y_test = X[100:], y[100:]
+        mc.add_clf(tree.DecisionTreeClassifier(max_depth=3), 'DT')
+        mc.add_clf(GaussianNB(), 'GNB')
+        mc.fit()
+
+        cms = mc._cm()
+        for clf_name in ['DT', 'GNB']:
+            y_pred = mc.clfs[clf_name].predict(mc.X_test)
+            self.assertEqual(cms[clf_name], confusion_matrix(mc.y_test, y_pred))
+
+        mc.costs = np.array([[0, 4], [12, 16]])
+        profit = mc.profit()
+        for clf_name in ['DT', 'GNB']:
+            cm = cms[clf_name]
+            self.assertEqual(profit['Profit'][clf_name], cm[1,1] * 16 - cm[0,1] * 4)
+
+        sensitivity = mc.profit_sensitivity([mc.costs, [[0, 1], [1, 1]]])
+        self.assertEqual(sensitivity.shape, (2, 2))
+        self.assertEqual(sensitivity[0]['DT'], profit['Profit']['DT'])
+        self.assertEqual(sensitivity[1]['GNB'], cms['GNB'][1,1] - cms['GNB'][0,1])
+
+    def test_threshold_sweep(self):
+        ''' Tests the confusion counts of the cutoff sweep against the
+        predictions of each cutoff
+        '''
+        from sklearn.naive_bayes import GaussianNB
+        np.random.seed(123)
+        X = np.random.randn(200, 4)
+        y = (X[:, 0] + np.random.randn(200) > 0).astype(float)
+
+        mc = copper.ModelComparison()
+        mc.X_train, mc.y_train = X[:100], y[:100]
+        mc.X_test, mc.y_test = X[100:], y[100:]
+        mc.target_labels = [0, 1]
+        mc.add_clf(GaussianNB(), 'GNB')
+        mc.fit()
+        mc.costs = np.array([[0, 4], [12, 16]])
+
+        sweep = mc.threshold_sweep()['GNB']
+        probas = mc.clfs['GNB'].predict_proba(mc.X_test)[:, 1]
+        self.assertEqual(len(sweep), len(set(probas)) + 1)
+        for i in [1, 10, 50, len(sweep) - 1]:
+            y_pred = probas >= sweep['Cutoff'][i]
+            self.assertEqual(sweep['TP'][i], (y_pred & (mc.y_test == 1)).sum())
+            self.assertEqual(sweep['FP'][i], (y_pred & (mc.y_test == 0)).sum())
+        self.assertEqual(sweep['Recall'].values[-1], 1)
+
+        best = mc.optimal_cutoff()
+        self.assertEqual(best['Profit']['GNB'], sweep['Profit'].max())
+
+        # The probabilities are the column of target in the classes_
+        mc.target_labels = [1, 0]
+        self.assertEqual(mc.threshold_sweep()['GNB']['TP'].tolist(), sweep['TP'].tolist())
+
+    def test_evaluate_chunks(self):
+        ''' Tests that the metrics accumulated by chunks are the same as the
+        metrics on the complete test set
+        '''
+        from sklearn.naive_bayes import GaussianNB
+        np.random.seed(123)
+        frame = pd.DataFrame(np.random.randn(600, 3), columns=['A', 'B', 'C'])
+        frame['Target'] = (frame['A'] + np.random.randn(600) > 0).astype(float)
+        train = copper.Dataset(frame[:200])
+        test = copper.Dataset(frame[200:])
+
+        mc = copper.ModelComparison()
+        mc.train = train
+        mc.test = test
+        mc.add_clf(GaussianNB(), 'GNB')
+        mc.fit()
+
+        metrics = mc.evaluate_chunks(test, chunksize=70).frame()
+        self.assertEqual(metrics['Accuracy']['GNB'], mc.accuracy()['GNB'], 8)
+        self.assertEqual(metrics['Mean Squared Error']['GNB'], mc.mse()['GNB'], 8)
+        self.assertEqual(metrics['Area Under the Curve']['GNB'], mc.auc()['GNB'], 2)
+
+        first = mc.evaluate_chunks([test.frame[:150]], metadata=test)
+        second = mc.evaluate_chunks([test.frame[150:]], metadata=test)
+        merged = first.merge(second).frame()
+        self.assertEqual(merged['Accuracy']['GNB'], metrics['Accuracy']['GNB'], 8)
+
+        # Labels not seen on training are not counted as other labels
+        acc = copper.MetricAccumulator(['A', 'B'], [0, 1])
+        y_pred = np.array([[0, 1, 1], [1, 1, 0]])
+        self.assertRaises(ValueError, acc.update, np.array([0, 2, 1]), y_pred)
+        self.assertRaises(ValueError, acc.update, np.array([0, 0.5, 1]), y_pred)
+        self.assertEqual(acc.n, 0)
+        acc.update(np.array([0, 1, 1]), y_pred)
+        self.assertEqual(acc.cm('A').values, np.array([[1, 0], [0, 2]]))
+        self.assertEqual(acc.cm('B').values, np.array([[0, 1], [1, 1]]))
+
+        # Regressors accumulate only the squared errors
+        from sklearn.linear_model import LinearRegression
+        frame['Target'] = frame['A'] * 2 + np.random.rand(600)
+        mc = copper.ModelComparison()
+        mc.train = copper.Dataset(frame[:200])
+        mc.test = copper.Dataset(frame[200:])
+        mc.add_clf(LinearRegression(), 'LR')
+        mc.fit()
+        acc = mc.evaluate_chunks(copper.Dataset(frame[200:]), chunksize=70)
+        self.assertEqual(acc.mse()['LR'], mc.mse()['LR'], 8)
+        self.assertTrue(np.isnan(acc.accuracy()['LR']))
+        self.assertRaises(ValueError, acc.cm, 'LR')
+
+    def test_race(self):
+        ''' Tests that every round of the race drops at least one classifier
+        '''
+        from sklearn import tree
+        from sklearn.naive_bayes import GaussianNB
+        np.random.seed(123)
+        X = np.random.randn(400, 4)
+        y = (X[:, 0] + np.random.randn(400) > 0).astype(float)
+
+        mc = copper.ModelComparison()
+        mc.X_train, mc.y_train = X[:200], y[:200]
+        mc.X_test, mc.y_test = X[200:], y[200:]
+        mc.add_clf(tree.DecisionTreeClassifier(max_depth=3), 'DT')
+        mc.add_clf(tree.DecisionTreeClassifier(max_depth=1), 'Stump')
+        mc.add_clf(GaussianNB(), 'GNB')
+        mc.X_train, mc.y_train = X[:20], y[:20]
+        mc.fit()
+        mc.bootstrap_ci(n_iter=10)
+        mc.X_train, mc.y_train = X[:200], y[:200]
+
+        winner, history, times = mc.race(keep=0.9, random_state=0)
+        self.assertEqual(list(history['Round'].unique()), [0, 1])
+        self.assertEqual(len(times), 2)
+        self.assertEqual(history['Kept'].sum(), 3)
+        last = history[history['Round'] == 1]
+        self.assertEqual(last['Classifier'][last['Kept']].tolist(), [winner])
+
+        # The winner is fitted on the training set and its predictions are
+        # not the ones cached before the race
+        ci = mc.bootstrap_ci(n_iter=10, random_state=0)
+        self.assertEqual(ci['accuracy'][winner], mc.accuracy()[winner])
+
+        for keep in [0, 1, 1.5]:
+            self.assertRaises(ValueError, mc.race, keep=keep)
+
+    def test_add_train(self):
+        ''' Tests the incremental updates of the classifiers with new rows
+        '''
+        from sklearn import tree
+        from sklearn.naive_bayes import GaussianNB
+        np.random.seed(123)
+        frame = pd.DataFrame(np.random.randn(400, 3), columns=['A', 'B', 'C'])
+        frame['Target'] = (frame['A'] + np.random.randn(400) > 0).astype(float)
+
+        mc = copper.ModelComparison()
+        mc.test = copper.Dataset(frame[300:])
+        mc.add_clf(tree.DecisionTreeClassifier(max_depth=3), 'DT')
+        mc.add_clf(GaussianNB(), 'GNB')
+        mc.refit_every = 2
+        update = mc.add_train(copper.Dataset(frame[:100]))
+        self.assertEqual(update.tolist(), ['fit', 'fit'])
+
+        mc._cached('DT', 'predict')
+        mc._cached('GNB', 'predict')
+        update = mc.add_train(copper.Dataset(frame[100:200]))
+        self.assertEqual(update['GNB'], 'partial_fit')
+        self.assertEqual(update['DT'], 'pending (1)')
+        self.assertEqual(len(mc.X_train), 200)
+        # partial_fit gets only the new rows
+        self.assertEqual(mc.clfs['GNB'].class_count_.sum(), 200)
+        self.assertTrue(('DT', 'predict') in mc._cache)
+        self.assertFalse(('GNB', 'predict') in mc._cache)
+        self.assertEqual(mc.clfs['DT'].tree_.n_node_samples[0], 100)
+
+        update = mc.add_train(copper.Dataset(frame[200:300]))
+        self.assertEqual(update['DT'], 'fit')
+        self.assertFalse(('DT', 'predict') in mc._cache)
+        self.assertEqual(mc.clfs['DT'].tree_.n_node_samples[0], 300)
+        self.assertEqual(mc.clfs['GNB'].class_count_.sum(), 300)
+
+        gnb = GaussianNB().fit(mc.X_train, mc.y_train)
+        self.assertEqual(mc.clfs['GNB'].theta_, gnb.theta_, 8)
+
+    def test_costs_report(self):
+        ''' Tests the recorded time, memory and size of each classifier
+        '''
+        import pickle
+        from sklearn import tree
+        from sklearn.naive_bayes import GaussianNB
+        np.random.seed(123)
+        X = np.random.randn(400, 4)
+        y = (X[:, 0] + np.random.randn(400) > 0).astype(float)
+
+        mc = copper.ModelComparison()
+        mc.X_train, mc.y_train = X[:300], y[:300]
+        mc.X_test, mc.y_test = X[300:], y[300:]
+        mc.add_clf(tree.DecisionTreeClassifier(max_depth=3), 'DT')
+        mc.add_clf(GaussianNB(), 'GNB')
+        self.assertEqual(mc.costs_report()['Model size']['DT'],
+                len(pickle.dumps(mc.clfs['DT'], pickle.HIGHEST_PROTOCOL)))
+        mc.fit()
+        mc.accuracy()
+
+        report = mc.costs_report()
+        self.assertEqual(list(report.index), ['DT', 'GNB'])
+        self.assertEqual(list(report.columns), ['Fit time', 'Fit CPU time',
+                    'Fit peak memory', 'Accuracy time', 'Accuracy CPU time',
+                    'Accuracy peak memory', 'Accuracy time per 10k rows',
+                    'Model size'])
+        self.assertTrue((report['Fit time'] >= 0).all())
+        self.assertTrue(report['Fit peak memory'].isnull().all())
+        for clf_name in ['DT', 'GNB']:
+            self.assertEqual(report['Model size'][clf_name],
+                len(pickle.dumps(mc.clfs[clf_name], pickle.HIGHEST_PROTOCOL)))
+        self.assertEqual(report['Accuracy time per 10k rows']['DT'],
+                                    report['Accuracy time']['DT'] * 100, 8)
+
+        mc.track_memory = True
+        mc.fit(clfs=['DT'])
+        report = mc.costs_report(clfs=['DT'])
+        self.assertTrue(report['Fit peak memory']['DT'] > 0)
+        mc.rm_clf('DT')
+        self.assertEqual(list(mc.costs_report().index), ['GNB'])
+        self.assertTrue(mc.costs_report()['Fit peak memory'].isnull().all())
+
+    def test_save_load(self):
+        ''' Tests that a saved ModelComparison and Bag predict the same after
+        loading them with memory-mapped arrays
+        '''
+        import tempfile
+        from sklearn import tree
+        from sklearn.ensemble import RandomForestClassifier
+        np.random.seed(123)
+        X = np.random.randn(3000, 8)
+        y = (X[:, 0] + np.random.randn(3000) > 0).astype(float)
+        copper.project.path = tempfile.mkdtemp()
+
+        mc = copper.ModelComparison()
+        mc.X_train, mc.y_train = X[:2000], y[:2000]
+        mc.X_test, mc.y_test = X[2000:], y[2000:]
+        mc.add_clf(tree.DecisionTreeClassifier(max_depth=3), 'DT')
+        mc.add_clf(RandomForestClassifier(n_estimators=20, random_state=0), 'RF')
+        mc.fit()
+        probas = mc.predict_proba()
+        ci = mc.bootstrap_ci(n_iter=20, random_state=0)
+        mc.save('models')
+
+        loaded = copper.load('models.mc')
+        self.assertTrue(isinstance(loaded.X_train, np.memmap))
+        self.assertEqual(np.asarray(loaded.X_test), mc.X_test)
+        # The metrics of the cached predictions do not load the classifiers
+        self.assertEqual(loaded.bootstrap_ci(n_iter=20, random_state=0).values, ci.values)
+        self.assertEqual(loaded.costs_report()['Model size'], mc.costs_report()['Model size'])
+        self.assertTrue(dict.get(loaded._clfs, 'RF') is None)
+        self.assertEqual(sorted(loaded.clfs.index), ['DT', 'RF'])
+        self.assertEqual(loaded.predict_proba(), probas)
+        self.assertEqual(loaded.accuracy(), mc.accuracy())
+
+        # The memory-mapped arrays are saved again as .npy files
+        loaded.save('again')
+        sizes = [[os.path.getsize(os.path.join(copper.project.data, name, filename))
+                        for filename in ['data.pkl', os.path.join('arrays', '0.npy')]]
+                        for name in ['models.mc', 'again.mc']]
+        self.assertEqual(sizes[1][1], sizes[0][1])
+        self.assertTrue(sizes[1][0] < sizes[0][0] + 1000)
+
+        rf = copper.load('models.mc', clf='RF')
+        self.assertEqual(rf.predict_proba(mc.X_test), mc.clfs['RF'].predict_proba(mc.X_test))
+
+        bag = copper.AverageBag(mc.clfs)
+        copper.save(bag, 'models.bag')
+        loaded = copper.load('models.bag', mmap_mode=None)
+        self.assertEqual(loaded.predict_proba(mc.X_test), bag.predict_proba(mc.X_test))
+
+    def test_bag_fit(self):
+        ''' Tests the bootstrap, feature samples and out-of-bag score of the
+        members of a Bag
+        '''
+        from sklearn import tree
+        np.random.seed(123)
+        X = np.random.randn(300, 6)
+        y = (X[:, 0] + np.random.randn(300) > 0).astype(float)
+        clfs = [tree.DecisionTreeClassifier(max_depth=3, random_state=i)
+                                                        for i in range(8)]
+
+        bag = copper.AverageBag(clfs, bootstrap=True, max_features=0.5,
+                                oob_score=True, random_state=0).fit(X, y)
+        self.assertEqual(len(bag.features_), 8)
+        for clf, features in zip(bag.clfs, bag.features_):
+            self.assertEqual(len(features), 3)
+            self.assertEqual(clf.tree_.n_features, 3)
+            self.assertEqual(clf.tree_.weighted_n_node_samples[0], 300)
+
+        oob = bag.oob_decision_function_
+        predicted = ~np.isnan(oob[:, 0])
+        self.assertTrue(predicted.sum() > 270)
+        self.assertEqual(oob[predicted].sum(axis=1), np.ones(predicted.sum()), 8)
+        y_oob = bag.classes_[oob[predicted].argmax(axis=1)]
+        self.assertEqual(bag.oob_score_, (y_oob == y[predicted]).mean(), 8)
+        self.assertTrue(bag.oob_score_ < bag.score(X, y))
+
+        parallel = copper.AverageBag(clfs, n_jobs=2, bootstrap=True,
+                    max_features=0.5, oob_score=True, random_state=0).fit(X, y)
+        self.assertEqual(parallel.predict_proba(X), bag.predict_proba(X))
+        self.assertEqual(parallel.oob_score_, bag.oob_score_)
+
+    def test_bag_reduce(self):
+        ''' Tests the probabilities of the bags against row by row versions,
+        the batches and the labels of the predictions
+        '''
+        from sklearn import tree
+        from sklearn.naive_bayes import GaussianNB
+        np.random.seed(123)
+        X = np.random.randn(300, 4)
+        y = np.where(X[:, 0] + np.random.randn(300) > 0, 7, 3)
+        clfs = [tree.DecisionTreeClassifier(max_depth=2, random_state=0),
+                tree.DecisionTreeClassifier(max_depth=4, random_state=0),
+                GaussianNB()]
+        for clf in clfs:
+            clf.fit(X[:200], y[:200])
+        X_test = X[200:]
+        probas = np.array([clf.predict_proba(X_test) for clf in clfs])
+
+        average = copper.AverageBag(clfs)
+        self.assertEqual(average.predict_proba(X_test), probas.mean(axis=0), 8)
+        weighted = copper.AverageBag(clfs, weights=[2, 1, 1])
+        expected = (2 * probas[0] + probas[1] + probas[2]) / 4
+        self.assertEqual(weighted.predict_proba(X_test), expected, 8)
+        self.assertEqual(copper.Bag(clfs).predict_proba(X_test), probas.mean(axis=0), 8)
+
+        max_proba = np.array([probas[np.argmax(probas[:, i].max(axis=1)), i]
+                                                    for i in range(len(X_test))])
+        self.assertEqual(copper.MaxProbaBag(clfs).predict_proba(X_test), max_proba)
+
+        priority = copper.PriorityBag(range=0.2, clfs=clfs)
+        expected = probas[0].copy()
+        for i in range(len(X_test)):
+            for member in probas[:, i]:
+                if member.max() > 0.7:
+                    expected[i] = member
+                    break
+        self.assertEqual(priority.predict_proba(X_test), expected)
+
+        # Batches and threads give the same probabilities
+        batched = copper.PriorityBag(range=0.2, clfs=clfs, batch_size=33, n_jobs=2)
+        self.assertEqual(batched.predict_proba(X_test), expected)
+
+        # The predictions are labels, not positions
+        y_pred = average.predict(X_test)
+        self.assertEqual(sorted(set(y_pred)), [3, 7])
+        self.assertEqual(average.score(X_test, y[200:]), (y_pred == y[200:]).mean())
+        self.assertTrue(average.score(X_test, y[200:]) > 0.6)
+
+        # An empty X gives empty probabilities and predictions
+        self.assertEqual(average.predict_proba(X_test[:0]).shape, (0, 2))
+        self.assertEqual(len(average.predict(X_test[:0])), 0)
+        self.assertEqual(batched.predict_proba(X_test[:0]).shape, (0, 2))
+
+    def test_split_wrapper(self):
+        ''' Tests that each row is predicted by the model of its segment,
+        splitting on one and two variables
+        '''
+        from sklearn import tree
+        np.random.seed(123)
+        n = 600
+        labels = ['Num.1', 'Num.2', 'A#x', 'A#y', 'B#p', 'B#q', 'B#r']
+        a = np.random.randint(0, 2, n)
+        b = np.random.randint(0, 3, n)
+        b[(a == 1) & (b == 2)] = 1 # (y, r) is not on the training rows
+        X = np.zeros((n, 7))
+        X[:, :2] = np.random.randn(n, 2)
+        X[np.arange(n), 2 + a] = 1
+        X[np.arange(n), 4 + b] = 1
+        y = (X[:, 0] * (1 - 2 * a) + X[:, 1] * (b - 1) > 0).astype(float)
+        base = tree.DecisionTreeClassifier(max_depth=3, random_state=0)
+
+        split = copper.SplitWrapper(base, labels, 'A').fit(X, y)
+        self.assertEqual(sorted(split.models.keys()), [('x',), ('y',)])
+        probas = split.predict_proba(X)
+        for option in [0, 1]:
+            rows = a == option
+            clf = tree.DecisionTreeClassifier(max_depth=3, random_state=0)
+            clf.fit(X[rows][:, [0, 1, 4, 5, 6]], y[rows])
+            self.assertEqual(probas[rows], clf.predict_proba(X[rows][:, [0, 1, 4, 5, 6]]))
+
+        nested = copper.SplitWrapper(base, labels, ['A', 'B'], n_jobs=2).fit(X, y)
+        self.assertEqual(len(nested.models), 5)
+        X_test = X.copy()
+        X_test[:10, 4:] = [0, 0, 1] # move the first rows to (x, r) or (y, r)
+        probas = nested.predict_proba(X_test)
+        y_pred = nested.predict(X_test)
+        missing = (a[:10] == 1)
+        self.assertTrue(np.isnan(probas[:10][missing]).all())
+        self.assertTrue(np.isnan(y_pred[:10][missing]).all())
+        self.assertFalse(np.isnan(probas[:10][~missing]).any())
+        rows = np.nonzero((a == 0) & (b == 1))[0]
+        rows = rows[rows >= 10]
+        clf = nested.models[('x', 'q')]
+        self.assertEqual(probas[rows], clf.predict_proba(X[rows][:, :2]))
+        self.assertEqual(y_pred[rows], clf.predict(X[rows][:, :2]))
+        self.assertEqual(nested.score(X, y), (nested.predict(X) == y).mean())
+
+    def test_pca_wrapper(self):
+        ''' Tests the predictions and the projection cache of PCAWrapper
+        '''
+        import pickle
+        from sklearn.decomposition import PCA
+        from sklearn.naive_bayes import GaussianNB
+        np.random.seed(123)
+        X = np.random.randn(2000, 10)
+        y = (X[:, 0] + np.random.randn(2000) > 0).astype(float)
+
+        wrapper = copper.PCAWrapper(GaussianNB(), n_components=3).fit(X, y)
+        self.assertEqual(wrapper._cache_X, None)
+        self.assertTrue(len(pickle.dumps(wrapper)) < X.nbytes / 10)
+
+        pca = PCA(n_components=3).fit(X)
+        gnb = GaussianNB().fit(pca.transform(X), y)
+        self.assertEqual(wrapper.predict_proba(X), gnb.predict_proba(pca.transform(X)), 4)
+        self.assertEqual(wrapper.predict(X), gnb.predict(pca.transform(X)))
+
+        # Without cache every X is projected
+        self.assertFalse(wrapper.transform(X) is wrapper.transform(X))
+        buffer = X[:500].copy()
+        first = wrapper.transform(buffer).copy()
+        buffer[:] = X[500:1000]
+        self.assertFalse(np.allclose(wrapper.transform(buffer), first))
+
+        # The projection of the last X is reused, but not pickled
+        wrapper.cache = 'id'
+        self.assertTrue(wrapper.transform(X) is wrapper.transform(X))
+        self.assertFalse(wrapper.transform(X) is wrapper.transform(X.copy()))
+        loaded = pickle.loads(pickle.dumps(wrapper))
+        self.assertEqual(loaded._cache_X, None)
+        self.assertTrue(wrapper._cache_X is not None)
+        self.assertEqual(loaded.predict_proba(X), wrapper.predict_proba(X))
+
+        hashed = copper.PCAWrapper(GaussianNB(), n_components=3, cache='hash').fit(X, y)
+        self.assertTrue(hashed.transform(X) is hashed.transform(X.copy()))
+        # The same bytes with other shape or dtype are other data
+        self.assertTrue(hashed._key(X) != hashed._key(X.reshape((4000, 5))))
+        self.assertTrue(hashed._key(X) != hashed._key(X.view(np.int64)))
+
+        incremental = copper.PCAWrapper(GaussianNB(), n_components=3,
+                            mode='incremental', batch_size=500).fit(X, y)
+        self.assertEqual(incremental.pca_model.n_samples_seen_, 2000)
+        gnb = GaussianNB().fit(incremental.pca_model.transform(X), y)
+        self.assertEqual(incremental.predict(X), gnb.predict(incremental.pca_model.transform(X)))
+
+    def test_stack_bag(self):
+        ''' Tests that the meta classifier of StackBag is fitted on the
+        out-of-fold probabilities of the members
+        '''
+        from sklearn import tree
+        from sklearn import cross_validation
+        from sklearn.naive_bayes import GaussianNB
+        from sklearn.linear_model import LogisticRegression
+        np.random.seed(123)
+        X = np.random.randn(300, 4)
+        y = (X[:, 0] + X[:, 1] * X[:, 2] + np.random.randn(300) > 0).astype(float)
+        clfs = [tree.DecisionTreeClassifier(max_depth=3, random_state=0), GaussianNB()]
+
+        stack = copper.StackBag(clfs, cv=3).fit(X[:200], y[:200])
+        folds = cross_validation.StratifiedKFold(y[:200], n_folds=3)
+        oof = np.zeros((200, 4))
+        for train, test in folds:
+            for i, clf in enumerate(clfs):
+                member = clf.__class__(**clf.get_params()).fit(X[train], y[train])
+                oof[test, 2 * i:2 * i + 2] = member.predict_proba(X[test])
+        meta = LogisticRegression().fit(oof, y[:200])
+        self.assertEqual(stack.meta_clf_.coef_, meta.coef_, 6)
+        self.assertEqual(stack.meta_clf, None)
+
+        X_test = X[200:]
+        members = np.hstack([clf.__class__(**clf.get_params()).fit(X[:200],
+                        y[:200]).predict_proba(X_test) for clf in clfs])
+        expected = meta.predict_proba(members)
+        self.assertEqual(stack.predict_proba(X_test), expected, 6)
+        self.assertEqual(stack.predict(X_test), stack.classes_[expected.argmax(axis=1)])
+
+        parallel = copper.StackBag(clfs, cv=3, n_jobs=2, batch_size=40).fit(X[:200], y[:200])
+        self.assertEqual(parallel.predict_proba(X_test), stack.predict_proba(X_test), 8)
+
+        # A given meta_clf is cloned, not fitted in place
+        meta_clf = LogisticRegression(C=0.5)
+        given = copper.StackBag(clfs, meta_clf=meta_clf, cv=3).fit(X[:200], y[:200])
+        self.assertFalse(hasattr(meta_clf, 'coef_'))
+        self.assertEqual(given.meta_clf_.C, 0.5)
+        self.assertEqual(given.fit(X[100:], y[100:]).meta_clf_.classes_.tolist(), [0, 1])
+
+    def test_export(self):
+        ''' Tests that the compiled bags predict the same as the bags
+        '''
+        import tempfile
+        from sklearn import tree
+        from sklearn.linear_model import LogisticRegression, SGDClassifier
+        from sklearn.ensemble import RandomForestClassifier, ExtraTreesClassifier
+        np.random.seed(123)
+        X = np.random.randn(400, 5)
+        y = np.digitize(X[:, 0] + X[:, 1] * X[:, 2] + np.random.randn(400), [-1, 1])
+        X_train, y_train, X_test = X[:300], y[:300], X[300:]
+        # the log loss was renamed on newer versions of scikit-learn
+        log = 'log_loss' if 'log_loss' in SGDClassifier.loss_functions else 'log'
+
+        def members():
+            return [LogisticRegression(),
+                    SGDClassifier(loss=log, random_state=0),
+                    tree.DecisionTreeClassifier(max_depth=5, random_state=0),
+                    RandomForestClassifier(n_estimators=10, random_state=0),
+                    ExtraTreesClassifier(n_estimators=10, random_state=0)]
+
+        bags = [copper.AverageBag(members()),
+                copper.AverageBag(members(), weights=[1, 2, 3, 4, 5]),
+                copper.AverageBag(members(), max_features=0.6, random_state=0),
+                copper.MaxProbaBag(members()),
+                copper.PriorityBag(range=0.2, clfs=members()),
+                copper.StackBag(members(), cv=3)]
+        for target in [y_train, (y_train > 0).astype(int)]:
+            for bag in bags:
+                bag.fit(X_train, target)
+                compiled = bag.export()
+                self.assertEqual(compiled.predict_proba(X_test), bag.predict_proba(X_test), 10)
+                self.assertEqual(compiled.predict(X_test), bag.predict(X_test))
+
+        f = os.path.join(tempfile.mkdtemp(), 'bag.npz')
+        compiled.save(f)
+        loaded = copper.utils.inference.load(f)
+        self.assertEqual(loaded.predict_proba(X_test), bag.predict_proba(X_test), 10)
+
+        for loss in ['hinge', 'modified_huber']:
+            bag = copper.AverageBag([SGDClassifier(loss=loss)]).fit(X_train, y_train)
+            self.assertRaises(ValueError, bag.export)
+
+    def test_bootstrap_ci(self):
+        ''' Tests the bootstrap intervals of the metrics of the predictions
+        '''
+        from sklearn import tree
+        from sklearn.naive_bayes import GaussianNB
+        np.random.seed(123)
+        X = np.random.randn(400, 4)
+        y = (X[:, 0] + np.random.randn(400) > 0).astype(float)
+
+        mc = copper.ModelComparison()
+        mc.X_train, mc.y_train = X[:200], y[:200]
+        mc.X_test, mc.y_test = X[200:], y[200:]
+        mc.add_clf(tree.DecisionTreeClassifier(max_depth=3), 'DT')
+        mc.add_clf(GaussianNB(), 'GNB')
+        mc.fit()
+
+        accuracy = mc.accuracy()
+        auc = mc.auc()
+        for metric, values in [('accuracy', accuracy), ('auc', auc)]:
+            ci = mc.bootstrap_ci(metric, n_iter=200, random_state=0)
+            for clf_name in ['DT', 'GNB']:
+                self.assertEqual(ci[metric][clf_name], values[clf_name], 8)
+                self.assertTrue(ci['Lower'][clf_name] <= values[clf_name])
+                self.assertTrue(ci['Upper'][clf_name] >= values[clf_name])
+
+        diff = mc.bootstrap_compare('GNB', 'DT', n_iter=200, random_state=0)
+        self.assertEqual(diff['Difference'], accuracy['GNB'] - accuracy['DT'], 8)
+
+        # The resamples do not depend on the size of the blocks
+        import copper.core.compare as compare
+        block_size = compare.BOOTSTRAP_BLOCK_SIZE
+        try:
+            compare.BOOTSTRAP_BLOCK_SIZE = 3 * len(mc.y_test)
+            small = mc.bootstrap_ci('auc', n_iter=200, random_state=0)
+        finally:
+            compare.BOOTSTRAP_BLOCK_SIZE = block_size
+        self.assertEqual(small, mc.bootstrap_ci('auc', n_iter=200, random_state=0))
+
 if __name__ == '__main__':
     suite = ModelComparison().suite()
     unittest.TextTestRunner(verbosity=2).run(suite)
@@ -11,11 +11,16 @@ class UtilsFrame(CopperTest):
     def suite(self):
         suite = unittest.TestSuite()
         # suite.addTest(UtilsFrame('test_percent_missing'))
+        suite.addTest(UtilsFrame('test_missing_stats'))
         # suite.addTest(UtilsFrame('test_unique_values'))
+        suite.addTest(UtilsFrame('test_unique_values_approximate'))
         # suite.addTest(UtilsFrame('test_outliers'))
+        suite.addTest(UtilsFrame('test_outlier_limits'))
         suite.addTest(UtilsFrame('test_pca'))
         # suite.addTest(UtilsFrame('test_feature_weight'))
         # suite.addTest(UtilsFrame('test_rce_rank'))
+        suite.addTest(UtilsFrame('test_feature_scores'))
+        suite.addTest(UtilsFrame('test_rce_rank_steps'))
         return suite
 
     def test_percent_missing(self):
@@ -51,6 +56,48 @@ class UtilsFrame(CopperTest):
         self.assertEqual(ds.percent_missing()['Col.2'], 0.23, digits=8)
         self.assertEqual(ds.percent_missing()['Col.1'], 1, digits=8)
         
+    def test_missing_stats(self):
+        ''' Tests the missing counts and pairs of merged chunks
+        '''
+        frame = pd.DataFrame({'a': [1, np.nan, 3, np.nan, 5, 6],
+                              'b': [np.nan, np.nan, 3, np.nan, 5, np.nan],
+                              'c': ['x', 'y', None, 'z', 'x', 'y']})
+        stats = copper.utils.sketch.MissingStats().update(frame[:3])
+        stats.merge(copper.utils.sketch.MissingStats().update(frame[3:]))
+
+        self.assertEqual(stats.rows, 6)
+        self.assertEqual(stats.count()['a'], 2)
+        self.assertEqual(stats.count()['b'], 4)
+        self.assertEqual(stats.percent()['c'], 1. / 6, digits=8)
+        pairs = stats.cooccurrence()
+        self.assertEqual(pairs['a']['b'], 2)
+        self.assertEqual(pairs['b']['a'], 2)
+        self.assertEqual(pairs['a']['c'], 0)
+        self.assertEqual(pairs['b']['b'], 4)
+        self.assertEqual(stats.corr()['a']['b'], 0.5, digits=8)
+
+        # Merging with stats without pairs keeps only the counts
+        counts = copper.utils.sketch.MissingStats(cooccurrence=False).update(frame[3:])
+        merged = copper.utils.sketch.MissingStats().update(frame[:3]).merge(counts)
+        self.assertEqual(merged.count().tolist(), [2, 4, 1])
+        self.assertRaises(ValueError, merged.cooccurrence)
+        other = copper.utils.sketch.MissingStats().update(frame[['a', 'b']])
+        self.assertRaises(ValueError, stats.merge, other)
+
+        # Only the changed columns are recalculated
+        counts = copper.utils.sketch.MissingStats(cooccurrence=False).update(frame)
+        changed = frame.copy()
+        changed['b'] = changed['b'].fillna(0)
+        changed['c'] = None
+        counts.refresh(changed, ['b'])
+        self.assertEqual(counts.count().tolist(), [2, 0, 1])
+
+        ds = copper.Dataset(frame)
+        self.assertEqual(ds.missing_stats(cooccurrence=True).count()['a'], 2)
+        ds['a'] = ds['a'].fillna(0)
+        self.assertEqual(ds.missing_stats().count()['a'], 0)
+        self.assertEqual(ds.missing_stats().cooccurrence()['b']['a'], 0)
+
     def test_unique_values(self):
         dic = { 0: np.ones(5),
                 1: np.random.rand(5),
@@ -63,6 +110,60 @@ class UtilsFrame(CopperTest):
         self.assertEqual(unique[2], 2)
         self.assertEqual(unique[3], 3)
 
+    def test_unique_values_approximate(self):
+        ''' Tests the HyperLogLog counts on a frame and on merged chunks
+        '''
+        np.random.seed(123)
+        df = pd.DataFrame({0: np.random.randint(0, 500, 20000),
+                           1: np.random.randint(0, 5, 20000).astype(float)})
+        df[1][:100] = np.nan
+        df[2] = np.array(['a', 'b', 'c'], dtype=object)[df[0] % 3]
+
+        exact = copper.utils.frame.unique_values(df)
+        self.assertEqual(exact[0], 500)
+        self.assertEqual(exact[1], 5)
+        self.assertEqual(exact[2], 3)
+
+        approximate = copper.utils.frame.unique_values(df, approximate=True)
+        self.assertTrue(abs(approximate[0] - 500) < 25)
+        self.assertEqual(approximate[1], 5)
+        self.assertEqual(approximate[2], 3)
+
+        first = copper.utils.sketch.HyperLogLog().update(df[:5000])
+        second = copper.utils.sketch.HyperLogLog().update(df[5000:])
+        merged = first.merge(second).count()
+        for col in df.columns:
+            self.assertEqual(merged[col], approximate[col])
+
+        # Large integers (ids) are not merged by a cast to float
+        ids = pd.DataFrame({0: 2 ** 60 + np.arange(4, dtype=np.int64)})
+        self.assertEqual(copper.utils.frame.unique_values(ids)[0], 4)
+        self.assertEqual(copper.utils.frame.unique_values(ids, approximate=True)[0], 4)
+        floats = copper.utils.sketch.hash_values(pd.Series([1.0, 2.5, np.nan]))
+        ints = copper.utils.sketch.hash_values(pd.Series([1, 2]))
+        self.assertEqual(floats[0], ints[0])
+        self.assertTrue(floats[1] != ints[1])
+
+    def test_outlier_limits(self):
+        ''' Tests the outlier limits of the quantile sketch on chunks
+        '''
+        np.random.seed(123)
+        df = pd.DataFrame({0: np.random.randn(50000), 1: np.random.rand(50000)})
+        exact = copper.utils.frame.outlier_limits(df)
+        self.assertEqual(exact['lower'][1], -0.5, digits=1)
+        self.assertEqual(exact['upper'][1], 1.5, digits=1)
+
+        chunks = [df[i:i + 5000] for i in range(0, 50000, 5000)]
+        approximate = copper.utils.frame.outlier_limits(chunks)
+        for col in df.columns:
+            self.assertEqual(approximate['lower'][col], exact['lower'][col], digits=2)
+            self.assertEqual(approximate['upper'][col], exact['upper'][col], digits=2)
+
+        small = pd.Series([1, 2, 3, 4, 100.0])
+        quantiles = copper.utils.sketch.QuantileSketch().update(small)
+        self.assertEqual(quantiles.quantile(0.25)[small.name], 2)
+        self.assertEqual(copper.utils.frame.outlier_count(small), 1)
+
     def test_outliers(self):
         np.random.seed(123)
         dic = { 0: np.random.randn(20),
@@ -142,6 +243,25 @@ class UtilsFrame(CopperTest):
         self.assertEqual(weights[3],0.545589, 5)
         self.assertEqual(weights[4],1.000000, 5)
 
+    def test_feature_scores(self):
+        ''' Tests the scores on sparse chunks against the dense scores
+        '''
+        from scipy import sparse
+        np.random.seed(123)
+        X = (np.random.rand(1000, 20) > 0.8).astype(float)
+        y = np.random.randint(0, 2, 1000)
+        X[:, 0] = X[:, 0] * y
+
+        dense = copper.utils.scoring.FeatureScores().update(X, y)
+        chunks = [(sparse.csr_matrix(X[i:i + 250]), y[i:i + 250])
+                                            for i in range(0, 1000, 250)]
+        for method in copper.utils.scoring.METHODS:
+            scores = copper.utils.scoring.feature_scores(chunks, method=method)
+            self.assertEqual(scores.index[0], 0)
+            sol = dense.scores(method)
+            for col in range(20):
+                self.assertEqual(scores[col], sol[col], digits=8)
+
     def test_rce_rank(self):
         np.random.seed(123)
         X = pd.DataFrame(np.random.randn(10, 2))
@@ -153,6 +273,46 @@ class UtilsFrame(CopperTest):
         self.assertEqual(weights[0],1)
         self.assertEqual(weights[1],2)
 
+    def test_rce_rank_steps(self):
+        ''' Tests the steps, groups, prefilter and cross validation of rce_rank
+        '''
+        from sklearn.svm import SVC
+        from sklearn import cross_validation
+        from sklearn.feature_selection import RFE
+        np.random.seed(123)
+        X = pd.DataFrame(np.random.randn(100, 10))
+        y = pd.Series((X[0] + X[1] - X[2] + np.random.randn(100) > 0).astype(int))
+
+        for step in [1, 3, 0.5]:
+            ranks = copper.utils.frame.rce_rank(X, y, 5, step=step)
+            self.assertEqual((ranks == 1).sum(), 5)
+            if step >= 1:
+                rfe = RFE(SVC(kernel='linear'), n_features_to_select=5, step=step).fit(X.values, y.values)
+                self.assertEqual(ranks[X.columns].values, rfe.ranking_)
+
+        # The columns of a category are eliminated together
+        X.columns = ['A', 'B', 'C', 'D#x', 'D#y', 'D#z', 'E#1', 'E#2', 'F', 'G']
+        ranks = copper.utils.frame.rce_rank(X, y, 4, step=1)
+        self.assertEqual(len(set(ranks[['D#x', 'D#y', 'D#z']])), 1)
+        self.assertEqual(len(set(ranks[['E#1', 'E#2']])), 1)
+        self.assertEqual(ranks[['A', 'B', 'C']].max(), 1)
+        ungrouped = copper.utils.frame.rce_rank(X, y, 4, step=1, groups=False)
+        self.assertEqual((ungrouped == 1).sum(), 4)
+
+        # Only the prefiltered groups are eliminated recursively
+        ranks = copper.utils.frame.rce_rank(X, y, 2, step=1, prefilter=3)
+        self.assertEqual((ranks == 1).sum(), 2)
+        self.assertEqual((ranks == ranks.max()).sum(), 10 - 3)
+        weights = copper.utils.frame.features_weight(X, y)
+        self.assertEqual(sorted(ranks[ranks < ranks.max()].index),
+                                            sorted(weights.index[:3]))
+
+        cv = cross_validation.ShuffleSplit(100, n_iter=3, random_state=0)
+        ranks, scores = copper.utils.frame.rce_rank(X, y, step=1, cv=cv,
+                                                groups=False, n_jobs=2)
+        self.assertEqual(list(scores.index), list(range(1, 11)))
+        self.assertEqual((ranks == 1).sum(), scores.index[np.argmax(scores.values)])
+
 if __name__ == '__main__':
     suite = UtilsFrame().suite()
     unittest.TextTestRunner(verbosity=2).run(suite)
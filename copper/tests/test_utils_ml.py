@@ -13,6 +13,12 @@ class UtilsML(CopperTest):
     def suite(self):
         suite = unittest.TestSuite()
         suite.addTest(UtilsML('test_bootstrap'))
+        suite.addTest(UtilsML('test_bootstrap_oob'))
+        suite.addTest(UtilsML('test_ensemble_selection'))
+        suite.addTest(UtilsML('test_learning_curve'))
+        suite.addTest(UtilsML('test_grid_cache'))
+        suite.addTest(UtilsML('test_cv_pca'))
+        suite.addTest(UtilsML('test_grid_warm_start'))
         return suite
 
     def test_bootstrap(self):
@@ -37,11 +43,223 @@ class UtilsML(CopperTest):
         for gnb in gnbs:
             self.assertEqual(type(gnb), GaussianNB)
 
-if __name__ == '__main__':
-    suite = UtilsML().suite()
-    unittest.TextTestRunner(verbosity=2).run(suite)
+    def test_bootstrap_oob(self):
+        ''' Tests the out-of-bag scores and probabilities of bootstrap
+        '''
+        np.random.seed(123)
+        frame = pd.DataFrame(np.random.rand(100, 5))
+        frame[0] = (frame[1] > 0.5).astype(int)
+        train = copper.Dataset(frame)
+        train.role[0] = train.TARGET
+
+        from sklearn import tree
+        dt = tree.DecisionTreeClassifier()
+        trees, scores, oob = copper.utils.ml.bootstrap(dt, 10, train, oob=True,
+                                                        random_state=1)
+        self.assertEqual(len(trees), 10)
+        self.assertEqual(len(scores), 10)
+        self.assertEqual(oob.shape, (100, 2))
+        predicted = ~np.isnan(oob[:, 0])
+        self.assertTrue(predicted.sum() > 90)
+        self.assertTrue(np.abs(oob[predicted].sum(axis=1) - 1).max() < 1e-9)
+
+        again = copper.utils.ml.bootstrap(dt, 10, train, oob=True, random_state=1)
+        self.assertEqual(again[1], scores)
+
+        # score only needs clf.score: models without predict_proba
+        from sklearn.svm import LinearSVC
+        svms, scores = copper.utils.ml.bootstrap(LinearSVC(), 3, train,
+                                                    score=True, random_state=1)
+        self.assertEqual(len(scores), 3)
+        rows = np.random.RandomState(1).randint(0, 100, (3, 100))[0]
+        out = np.setdiff1d(np.arange(100), rows)
+        X = train.frame[[1, 2, 3, 4]].values
+        self.assertEqual(scores[0], svms[0].score(X[out], frame[0].values[out]))
+
+    def test_ensemble_selection(self):
+        ''' Tests the selection of a weighted bag from fitted classifiers
+        '''
+        np.random.seed(123)
+        X = np.random.randn(300, 5)
+        y = (X[:, 0] + X[:, 1] > 0).astype(int)
+
+        from sklearn import tree
+        clfs = []
+        for i in range(10):
+            clf = tree.DecisionTreeClassifier(max_depth=3, max_features=2)
+            clfs.append(clf.fit(X[:200], y[:200]))
+        probas = np.array([clf.predict_proba(X[200:]) for clf in clfs])
+
+        bag, scores = copper.utils.ml.ensemble_selection(clfs, probas, y[200:],
+                                                                n_iter=10)
+        self.assertEqual(type(bag), copper.AverageBag)
+        self.assertEqual(len(scores), 11)
+        self.assertTrue(len(bag.clfs) <= 10)
+        self.assertEqual(len(bag.weights), len(bag.clfs))
+        self.assertEqual(bag.score(X[200:], y[200:]), scores.max(), 8)
+
+        # The initial ensemble is returned when no classifier improves it
+        best = np.argmax([clf.score(X[200:], y[200:]) for clf in clfs])
+        bag, scores = copper.utils.ml.ensemble_selection([clfs[best]] * 2,
+                                    probas[[best, best]], y[200:], n_iter=3)
+        self.assertEqual(scores.index.tolist(), [0, 1, 2, 3])
+        self.assertEqual(bag.weights, [1])
+
+        # The AUC of each candidate is the same as scikit-learn's
+        from sklearn.metrics import roc_auc_score
+        single = copper.utils.ml._ensemble_scores(probas, y[200:], 'auc')
+        for i in [0, 5]:
+            self.assertEqual(single[i], roc_auc_score(y[200:], probas[i][:, 1]), 8)
+
+    def test_learning_curve(self):
+        ''' Tests the shape of the learning curves and that growing a model
+        with partial_fit gives the same result as fitting it from scratch
+        '''
+        np.random.seed(123)
+        frame = pd.DataFrame(np.random.rand(200, 5))
+        frame[0] = (frame[1] > 0.5).astype(int)
+        train = copper.Dataset(frame)
+        train.role[0] = train.TARGET
 
+        from sklearn.naive_bayes import GaussianNB
+        clfs = {'GNB': GaussianNB()}
+        sizes, train_scores, test_scores = copper.utils.ml.learning_curve(
+                        train, clfs, sizes=[0.2, 0.5, 1], random_state=1)
+        self.assertEqual(len(sizes), 3)
+        self.assertEqual(test_scores['GNB'].shape, (3, 3))
+        self.assertEqual(train_scores['GNB'].shape, (3, 3))
+
+        cold = copper.utils.ml.learning_curve(train, clfs, sizes=[0.2, 0.5, 1],
+                                        random_state=1, incremental=False)
+        self.assertTrue(np.allclose(test_scores['GNB'], cold[2]['GNB']))
+
+    def test_grid_cache(self):
+        ''' Tests that grid saves each result on the project cache and that
+        a search resumes from the cached results
+        '''
+        import tempfile
+        from sklearn import tree
+        from sklearn import cross_validation
+        np.random.seed(123)
+        frame = pd.DataFrame(np.random.rand(200, 5))
+        frame[0] = (frame[1] + frame[2] > 1).astype(int)
+        train = copper.Dataset(frame)
+        train.role[0] = train.TARGET
+        copper.project.path = tempfile.mkdtemp()
+        folder = os.path.join(copper.project.cache, 'grid')
 
+        dt = tree.DecisionTreeClassifier(random_state=0)
+        cv = cross_validation.ShuffleSplit(200, n_iter=3, random_state=0)
+        values = [1, 2, 4]
+        train_scores, test_scores = copper.utils.ml.grid(train, dt,
+                                            'max_depth', values, cv=cv)
+        self.assertEqual(test_scores.shape, (3, 3))
+        self.assertEqual(len(os.listdir(folder)), 9)
+        X = train.frame[[1, 2, 3, 4]].values
+        train_rows, test_rows = list(cv)[1]
+        clf = tree.DecisionTreeClassifier(random_state=0, max_depth=2)
+        clf.fit(X[train_rows], frame[0].values[train_rows])
+        self.assertEqual(test_scores[1, 1], clf.score(X[test_rows], frame[0].values[test_rows]))
 
+        # The results are read from the cache: a tampered result is returned
+        # and a missing result is calculated again
+        files = sorted(os.listdir(folder))
+        with open(os.path.join(folder, files[0]), 'w') as f:
+            f.write('[0.5, 0.25]')
+        os.remove(os.path.join(folder, files[1]))
+        again = copper.utils.ml.grid(train, dt, 'max_depth', values, cv=cv)
+        self.assertEqual(len(os.listdir(folder)), 9)
+        self.assertEqual((again[1] == 0.25).sum(), 1)
+        self.assertEqual(again[1][again[1] != 0.25], test_scores[again[1] != 0.25])
+
+        # A dict of params searches all the combinations, without the cache
+        params = {'max_depth': [1, 2], 'min_samples_leaf': [1, 5]}
+        train_scores, test_scores = copper.utils.ml.grid(train, dt, params,
+                                                    cv=cv, cache=False)
+        self.assertEqual(test_scores.shape, (4, 3))
+        self.assertEqual(len(os.listdir(folder)), 9)
+
+    def test_cv_pca(self):
+        ''' Tests the scores of cv_pca against fitting a PCA for each number
+        of components on each fold
+        '''
+        from sklearn import cross_validation
+        from sklearn.decomposition import PCA
+        from sklearn.naive_bayes import GaussianNB
+        np.random.seed(123)
+        frame = pd.DataFrame(np.random.rand(200, 6))
+        frame[0] = (frame[1] + frame[2] > 1).astype(int)
+        train = copper.Dataset(frame)
+        train.role[0] = train.TARGET
+        X = train.frame[[1, 2, 3, 4, 5]].values
+        y = frame[0].values
 
+        cv = cross_validation.ShuffleSplit(200, n_iter=3, random_state=0)
+        scores = copper.utils.ml.cv_pca(train, GaussianNB(), cv=cv)
+        self.assertEqual(sorted(scores.index), [1, 2, 3, 4])
+        parallel = copper.utils.ml.cv_pca(train, GaussianNB(), range_=[1, 3],
+                                                        cv=cv, n_jobs=2)
+        for n_components in [1, 3]:
+            expected = []
+            for train_rows, test_rows in cv:
+                pca = PCA(n_components=n_components).fit(X[train_rows])
+                clf = GaussianNB().fit(pca.transform(X[train_rows]), y[train_rows])
+                expected.append(clf.score(pca.transform(X[test_rows]), y[test_rows]))
+            self.assertEqual(scores[n_components], np.mean(expected), 8)
+            self.assertEqual(parallel[n_components], np.mean(expected), 8)
 
+    def test_grid_warm_start(self):
+        ''' Tests the sweeps evaluated as a warm started path and that their
+        cached results are not mixed with the results fitted from scratch
+        '''
+        import tempfile
+        from sklearn import cross_validation
+        from sklearn.linear_model import SGDClassifier
+        from sklearn.ensemble import RandomForestClassifier
+        np.random.seed(123)
+        frame = pd.DataFrame(np.random.rand(200, 5))
+        frame[0] = (frame[1] + frame[2] + np.random.rand(200) > 1.5).astype(int)
+        train = copper.Dataset(frame)
+        train.role[0] = train.TARGET
+        cv = cross_validation.ShuffleSplit(200, n_iter=2, random_state=0)
+
+        # Growing a forest gives the same trees as fitting it from scratch
+        rf = RandomForestClassifier(random_state=0)
+        values = [5, 10, 20]
+        warm = copper.utils.ml.grid(train, rf, 'n_estimators', values, cv=cv,
+                                                                cache=False)
+        cold = copper.utils.ml.grid(train, rf, 'n_estimators', values, cv=cv,
+                                            cache=False, warm_start=False)
+        self.assertEqual(warm[1], cold[1])
+
+        copper.project.path = tempfile.mkdtemp()
+        folder = os.path.join(copper.project.cache, 'grid')
+        sgd = SGDClassifier(random_state=0)
+        values = [0.1, 0.01, 0.001]
+        cold = copper.utils.ml.grid(train, sgd, 'alpha', values, cv=cv,
+                                                        warm_start=False)
+        warm = copper.utils.ml.grid(train, sgd, 'alpha', values, cv=cv)
+        self.assertEqual(len(os.listdir(folder)), 12)
+        expected = copper.utils.ml.grid(train, sgd, 'alpha', values, cv=cv,
+                                                                cache=False)
+        self.assertEqual(warm[1], expected[1])
+        again = copper.utils.ml.grid(train, sgd, 'alpha', values, cv=cv,
+                                                        warm_start=False)
+        self.assertEqual(again[1], cold[1])
+
+        # The results of a shorter path are not reused on a longer path and
+        # a path with a missing result is fitted again from its start
+        copper.project.path = tempfile.mkdtemp()
+        folder = os.path.join(copper.project.cache, 'grid')
+        copper.utils.ml.grid(train, sgd, 'alpha', values[1:], cv=cv)
+        warm = copper.utils.ml.grid(train, sgd, 'alpha', values, cv=cv)
+        self.assertEqual(len(os.listdir(folder)), 10)
+        self.assertEqual(warm[1], expected[1])
+        for filename in sorted(os.listdir(folder))[:5]:
+            os.remove(os.path.join(folder, filename))
+        again = copper.utils.ml.grid(train, sgd, 'alpha', values, cv=cv)
+        self.assertEqual(again[1], expected[1])
+
+if __name__ == '__main__':
+    suite = UtilsML().suite()
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -3,8 +3,12 @@ import copper
 import numpy as np
 import pandas as pd
 
+from copper.utils import sketch
+from copper.utils import parallel
+from copper.utils import scoring
 from sklearn import decomposition
-from sklearn.feature_selection import RFE, SelectPercentile, f_classif
+from sklearn.base import clone
+from sklearn.externals.joblib import Parallel, delayed
 '''
 Utils for a pandas Dataframe
 '''
@@ -15,31 +19,74 @@ def percent_missing(frame, ascending=False):
 
     Parameters
     ----------
+        frame: pandas.DataFrame or an iterable of DataFrames (chunks, e.g.
+                    pd.read_csv(..., chunksize=)), see also
+                    copper.utils.sketch.MissingStats
         ascending: boolean, sort the returned Series on this direction
 
     Returns
     -------
         pandas.Series
     '''
-    return (1 - (frame.count() / len(frame))).order(ascending=ascending)
+    if isinstance(frame, pd.DataFrame):
+        frame = [frame]
+    stats = sketch.MissingStats(cooccurrence=False)
+    for chunk in frame:
+        stats.update(chunk)
+    return stats.percent().order(ascending=ascending)
 
-def unique_values(frame, ascending=False):
+def _nunique(frame):
+    '''
+    Number of unique values (excluding NA) of each column. The numeric
+    columns of the same dtype are counted at once sorting their values.
+    '''
+    ans = pd.Series(np.zeros(len(frame.columns)), index=frame.columns)
+    numeric = [col for col in frame.columns if frame[col].dtype.kind in 'biuf']
+    dtypes = {}
+    for col in numeric:
+        dtypes.setdefault(frame[col].dtype, []).append(col)
+    for cols in dtypes.values():
+        if not len(frame):
+            break
+        # not cast to float64: int64 above 2 ** 53 would be merged
+        values = np.sort(frame[cols].values, axis=0)
+        distinct = np.ones(values.shape, dtype=bool)
+        distinct[1:] = values[1:] != values[:-1]
+        if values.dtype.kind == 'f':
+            # nan sort last and are never equal: do not count them
+            distinct &= ~np.isnan(values)
+        ans[cols] = distinct.sum(axis=0)
+    for col in frame.columns:
+        if col not in numeric:
+            ans[col] = frame[col].nunique()
+    return ans
+
+def unique_values(frame, ascending=False, approximate=False, error=0.01):
     '''
     Generetas a Series with the number of unique values of each column.
     Note: Excludes NA
 
     Parameters
     ----------
+        frame: pandas.DataFrame or an iterable of DataFrames (chunks, e.g.
+                    pd.read_csv(..., chunksize=)), chunks are always approximate
         ascending: boolean, sort the returned Series on this direction
+        approximate: boolean, estimate the counts with a HyperLogLog sketch
+                    (see copper.utils.sketch) instead of exact counts
+        error: float, relative standard error of the approximate counts
 
     Returns
     -------
         pandas.Series
     '''
-    ans = pd.Series(index=frame.columns)
-    for col in frame.columns:
-        ans[col] = len(frame[col].value_counts())
-    return ans.order(ascending=ascending)
+    if isinstance(frame, pd.DataFrame) and not approximate:
+        return _nunique(frame).order(ascending=ascending)
+    if isinstance(frame, pd.DataFrame):
+        frame = [frame]
+    hll = sketch.HyperLogLog(error=error)
+    for chunk in frame:
+        hll.update(chunk)
+    return hll.count().order(ascending=ascending)
 
 def PCA(data, ret_model=False, **args):
     ''' Calculates the PCA Decomposition of the frame
@@ -52,56 +99,261 @@ def PCA(data, ret_model=False, **args):
 
 def features_weight(X, y, ascending=False):
     '''
+    -log10 of the p-values of the ANOVA F of each feature, normalized by the
+    maximum. See copper.utils.scoring for other scores and chunked inputs
+
     Paremeters
     ----------
-        X: pd.DataFrame
+        X: pd.DataFrame or scipy.sparse matrix
         y: pd.Series
     '''
-    selector = SelectPercentile(f_classif)
-    selector.fit(X.values, y.values)
-    scores = -np.log10(selector.pvalues_)
+    f, pvalues = scoring.FeatureScores().update(X, y).f()
+    scores = -np.log10(pvalues)
     scores /= scores.max()
-    ans = pd.Series(scores, index=X.columns)
-    return ans.order(ascending=ascending)
+    return scores.order(ascending=ascending)
 
-def rce_rank(X, y, n_features_to_select=None, estimator=None):
+def _importances(estimator):
+    '''
+    Importance of each input of a fitted estimator: squared coefficients
+    (summed over the classes) or feature_importances_
     '''
+    if hasattr(estimator, 'coef_'):
+        coef = estimator.coef_
+        coef = np.asarray(coef.todense() if hasattr(coef, 'todense') else coef)
+        return (coef ** 2).reshape((-1, coef.shape[-1])).sum(axis=0)
+    return np.asarray(estimator.feature_importances_)
+
+def _rfe_path(estimator, X, y, units, n_features, step, train=None, test=None):
+    '''
+    Recursive elimination of units (arrays of columns of X) until there are
+    n_features columns or less. Each step removes the weakest units, about
+    a fraction step of the columns left to remove or int step units (never
+    more columns than left to remove, unless the weakest unit is bigger).
+    If test rows are given every subset is scored on them.
+
+    Returns
+    -------
+        (ranking of the units, list of (number of columns, test score))
+    '''
+    if train is not None:
+        X_train, y_train = X[train], y[train]
+    else:
+        X_train, y_train = X, y
+    owner = np.zeros(X.shape[1], dtype=int)
+    for i, unit in enumerate(units):
+        owner[unit] = i
+    sizes = np.array([len(unit) for unit in units])
+    alive = np.ones(len(units), dtype=bool)
+    ranking = np.ones(len(units), dtype=int)
+    scores = []
+    while True:
+        cols = np.concatenate([units[i] for i in np.nonzero(alive)[0]])
+        if len(cols) <= n_features and test is None:
+            break
+        clf = clone(estimator)
+        clf.fit(X_train[:, cols], y_train)
+        if test is not None:
+            scores.append((len(cols), clf.score(X[test][:, cols], y[test])))
+        if len(cols) <= n_features:
+            break
+
+        importance = np.bincount(owner[cols], weights=_importances(clf),
+                                                    minlength=len(units))
+        # groups are not favored by their number of columns (as group lasso)
+        importance = importance / np.sqrt(sizes)
+        candidates = np.nonzero(alive)[0]
+        candidates = candidates[np.argsort(importance[candidates], kind='mergesort')]
+        removed = np.cumsum(sizes[candidates])
+        left = len(cols) - n_features
+        if step >= 1:
+            # int(step) units, without going below n_features columns
+            n_remove = min(int(step), np.searchsorted(removed, left, side='right'))
+        else:
+            budget = max(int(step * left), 1)
+            n_remove = np.searchsorted(removed, budget, side='right')
+        # a unit bigger than the columns left to remove is removed whole
+        n_remove = max(n_remove, 1)
+        alive[candidates[:n_remove]] = False
+        ranking[~alive] += 1
+    return ranking, scores
+
+def rce_rank(X, y, n_features_to_select=None, estimator=None, step=0.1,
+                groups=True, prefilter=None, cv=None, n_jobs=1):
+    '''
+    Ranks the features by recursive feature elimination: 1 for the selected
+    features, higher for the features eliminated earlier.
+
+    Each step fits the estimator and eliminates the weakest features: a
+    fraction step of the features left to eliminate, so the steps get finer
+    near n_features_to_select. With groups the one-hot columns of the same
+    category (named 'column#category' by copper.transform.inputs2ml) are
+    eliminated together.
+
     Paremeters
     ----------
         X: pd.DataFrame
         y: pd.Series
+        n_features_to_select: int, default half of the features
+        estimator: scikit-learn estimator with coef_ or feature_importances_,
+                    default SVC(kernel='linear')
+        step: float (< 1) fraction of the features left to eliminate on each
+                    step or int number of features (groups) per step, as
+                    sklearn's RFE the last step is smaller so it stops at
+                    n_features_to_select features (a group is not split:
+                    with groups the last step can go below it)
+        groups: boolean, eliminate the one-hot columns of a category together
+        prefilter: float (< 1) fraction or int number of features (groups)
+                    kept by features_weight before the elimination, the rest
+                    get the highest rank
+        cv: scikit-learn cross validation, if given n_features_to_select is
+                    the number with the best mean score of the folds (each
+                    fold eliminates in parallel down to one feature)
+        n_jobs: int, number of folds in parallel, -1 for all cpus
+
+    Returns
+    -------
+        pd.Series with the ranking, if cv: (ranking, pd.Series with the mean
+        score of each number of features)
     '''
     if estimator is None:
         from sklearn.svm import SVC
         estimator = SVC(kernel="linear")
-    selector = RFE(estimator, n_features_to_select, step=1)
-    selector = selector.fit(X.values, y.values)
-    ans = pd.Series(selector.ranking_, index=X.columns)
-    return ans.order(ascending=False)
-    
+    columns = list(X.columns)
+    if groups:
+        names = [str(col).split('#')[0] for col in columns]
+    else:
+        names = list(range(len(columns)))
+    unique_names = []
+    for name in names:
+        if name not in unique_names:
+            unique_names.append(name)
+    units = [np.array([i for i, name in enumerate(names) if name == unit])
+                                                    for unit in unique_names]
+    if n_features_to_select is None:
+        n_features_to_select = len(columns) // 2
+
+    keep = np.ones(len(units), dtype=bool)
+    if prefilter is not None:
+        weights = features_weight(X, y).reindex(X.columns).values
+        unit_weights = np.array([weights[unit].max() for unit in units])
+        n_keep = int(prefilter * len(units)) if prefilter < 1 else int(prefilter)
+        keep[:] = False
+        keep[np.argsort(-unit_weights, kind='mergesort')[:max(n_keep, 1)]] = True
+    kept = [unit for unit, k in zip(units, keep) if k]
+
+    values = X.values.astype(np.float64)
+    target = np.asarray(y)
+    scores = None
+    if cv is not None:
+        if n_jobs != 1:
+            values, target = parallel.shared(values, target)
+        paths = Parallel(n_jobs=n_jobs)(delayed(_rfe_path)(estimator, values,
+                            target, kept, 1, step, train, test)
+                            for train, test in cv)
+        sizes = np.unique(np.concatenate([[n for n, score in path]
+                                                for ranking, path in paths]))
+        table = []
+        for ranking, path in paths:
+            path = sorted(path)
+            table.append(np.interp(sizes, [n for n, score in path],
+                                            [score for n, score in path]))
+        scores = pd.Series(np.mean(table, axis=0), index=sizes)
+        n_features_to_select = sizes[np.argmax(scores.values)]
+
+    ranking, path = _rfe_path(estimator, values, target, kept,
+                                                n_features_to_select, step)
+    ranks = np.zeros(len(columns), dtype=int)
+    for unit, rank in zip(kept, ranking):
+        ranks[unit] = rank
+    ranks[ranks == 0] = ranking.max() + 1
+    ans = pd.Series(ranks, index=X.columns).order(ascending=False)
+    return (ans, scores) if cv is not None else ans
+
 
 #-----------------------  OUTLIERS  --------------------------------------------
 
-def outlier_rows(data, width=1.5):
+def _quartiles(values):
+    '''
+    First and third quartiles of each column of a 2d float array, excluding
+    nan, with linear interpolation (like Series.describe). All the columns
+    are sorted at once.
+    '''
+    values = np.sort(values, axis=0)
+    counts = (~np.isnan(values)).sum(axis=0)
+    cols = np.arange(values.shape[1])
+    ans = []
+    for q in (0.25, 0.75):
+        position = np.maximum(q * (counts - 1), 0)
+        lower = np.floor(position).astype(int)
+        upper = np.ceil(position).astype(int)
+        fraction = position - lower
+        ans.append(values[lower, cols] * (1 - fraction) + values[upper, cols] * fraction)
+    ans[0][counts == 0] = np.nan
+    ans[1][counts == 0] = np.nan
+    return ans
+
+def _numeric(frame):
+    return frame[[col for col in frame.columns if frame[col].dtype.kind in 'biuf']]
+
+def outlier_limits(data, width=1.5, approximate=False, delta=200):
+    '''
+    Returns the limits of the outliers of each numeric column:
+    Q1 - width * IQR and Q3 + width * IQR
+
+    Parameters
+    ----------
+        data: pd.Series, pd.DataFrame or an iterable of DataFrames (chunks,
+                    e.g. pd.read_csv(..., chunksize=)), chunks are always
+                    approximate
+        approximate: boolean, use a mergeable quantile sketch
+                    (copper.utils.sketch.QuantileSketch) instead of sorting
+        delta: int, compression of the sketch, more is more accurate
+
+    Returns
+    -------
+        pd.DataFrame with columns 'lower' and 'upper' for each column
+    '''
+    if type(data) is pd.Series:
+        data = pd.DataFrame({data.name: data})
+    if type(data) is pd.DataFrame and not approximate:
+        data = _numeric(data)
+        q1, q3 = _quartiles(data.values.astype(np.float64))
+        columns = data.columns
+    else:
+        if type(data) is pd.DataFrame:
+            data = [data]
+        quantiles = sketch.QuantileSketch(delta=delta)
+        for chunk in data:
+            quantiles.update(chunk)
+        quantiles = quantiles.quantile([0.25, 0.75])
+        q1, q3 = quantiles.values
+        columns = quantiles.columns
+    iqr = q3 - q1
+    return pd.DataFrame({'lower': q1 - width * iqr, 'upper': q3 + width * iqr},
+                                    index=columns, columns=['lower', 'upper'])
+
+def outlier_rows(data, width=1.5, limits=None):
     ''' Returna a series/frame with the outliers filter array [Trues and Falses]
 
     Parameters
     ----------
         data: pd.Series or pd.Frame
+        limits: pd.DataFrame, see outlier_limits, e.g. calculated on all the
+                    chunks of a dataset, default the limits of data
     '''
     if type(data) is pd.Series:
-        q1 = data.describe()[4]
-        q3 = data.describe()[6]
-        iqr = q3 - q1
-        lower_limit = q1 - width * iqr
-        upper_limit = q3 + width * iqr
-        return (data < lower_limit) | (data > upper_limit)
+        if limits is None:
+            limits = outlier_limits(data, width=width)
+        lower, upper = limits.values[0]
+        return (data < lower) | (data > upper)
     elif type(data) is pd.DataFrame:
-        ans = pd.DataFrame(index=data.index)
-        for col in data.columns:
-            new = outlier_rows(data[col], width=width)
-            ans = ans.join(new)
-        return ans
+        data = _numeric(data)
+        if limits is None:
+            limits = outlier_limits(data, width=width)
+        limits = limits.reindex(data.columns)
+        values = data.values.astype(np.float64)
+        ans = (values < limits['lower'].values) | (values > limits['upper'].values)
+        return pd.DataFrame(ans, index=data.index, columns=data.columns)
 
 def outliers(series, width=1.5):
     '''
@@ -117,9 +369,6 @@ def outlier_count(data, width=1.5, ascending=False):
         data: pd.Series or pd.DataFrame
     '''
     if type(data) is pd.Series:
-        return len(outliers(data, width=width))
+        return int(outlier_rows(data, width=width).sum())
     elif type(data) is pd.DataFrame:
-        ans = pd.Series(index=data.columns)
-        for col in data.columns:
-            ans[col] = outlier_count(data[col], width=width)
-        return ans.order(ascending=ascending)
\ No newline at end of file
+        return outlier_rows(data, width=width).sum().order(ascending=ascending)
@@ -0,0 +1,265 @@
+from __future__ import division
+import json
+import numpy as np
+'''
+Compact NumPy only inference for fitted Bags (AverageBag, MaxProbaBag,
+PriorityBag and StackBag).
+
+All the linear members are stacked in one coefficient matrix and evaluated
+with a single matrix product. All the trees (decision trees and the trees of
+random forests/extra trees) are flattened into node arrays and traversed at
+the same time for all the rows.
+
+This module only imports numpy: copy it to the scoring process and use
+load(filepath) without copper or scikit-learn.
+'''
+
+LINEAR = ('LogisticRegression', 'SGDClassifier')
+TREE = ('DecisionTreeClassifier', 'ExtraTreeClassifier')
+FOREST = ('RandomForestClassifier', 'ExtraTreesClassifier')
+
+def _check_linear(clf):
+    ''' Only linear models with probabilities from the logistic function
+    (not the hinge or modified huber losses of SGDClassifier) are exported
+    '''
+    name = type(clf).__name__
+    if name == 'SGDClassifier' and clf.loss not in ('log', 'log_loss'):
+        raise ValueError('Can not export a SGDClassifier with loss=%s, only '
+                                                'the log loss' % clf.loss)
+
+def _link(clf):
+    ''' Function from the decision function to the probabilities, like
+    scikit-learn: sigmoid for binary and one-vs-rest (normalized) and
+    softmax for multinomial
+    '''
+    if len(clf.classes_) == 2:
+        return 'binary'
+    if type(clf).__name__ == 'SGDClassifier' or not hasattr(clf, 'solver'):
+        # SGDClassifier and liblinear only versions of LogisticRegression
+        return 'ovr'
+    if getattr(clf, 'multi_class', None) == 'ovr' or clf.solver == 'liblinear':
+        return 'ovr'
+    return 'softmax'
+
+def _sigmoid(z):
+    ans = -z
+    np.exp(ans, ans)
+    ans += 1
+    np.reciprocal(ans, ans)
+    return ans
+
+def _apply_link(z, link):
+    if link == 'binary':
+        p = _sigmoid(z[:, 0])
+        return np.vstack([1 - p, p]).T
+    elif link == 'ovr':
+        p = _sigmoid(z)
+        return p / p.sum(axis=1).reshape((p.shape[0], -1))
+    z = z - z.max(axis=1)[:, np.newaxis]
+    p = np.exp(z)
+    return p / p.sum(axis=1)[:, np.newaxis]
+
+def _tree_arrays(tree, classes, cols, features):
+    ''' Node arrays of a fitted tree, values normalized and on the columns
+    of the bag classes, features mapped to the columns of the bag inputs
+    '''
+    t = tree.tree_
+    value = t.value[:, 0, :len(cols)].astype(float)
+    normalizer = value.sum(axis=1)
+    normalizer[normalizer == 0] = 1
+    values = np.zeros((t.node_count, len(classes)))
+    values[:, cols] = value / normalizer[:, np.newaxis]
+    feature = t.feature.astype(int)
+    if features is not None:
+        feature = np.where(feature >= 0, np.asarray(features)[feature], feature)
+    return [t.children_left.astype(int), t.children_right.astype(int),
+                        feature, t.threshold.astype(float), values]
+
+def export(bag):
+    ''' Compiles a fitted Bag into a CompiledBag
+
+    Parameters
+    ----------
+        bag: copper.AverageBag, MaxProbaBag, PriorityBag or StackBag, the
+                    members must be LogisticRegression, SGDClassifier (log
+                    loss), DecisionTreeClassifier, RandomForestClassifier or
+                    ExtraTreesClassifier
+
+    Raises ValueError for other members (or SGDClassifier losses)
+
+    Returns
+    -------
+        CompiledBag
+    '''
+    classes = getattr(bag, 'classes_', None)
+    if classes is None:
+        classes = np.unique(np.concatenate([clf.classes_ for clf in bag.clfs]))
+    classes = np.asarray(classes)
+    n_features = getattr(bag, 'n_features_', None)
+    if n_features is None:
+        clf = bag.clfs[0]
+        if hasattr(clf, 'coef_'):
+            n_features = clf.coef_.shape[1]
+        else:
+            tree = clf if type(clf).__name__ in TREE else clf.estimators_[0]
+            n_features = tree.tree_.n_features
+
+    meta = {'reducer': type(bag).__name__, 'members': []}
+    coefs, intercepts = [], []
+    left, right, feature, threshold, values = [], [], [], [], []
+    roots, tree_member = [], []
+    n_nodes, n_outputs = 0, 0
+
+    for i, clf in enumerate(bag.clfs):
+        name = type(clf).__name__
+        features = bag.features_[i] if i < len(bag.features_) else None
+        cols = np.searchsorted(classes, clf.classes_).tolist()
+
+        if name in LINEAR:
+            _check_linear(clf)
+            coef = np.zeros((clf.coef_.shape[0], n_features))
+            if features is None:
+                coef[:] = clf.coef_
+            else:
+                coef[:, features] = clf.coef_
+            coefs.append(coef)
+            intercepts.append(np.asarray(clf.intercept_, dtype=float).ravel())
+            meta['members'].append({'kind': 'linear', 'cols': cols,
+                                    'start': n_outputs, 'link': _link(clf),
+                                    'end': n_outputs + coef.shape[0]})
+            n_outputs = n_outputs + coef.shape[0]
+        elif name in TREE or name in FOREST:
+            trees = [clf] if name in TREE else clf.estimators_
+            for tree in trees:
+                arrays = _tree_arrays(tree, classes, cols, features)
+                for lst, array in zip([left, right, feature, threshold, values], arrays):
+                    lst.append(array)
+                # children are indexes inside each tree: shift them
+                for lst in (left, right):
+                    lst[-1] = np.where(lst[-1] >= 0, lst[-1] + n_nodes, -1)
+                roots.append(n_nodes)
+                tree_member.append(i)
+                n_nodes = n_nodes + len(arrays[0])
+            meta['members'].append({'kind': 'trees', 'n_trees': len(trees)})
+        else:
+            raise ValueError('Can not export a member of type %s' % name)
+
+    arrays = {'classes': classes}
+    if coefs:
+        arrays['coef'] = np.vstack(coefs).T
+        arrays['intercept'] = np.concatenate(intercepts)
+    if roots:
+        arrays['left'] = np.concatenate(left)
+        arrays['right'] = np.concatenate(right)
+        arrays['feature'] = np.concatenate(feature)
+        arrays['threshold'] = np.concatenate(threshold)
+        arrays['values'] = np.vstack(values)
+        arrays['roots'] = np.array(roots)
+        arrays['tree_member'] = np.array(tree_member)
+
+    if meta['reducer'] == 'AverageBag' and bag.weights is not None:
+        meta['weights'] = list(map(float, bag.weights))
+    elif meta['reducer'] == 'PriorityBag':
+        meta['range'] = bag.range
+    elif meta['reducer'] == 'StackBag':
+        meta_clf = bag.meta_clf_
+        if type(meta_clf).__name__ not in LINEAR:
+            raise ValueError('Can not export a meta_clf of type %s' %
+                                                    type(meta_clf).__name__)
+        _check_linear(meta_clf)
+        arrays['meta_coef'] = np.asarray(meta_clf.coef_, dtype=float).T
+        arrays['meta_intercept'] = np.asarray(meta_clf.intercept_, dtype=float).ravel()
+        meta['meta_link'] = _link(meta_clf)
+    return CompiledBag(arrays, meta)
+
+class CompiledBag(object):
+    ''' NumPy only version of a fitted Bag, create it with export(bag)
+    '''
+    def __init__(self, arrays, meta):
+        self.arrays = arrays
+        self.meta = meta
+        self.classes_ = arrays['classes']
+
+    def _apply(self, X):
+        ''' Leaf of every tree for every row: (n_trees x rows)
+        '''
+        a = self.arrays
+        # scikit-learn compares float32 inputs with the thresholds
+        X = np.asarray(X, dtype=np.float32)
+        n_rows = len(X)
+        nodes = np.repeat(a['roots'], n_rows)
+        rows = np.tile(np.arange(n_rows), len(a['roots']))
+        # only the (tree, row) pairs that are not on a leaf yet
+        active = np.arange(len(nodes))
+        while len(active):
+            current = nodes[active]
+            left = a['left'][current]
+            split = left >= 0
+            active, current, left = active[split], current[split], left[split]
+            go_left = X[rows[active], a['feature'][current]] <= a['threshold'][current]
+            nodes[active] = np.where(go_left, left, a['right'][current])
+        return nodes.reshape((len(a['roots']), n_rows))
+
+    def proba_tensor(self, X):
+        ''' Predicted probabilities of every member (members x rows x classes)
+        '''
+        a = self.arrays
+        members = self.meta['members']
+        probas = np.zeros((len(members), len(X), len(self.classes_)))
+
+        if 'coef' in a:
+            z = np.dot(X, a['coef']) + a['intercept']
+            for i, member in enumerate(members):
+                if member['kind'] == 'linear':
+                    p = _apply_link(z[:, member['start']:member['end']], member['link'])
+                    probas[i][:, member['cols']] = p
+
+        if 'roots' in a:
+            leaves = a['values'][self._apply(X)]
+            starts = np.append(0, np.nonzero(np.diff(a['tree_member']))[0] + 1)
+            sums = np.add.reduceat(leaves, starts, axis=0)
+            for start, total in zip(starts, sums):
+                i = a['tree_member'][start]
+                probas[i] = total / members[i]['n_trees']
+        return probas
+
+    def predict_proba(self, X):
+        X = np.asarray(X, dtype=float)
+        probas = self.proba_tensor(X)
+        reducer = self.meta['reducer']
+        rows = np.arange(len(X))
+        if reducer in ('Bag', 'AverageBag'):
+            if 'weights' not in self.meta:
+                return probas.mean(axis=0)
+            weights = np.asarray(self.meta['weights'])
+            return np.tensordot(weights / weights.sum(), probas, axes=1)
+        elif reducer == 'MaxProbaBag':
+            return probas[np.argmax(probas.max(axis=2), axis=0), rows]
+        elif reducer == 'PriorityBag':
+            first = np.argmax(probas.max(axis=2) > 0.5 + self.meta['range'], axis=0)
+            return probas[first, rows]
+        elif reducer == 'StackBag':
+            features = probas.transpose((1, 0, 2)).reshape((len(X), -1))
+            z = np.dot(features, self.arrays['meta_coef']) + self.arrays['meta_intercept']
+            return _apply_link(z, self.meta['meta_link'])
+        raise ValueError('Unknown bag: %s' % reducer)
+
+    def predict(self, X):
+        probas = self.predict_proba(X)
+        return self.classes_[np.argmax(probas, axis=1)]
+
+    def save(self, filepath):
+        ''' Saves the arrays and the metadata in a .npz file
+        '''
+        np.savez(filepath, _meta=np.array(json.dumps(self.meta)), **self.arrays)
+
+def load(filepath):
+    ''' Loads a CompiledBag saved with CompiledBag.save
+
+    Returns
+    -------
+        CompiledBag
+    '''
+    data = np.load(filepath)
+    arrays = dict((key, data[key]) for key in data.files if key != '_meta')
+    return CompiledBag(arrays, json.loads(str(data['_meta'])))
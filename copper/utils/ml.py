@@ -1,4 +1,7 @@
 from __future__ import division
+import os
+import json
+import hashlib
 import copper
 import numpy as np
 import pandas as pd
@@ -8,88 +11,542 @@ from sklearn import grid_search
 from sklearn import decomposition
 from sklearn import cross_validation
 from sklearn.base import clone
+from sklearn.externals.joblib import Parallel, delayed
+from copper.utils import parallel
+from copper.core.estimators import _fit_member, _oob_average
+from copper.core.compare import _auc_groups, _weighted_auc
 
-def bootstrap(base_clf, n_iter, ds, score=False):
+def _bootstrap_member(clf, X, y, rows, score, oob):
     '''
-    Use bootstrap cross validation to create classifiers
+    Fits clf on the rows of a bootstrap sample, if score scores it (with
+    clf.score) on the rows left out, if oob also predicts their probabilities
+    '''
+    clf, out, probas = _fit_member(clf, X, y, rows, None, oob)
+    value = None
+    if score:
+        if out is None:
+            out = np.ones(len(X), dtype=bool)
+            out[rows] = False
+            out = np.nonzero(out)[0]
+        value = clf.score(X[out], y[out]) if len(out) else np.nan
+    return clf, out, probas, value
+
+def bootstrap(base_clf, n_iter, ds, score=False, oob=False, n_jobs=1,
+                                                        random_state=None):
+    '''
+    Use bootstrap to create classifiers: each clone of base_clf is fitted
+    on a sample with replacement of the rows of the dataset and scored on
+    the rows left out of its sample (out-of-bag).
+
+    The samples are generated before fitting, the clones are fitted in
+    parallel and the workers share a single memory-mapped copy of the
+    inputs and target.
 
     Parameters
     ----------
-        clf_class: scikit-learn classifier
-        clf_name: str - prefix for the classifiers: clf_name + "_" + itertation
-        n_iter: int - number of iterations
-        X_train: np.array, inputs for the training, default is self.X_train
-        y_train: np.array, targets for the training, default is self.y_train
-        ds: copper.Dataset, dataset for the training, default is self.train
-        **args: - arguments of the classifier
+        base_clf: scikit-learn classifier
+        n_iter: int - number of classifiers
+        ds: copper.Dataset, dataset for the training
+        score: boolean, also return the out-of-bag score (clf.score) of each
+                classifier, works with any estimator
+        oob: boolean, also return the out-of-bag probabilities of each row
+                averaging the classifiers that did not use it (nan if all did),
+                needs classifiers with predict_proba
+        n_jobs: int, number of classifiers fitted in parallel, -1 for all cpus
+        random_state: int, seed of the samples
 
     Returns
     -------
-        nothing, classifiers are added to the list
+        list of classifiers, ready for copper.AverageBag
+        if score: (classifiers, list of scores)
+        if oob: (classifiers, list of scores, np.array (rows x classes))
     '''
     X = copper.transform.inputs2ml(ds).values
     y = copper.transform.target2ml(ds).values
 
-    clfs = []
-    scores = []
-    bs = cross_validation.Bootstrap(len(X), n_iter=n_iter)
-    for train_index, test_index in bs:
-        X_train = X[train_index]
-        y_train = y[train_index]
-        X_test = X[test_index]
-        y_test = y[test_index]
-        clf_params = base_clf.get_params()
-        clf = clone(base_clf)
-        clf.fit(X_train, y_train)
-        clfs.append(clf)
-        if score:
-            scores.append(clf.score(X_test, y_test))
-    if score:
-        return clfs, scores
-    else:
+    n = len(X)
+    rng = np.random.RandomState(random_state)
+    samples = rng.randint(0, n, (n_iter, n))
+    if n_jobs != 1:
+        X, y = parallel.shared(X, y)
+
+    results = Parallel(n_jobs=n_jobs)(delayed(_bootstrap_member)(
+                        clone(base_clf), X, y, rows, score or oob, oob)
+                        for rows in samples)
+    clfs = [clf for clf, out, probas, value in results]
+    if not (score or oob):
         return clfs
 
-def cv_pca(ds, clf, range_=None, cv=None, n_iter=3, ascending=False):
+    scores = [value for clf, out, probas, value in results]
+    if not oob:
+        return clfs, scores
+    total, predicted = _oob_average([(clf, out, probas) for clf, out, probas,
+                                        value in results], np.unique(y), n)
+    return clfs, scores, total
+
+def _pca_fold(X, train, test, n_components):
+    '''
+    Fits a PCA on the train rows and projects the train and test rows
+    '''
+    pca = decomposition.PCA(n_components=n_components)
+    X_train = pca.fit_transform(X[train])
+    return X_train, pca.transform(X[test])
+
+def _pca_score(clf, X_train, y_train, X_test, y_test, n_components):
+    '''
+    Scores clf using the first n_components columns of the projections
+    '''
+    clf.fit(X_train[:, :n_components], y_train)
+    return clf.score(X_test[:, :n_components], y_test)
+
+def cv_pca(ds, clf, range_=None, cv=None, n_iter=3, ascending=False, n_jobs=1):
+    '''
+    Cross validation score of clf on the PCA projection of the inputs for
+    each number of components.
+
+    The PCA is fitted once per fold (on the train rows only) with the
+    maximum number of components: the projection on fewer components is a
+    slice of its columns. The (fold, components) pairs are scored in
+    parallel.
+
+    Parameters
+    ----------
+        ds: copper.Dataset
+        clf: scikit-learn classifier
+        range_: list of numbers of components, default 1 to number of inputs
+        cv: scikit-learn cross validation, default ShuffleSplit(len(ds), n_iter)
+        n_iter: int, number of folds of the default cv
+        ascending: boolean, order of the result
+        n_jobs: int, number of tasks in parallel, -1 for all cpus
+
+    Returns
+    -------
+        pd.Series: mean score for each number of components
+    '''
     if cv is None:
         cv = cross_validation.ShuffleSplit(len(ds), n_iter=n_iter)
     if range_ is None:
         range_ = range(1, len(ds.inputs.columns))
-    
-    ans = pd.Series(index=range_)
+    range_ = list(range_)
+    folds = list(cv)
+
+    X = copper.transform.inputs2ml(ds).values
     y = copper.transform.target2ml(ds).values
-    for i in range_:
-        pca = ds.PCA(n_components=i)
-        X = pca.inputs
-        scores = cross_validation.cross_val_score(clf, X, y, cv=cv)
-        ans[i] = np.mean(scores)
+    if n_jobs != 1:
+        X, y = parallel.shared(X, y)
+
+    projections = Parallel(n_jobs=n_jobs)(delayed(_pca_fold)(
+                        X, train, test, max(range_)) for train, test in folds)
+    if n_jobs != 1:
+        projections = [parallel.shared(X_train, X_test)
+                                for X_train, X_test in projections]
+    scores = Parallel(n_jobs=n_jobs)(delayed(_pca_score)(
+                        clone(clf), X_train, y[train], X_test, y[test], i)
+                        for (train, test), (X_train, X_test) in zip(folds, projections)
+                        for i in range_)
+    scores = np.array(scores).reshape((len(folds), len(range_)))
+    ans = pd.Series(scores.mean(axis=0), index=range_)
     return ans.order(ascending=ascending)
 
-def grid(ds, base_clf, param, values, cv=None, verbose=False, **args):
+def _fingerprint(*objs):
+    '''
+    sha1 of arrays (their bytes) and other objects (their repr)
+    '''
+    sha = hashlib.sha1()
+    for obj in objs:
+        if isinstance(obj, np.ndarray):
+            sha.update(str((obj.shape, obj.dtype.str)).encode('utf-8'))
+            sha.update(np.ascontiguousarray(obj).view(np.uint8))
+        else:
+            sha.update(repr(obj).encode('utf-8'))
+    return sha.hexdigest()
+
+# Parameters that can be evaluated as a path with warm_start: True if the
+# path goes from the largest value to the smallest
+WARM_PARAMS = {'n_estimators': False, 'C': False, 'alpha': True}
+
+def _grid_path(clf, X, y, train, test, cells):
+    '''
+    Fits clf on the train rows with the params of each cell, in order, and
+    scores it on the train and test rows. With warm_start each fit starts
+    from the previous one (coefficients or trees already grown).
+
+    cells: list of (params, filepath). If filepath the scores are saved
+    there (written to a temporary file and renamed, so an interrupted search
+    never leaves a partial cell)
+    '''
+    X_train, y_train = X[train], y[train]
+    X_test, y_test = X[test], y[test]
+    ans = []
+    for params, filepath in cells:
+        clf.set_params(**params)
+        clf.fit(X_train, y_train)
+        scores = [clf.score(X_train, y_train), clf.score(X_test, y_test)]
+        if filepath is not None:
+            temp = '%s.%d.tmp' % (filepath, os.getpid())
+            with open(temp, 'w') as f:
+                json.dump(scores, f)
+            os.rename(temp, filepath)
+        ans.append(scores)
+    return ans
+
+def _warm_path(base_clf, param, values):
+    '''
+    None if the values of param can not be evaluated as a warm started path,
+    else the direction (reverse) to sort them
+    '''
+    if isinstance(param, dict) or param not in WARM_PARAMS:
+        return None
+    if 'warm_start' not in base_clf.get_params():
+        return None
+    for value in values:
+        if isinstance(value, bool) or not isinstance(value, (int, float, np.number)):
+            return None
+    return WARM_PARAMS[param]
+
+def grid(ds, base_clf, param, values=None, cv=None, verbose=False, n_jobs=1,
+                                        cache=True, warm_start=True, **args):
+    '''
+    Scores base_clf on each value of a parameter (or each combination of
+    several parameters) and each fold of the cross validation.
+
+    Every (combination, fold) is a task of a pool of n_jobs processes that
+    share a single memory-mapped copy of the dataset. If the project path is
+    set (copper.project.path) each result is saved on the project cache
+    folder, keyed by the data, the estimator, its parameters, the fold and
+    whether it was fitted from scratch or on a warm started path (and the
+    values fitted before it on the path): an interrupted search resumes
+    where it stopped and repeated searches reuse the previous results. Use a cv (or args) with a random_state so
+    the folds are the same between searches.
+
+    Sweeps of n_estimators, C or alpha on estimators with warm_start are
+    evaluated as a path: one task per fold fits the sorted values reusing
+    the trees or coefficients of the previous value. If a result of the
+    path is not cached the whole path of that fold is fitted again.
+
+    Parameters
+    ----------
+        ds: copper.Dataset
+        base_clf: scikit-learn estimator
+        param: str, name of the parameter. Or a dict {name: list of values}
+                    to search all the combinations of several parameters
+        values: list, values of the parameter (when param is a str)
+        cv: scikit-learn cross validation, default ShuffleSplit(len(ds), **args)
+        verbose: boolean, print the combinations and the cached results
+        n_jobs: int, number of tasks in parallel, -1 for all cpus
+        cache: boolean, use the project cache folder
+        warm_start: boolean, evaluate the sweep as a path when possible,
+                    False to fit every value from scratch
+
+    Returns
+    -------
+        (train_scores, test_scores): np.arrays (values x folds), for a dict
+            param the rows follow grid_search.ParameterGrid(param).
+            Use with copper.plot.grid(values, train_scores, test_scores)
+    '''
     if cv is None:
         cv = cross_validation.ShuffleSplit(len(ds), **args)
-    
+    if isinstance(param, dict):
+        combinations = list(grid_search.ParameterGrid(param))
+    else:
+        combinations = [{param: value} for value in values]
+    folds = list(cv)
+
     X = copper.transform.inputs2ml(ds).values
     y = copper.transform.target2ml(ds).values
 
-    train_scores = np.zeros((len(values), cv.n_iter))
-    test_scores = np.zeros((len(values), cv.n_iter))
-    for i, value in enumerate(values):
+    folder = None
+    if cache and copper.project.cache:
+        folder = os.path.join(copper.project.cache, 'grid')
+        if not os.access(folder, os.F_OK):
+            os.makedirs(folder)
+        data_key = _fingerprint(X, y)
+        fold_keys = [_fingerprint(train, test) for train, test in folds]
+
+    # a warm path does not give the same scores as fitting from scratch
+    reverse = _warm_path(base_clf, param, values) if warm_start else None
+    mode = 'fit' if reverse is None else 'path'
+    order = list(range(len(combinations)))
+    if reverse is not None:
+        order = sorted(order, key=lambda i: values[i], reverse=reverse)
+    # on a path each result also depends on the values fitted before it
+    paths = [None] * len(combinations)
+    if reverse is not None:
+        for k, i in enumerate(order):
+            paths[i] = [values[n] for n in order[:k]]
+
+    train_scores = np.zeros((len(combinations), len(folds)))
+    test_scores = np.zeros((len(combinations), len(folds)))
+    filepaths = [[None] * len(folds) for params in combinations]
+    missing = [[] for fold in folds]
+    for i, params in enumerate(combinations):
+        clf = clone(base_clf)
+        clf.set_params(**params)
         if verbose:
-            print('%s= %s' % (param, str(value)))
-        for j, (train, test) in enumerate(cv):
-            clf_params = base_clf.get_params()
-            clf_params[param] = value
-            clf = clone(base_clf)
-            clf.set_params(**clf_params)
-            clf.fit(X[train], y[train])
-            train_scores[i, j] = clf.score(X[train], y[train])
-            test_scores[i, j] = clf.score(X[test], y[test])
+            print(', '.join('%s= %s' % item for item in sorted(params.items())))
+        for j, (train, test) in enumerate(folds):
+            if folder is not None:
+                key = _fingerprint(data_key, type(clf).__module__,
+                            type(clf).__name__, sorted(clf.get_params().items()),
+                            fold_keys[j], mode, paths[i])
+                filepaths[i][j] = os.path.join(folder, key + '.json')
+                if os.access(filepaths[i][j], os.F_OK):
+                    with open(filepaths[i][j]) as f:
+                        train_scores[i, j], test_scores[i, j] = json.load(f)
+                    continue
+            missing[j].append(i)
+
+    # tasks: (fold, estimator, [combination, ...])
+    tasks = []
+    for j, cells in enumerate(missing):
+        if reverse is None:
+            tasks.extend((j, clone(base_clf), [i]) for i in cells)
+        elif cells:
+            # a path can not start from a cached result: fit the whole path
+            tasks.append((j, clone(base_clf).set_params(warm_start=True), order))
+
+    if verbose and folder is not None:
+        n_cells = len(combinations) * len(folds)
+        n_fits = sum(len(cells) for j, clf, cells in tasks)
+        print('%d of %d results from the cache' % (n_cells - n_fits, n_cells))
+    if n_jobs != 1 and tasks:
+        X, y = parallel.shared(X, y)
+    results = Parallel(n_jobs=n_jobs)(delayed(_grid_path)(
+                        clf, X, y, folds[j][0], folds[j][1],
+                        [(combinations[i], filepaths[i][j]) for i in cells])
+                        for j, clf, cells in tasks)
+    for (j, clf, cells), scores in zip(tasks, results):
+        for i, (train_score, test_score) in zip(cells, scores):
+            train_scores[i, j], test_scores[i, j] = train_score, test_score
 
     return train_scores, test_scores
 
 
+def _nested_order(y, rng):
+    '''
+    Permutation of the rows where every prefix is stratified: the rows of
+    each class are spread evenly (random offset per class) along the order
+    '''
+    ranks = np.zeros(len(y))
+    for label in np.unique(y):
+        rows = rng.permutation(np.nonzero(y == label)[0])
+        ranks[rows] = (np.arange(len(rows)) + rng.rand()) / len(rows)
+    return np.argsort(ranks, kind='mergesort')
+
+def _curve_mode(clf, incremental):
+    '''
+    How clf grows between subsets: 'partial' (partial_fit with the new
+    rows), 'warm' (fit with warm_start from the previous coefficients) or
+    'cold' (fit from scratch)
+    '''
+    if not incremental:
+        return 'cold'
+    if hasattr(clf, 'partial_fit'):
+        return 'partial'
+    params = clf.get_params()
+    # warm_start on ensembles only adds estimators, does not learn new rows
+    if 'warm_start' in params and 'n_estimators' not in params:
+        return 'warm'
+    return 'cold'
+
+def _curve_path(clf, X, y, rows, test, ends, mode, classes):
+    '''
+    Fits clf on rows[:end] for each end (ascending) and scores it on those
+    rows and on the test rows
+    '''
+    if mode == 'warm':
+        clf.set_params(warm_start=True)
+    X_test, y_test = X[test], y[test]
+    ans = []
+    start = 0
+    for end in ends:
+        if mode == 'partial':
+            clf.partial_fit(X[rows[start:end]], y[rows[start:end]], classes=classes)
+        else:
+            clf.fit(X[rows[:end]], y[rows[:end]])
+        start = end
+        ans.append([clf.score(X[rows[:end]], y[rows[:end]]),
+                    clf.score(X_test, y_test)])
+    return ans
+
+def learning_curve(ds, clfs, sizes=None, cv=None, n_iter=3, n_jobs=1,
+                                        incremental=True, random_state=None):
+    '''
+    Train and test scores of classifiers fitted on growing subsets of the
+    training rows of each fold.
+
+    The subsets are nested and stratified: prefixes of one permutation of
+    the training rows of the fold. The (size, classifier, fold) fits run in
+    parallel; if incremental, classifiers with partial_fit or warm_start
+    (not ensembles) grow along the sizes of a fold in a single task instead
+    of being refitted for every size.
+
+    Parameters
+    ----------
+        ds: copper.Dataset
+        clfs: dict {name: classifier} or list of classifiers
+        sizes: list of fractions (<= 1) or numbers of training rows,
+                    default 10 fractions from 0.1 to 1
+        cv: scikit-learn cross validation, default ShuffleSplit(len(ds), n_iter)
+        n_iter: int, number of folds of the default cv
+        n_jobs: int, number of tasks in parallel, -1 for all cpus
+        incremental: boolean, grow the models that support it, False to fit
+                    every size from scratch
+        random_state: int, seed of the default cv and the permutations
+
+    Returns
+    -------
+        (sizes, train_scores, test_scores): sizes is an np.array of numbers of
+            rows, the scores are dicts {name: np.array (sizes x folds)}.
+            Use with copper.plot.learning_curve(sizes, train_scores, test_scores)
+            or copper.plot.grid(sizes, train_scores[name], test_scores[name])
+    '''
+    if type(clfs) is list:
+        clfs = dict(('%s_%d' % (type(clf).__name__, i), clf)
+                                    for i, clf in enumerate(clfs))
+    if cv is None:
+        cv = cross_validation.ShuffleSplit(len(ds), n_iter=n_iter,
+                                                    random_state=random_state)
+    if sizes is None:
+        sizes = np.linspace(0.1, 1, 10)
+    folds = list(cv)
+
+    X = copper.transform.inputs2ml(ds).values
+    y = copper.transform.target2ml(ds).values
+    classes = np.unique(y)
+
+    rng = np.random.RandomState(random_state)
+    orders = [train[_nested_order(y[train], rng)] for train, test in folds]
+    n_train = min(len(train) for train, test in folds)
+    sizes = np.asarray(sizes)
+    if sizes.max() <= 1:
+        sizes = sizes * n_train
+    sizes = np.unique(np.clip(sizes.astype(int), len(classes), n_train))
+
+    # tasks: (name, fold, [indexes of the sizes], mode)
+    tasks = []
+    for name in sorted(clfs.keys()):
+        mode = _curve_mode(clfs[name], incremental)
+        for j in range(len(folds)):
+            if mode == 'cold':
+                tasks.extend((name, j, [k], mode) for k in range(len(sizes)))
+            else:
+                tasks.append((name, j, list(range(len(sizes))), mode))
+
+    if n_jobs != 1:
+        X, y = parallel.shared(X, y)
+    results = Parallel(n_jobs=n_jobs)(delayed(_curve_path)(
+                        clone(clfs[name]), X, y, orders[j], folds[j][1],
+                        sizes[ks], mode, classes)
+                        for name, j, ks, mode in tasks)
+
+    train_scores, test_scores = {}, {}
+    for name in clfs:
+        train_scores[name] = np.zeros((len(sizes), len(folds)))
+        test_scores[name] = np.zeros((len(sizes), len(folds)))
+    for (name, j, ks, mode), scores in zip(tasks, results):
+        for k, (train_score, test_score) in zip(ks, scores):
+            train_scores[name][k, j] = train_score
+            test_scores[name][k, j] = test_score
+    return sizes, train_scores, test_scores
+
 def rmsle(y_test, y_pred):
     ans = np.log1p(y_pred) - np.log1p(y_test)
     ans = np.power(ans, 2)
     ans = ans.mean()
-    return np.sqrt(ans)
\ No newline at end of file
+    return np.sqrt(ans)
+
+# ------------------------------------------------------------------------------
+#                            ENSEMBLE SELECTION
+# ------------------------------------------------------------------------------
+
+def _ensemble_scores(probas, y, metric):
+    '''
+    Metric of each candidate ensemble
+
+    Parameters
+    ----------
+        probas: np.array (n_candidates x n_rows x n_classes)
+        y: np.array (n_rows), index of the class of each row
+
+    Returns
+    -------
+        np.array (n_candidates), bigger is better
+    '''
+    rows = np.arange(probas.shape[1])
+    if metric == 'accuracy':
+        return (np.argmax(probas, axis=2) == y).mean(axis=1)
+    elif metric == 'logloss':
+        return np.log(np.clip(probas[:, rows, y], 1e-15, 1)).mean(axis=1)
+    elif metric == 'mse':
+        probas = probas.copy()
+        probas[:, rows, y] -= 1
+        return -np.power(probas, 2).sum(axis=2).mean(axis=1)
+    elif metric == 'auc':
+        ones = np.ones((1, probas.shape[1]))
+        return np.array([_weighted_auc(_auc_groups(scores, y == 1), ones)[0]
+                                            for scores in probas[:, :, 1]])
+    raise ValueError('Unknown metric: %s' % metric)
+
+def ensemble_selection(clfs, probas, y, metric='accuracy', n_iter=50, init_size=1):
+    '''
+    Greedy forward selection of an ensemble (Caruana et al. 2004) using only
+    the predicted probabilities of the classifiers on a validation set.
+    On each iteration the classifier (with replacement) that most improves
+    the average of the ensemble is added; all the candidates are evaluated
+    at once updating the running sum of probabilities.
+
+    Parameters
+    ----------
+        clfs: list or pandas.Series of fitted classifiers (library)
+        probas: np.array (n_clfs x n_rows x n_classes), predicted
+                    probabilities of the classifiers on the validation set
+        y: np.array (n_rows), index of the class of each validation row
+        metric: str, one of: accuracy, logloss, mse (Brier score), auc
+        n_iter: int, number of classifiers added
+        init_size: int, the ensemble starts with the best init_size classifiers
+
+    Returns
+    -------
+        (copper.AverageBag with the selected classifiers and weights,
+            pandas.Series with the metric of the initial ensemble (0, if
+            init_size) and after each iteration)
+    '''
+    if type(clfs) is pd.Series:
+        clfs = clfs.values.tolist()
+    probas = np.asarray(probas, dtype=float)
+    y = np.asarray(y, dtype=int)
+
+    counts = np.zeros(len(clfs), dtype=int)
+    total = np.zeros(probas.shape[1:])
+    single = _ensemble_scores(probas, y, metric)
+    for i in np.argsort(-single, kind='mergesort')[:init_size]:
+        counts[i] += 1
+        total += probas[i]
+
+    history = []
+    values = []
+    if init_size > 0:
+        # The initial ensemble is also a candidate result
+        history.append(counts.copy())
+        values.append(_ensemble_scores((total / counts.sum())[np.newaxis],
+                                                            y, metric)[0])
+    for it in range(n_iter):
+        candidates = (total + probas) / (counts.sum() + 1)
+        scores = _ensemble_scores(candidates, y, metric)
+        best = np.argmax(scores)
+        counts[best] += 1
+        total += probas[best]
+        history.append(counts.copy())
+        values.append(scores[best])
+
+    # Keep the iteration with the best metric
+    best_it = int(np.argmax(values))
+    counts = history[best_it]
+    selected = np.nonzero(counts)[0]
+    bag = copper.AverageBag([clfs[i] for i in selected],
+                                        weights=counts[selected].tolist())
+    if metric in ('logloss', 'mse'):
+        values = [-value for value in values]
+    index = range(n_iter + 1 - len(values), n_iter + 1)
+    return bag, pd.Series(values, index=index, name=metric)
@@ -0,0 +1,42 @@
+from __future__ import division
+import os
+import atexit
+import shutil
+import tempfile
+import numpy as np
+'''
+Utils for sharing data between the processes of joblib.Parallel
+'''
+
+_folder = None
+
+def _temp_folder():
+    global _folder
+    if _folder is None:
+        _folder = tempfile.mkdtemp(prefix='copper_')
+        atexit.register(shutil.rmtree, _folder, True)
+    return _folder
+
+def shared(*arrays):
+    ''' Saves the arrays to a temporary folder (removed at exit) and returns
+    them memory-mapped (read only). joblib sends memory-mapped arrays to the
+    workers as a reference to the file, so every process reads the same copy
+    no matter how many jobs use them.
+
+    Arrays that are already memory-mapped are returned as they are.
+
+    Returns
+    -------
+        np.memmap or list of np.memmap
+    '''
+    ans = []
+    for array in arrays:
+        if array is None or isinstance(array, np.memmap):
+            ans.append(array)
+            continue
+        array = np.asarray(array)
+        fd, filename = tempfile.mkstemp(suffix='.npy', dir=_temp_folder())
+        os.close(fd)
+        np.save(filename, array)
+        ans.append(np.load(filename, mmap_mode='r'))
+    return ans[0] if len(ans) == 1 else ans
@@ -0,0 +1,229 @@
+from __future__ import division
+import numpy as np
+import pandas as pd
+from scipy import stats
+from scipy import sparse
+from sklearn.externals.joblib import Parallel, delayed
+'''
+Univariate scores of the features of a classification problem computed from
+per class partial sums of each column. The sums are calculated directly on
+dense or scipy.sparse inputs (never densified), on blocks of columns in
+parallel and can be accumulated over chunks of rows and merged.
+'''
+
+METHODS = ('f', 'chi2', 'mi', 'corr')
+
+def _class_sums(X, Y):
+    '''
+    Per class sums, sums of squares and non zero counts of the columns of X.
+    Y is the sparse (rows x classes) indicator matrix of the target.
+
+    Returns
+    -------
+        3 np.arrays (classes x columns)
+    '''
+    Yt = Y.T.tocsr()
+    if sparse.issparse(X):
+        X = X.tocsc()
+        sums = Yt * X
+        squares = Yt * X.multiply(X)
+        nonzero = Yt * (X != 0).astype(np.float64)
+        return (np.asarray(sums.todense()), np.asarray(squares.todense()),
+                                            np.asarray(nonzero.todense()))
+    X = np.asarray(X, dtype=np.float64)
+    return Yt * X, Yt * (X * X), Yt * (X != 0).astype(np.float64)
+
+class FeatureScores(object):
+    '''
+    Accumulates the partial sums of the features for each class of the target
+
+    Parameters
+    ----------
+        columns: list, names of the features, default the columns of the first
+                    DataFrame given to update or their positions
+    '''
+    def __init__(self, columns=None):
+        self.columns = columns
+        self.classes = []
+        self.counts = None
+        self.sums = None
+        self.squares = None
+        self.nonzero = None
+
+    def _add_classes(self, classes):
+        new = [label for label in classes if label not in self.classes]
+        if not new:
+            return
+        self.classes = self.classes + new
+        zeros = np.zeros((len(new), len(self.columns)))
+        if self.counts is None:
+            self.counts = np.zeros(len(new))
+            self.sums, self.squares, self.nonzero = zeros, zeros.copy(), zeros.copy()
+        else:
+            self.counts = np.concatenate((self.counts, np.zeros(len(new))))
+            self.sums = np.vstack((self.sums, zeros))
+            self.squares = np.vstack((self.squares, zeros))
+            self.nonzero = np.vstack((self.nonzero, zeros))
+
+    def update(self, X, y, n_jobs=1, block_size=10000):
+        '''
+        Adds a chunk of rows
+
+        Parameters
+        ----------
+            X: pd.DataFrame, np.array or scipy.sparse matrix (rows x features)
+            y: pd.Series or np.array, classes
+            n_jobs: int, number of blocks of columns in parallel
+            block_size: int, number of columns of each block
+        '''
+        if self.columns is None:
+            if type(X) is pd.DataFrame:
+                self.columns = list(X.columns)
+            else:
+                self.columns = list(range(X.shape[1]))
+        if type(X) is pd.DataFrame:
+            X = X.values
+        y = np.asarray(y)
+        labels, inverse = np.unique(y, return_inverse=True)
+        self._add_classes(labels.tolist())
+        rows = np.array([self.classes.index(label) for label in labels])[inverse]
+        Y = sparse.csr_matrix((np.ones(len(y)), (np.arange(len(y)), rows)),
+                                            shape=(len(y), len(self.classes)))
+
+        if sparse.issparse(X):
+            X = X.tocsc()
+        blocks = range(0, X.shape[1], block_size)
+        results = Parallel(n_jobs=n_jobs)(delayed(_class_sums)(
+                        X[:, start:start + block_size], Y) for start in blocks)
+        self.counts += np.bincount(rows, minlength=len(self.classes))
+        self.sums += np.hstack([sums for sums, squares, nonzero in results])
+        self.squares += np.hstack([squares for sums, squares, nonzero in results])
+        self.nonzero += np.hstack([nonzero for sums, squares, nonzero in results])
+        return self
+
+    def merge(self, other):
+        '''
+        Adds the partial sums of another FeatureScores of the same features
+        '''
+        if other.counts is None:
+            return self
+        if self.columns is None:
+            self.columns = other.columns
+        self._add_classes(other.classes)
+        rows = [self.classes.index(label) for label in other.classes]
+        self.counts[rows] += other.counts
+        self.sums[rows] += other.sums
+        self.squares[rows] += other.squares
+        self.nonzero[rows] += other.nonzero
+        return self
+
+    def f(self):
+        '''
+        ANOVA F value of each feature (as sklearn's f_classif)
+
+        Returns
+        -------
+            (pd.Series F, pd.Series p-values)
+        '''
+        n = self.counts.sum()
+        k = len(self.classes)
+        total = self.sums.sum(axis=0)
+        square_of_sums = total ** 2 / n
+        ss_total = self.squares.sum(axis=0) - square_of_sums
+        ss_between = (self.sums ** 2 / self.counts[:, np.newaxis]).sum(axis=0) - square_of_sums
+        ss_within = ss_total - ss_between
+        with np.errstate(divide='ignore', invalid='ignore'):
+            f = (ss_between / (k - 1)) / (ss_within / (n - k))
+        pvalues = stats.f.sf(f, k - 1, n - k)
+        return (pd.Series(f, index=self.columns),
+                pd.Series(pvalues, index=self.columns))
+
+    def chi2(self):
+        '''
+        Chi squared of each (non negative) feature (as sklearn's chi2)
+
+        Returns
+        -------
+            (pd.Series chi2, pd.Series p-values)
+        '''
+        expected = np.outer(self.counts / self.counts.sum(), self.sums.sum(axis=0))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            chi2 = ((self.sums - expected) ** 2 / expected).sum(axis=0)
+        pvalues = stats.chi2.sf(chi2, len(self.classes) - 1)
+        return (pd.Series(chi2, index=self.columns),
+                pd.Series(pvalues, index=self.columns))
+
+    def mi(self):
+        '''
+        Mutual information (nats) between the target and the indicator of
+        each feature being non zero, e.g. one-hot or hashed features
+
+        Returns
+        -------
+            pd.Series
+        '''
+        n = self.counts.sum()
+        p_class = (self.counts / n)[:, np.newaxis]
+        joint = np.array([self.nonzero / n, (self.counts[:, np.newaxis] - self.nonzero) / n])
+        p_feature = joint.sum(axis=1)[:, np.newaxis, :]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            terms = joint * np.log(joint / (p_feature * p_class))
+        return pd.Series(np.nansum(terms, axis=(0, 1)), index=self.columns)
+
+    def corr(self):
+        '''
+        Pearson correlation between each feature and the target (the
+        classes as numbers)
+
+        Returns
+        -------
+            pd.Series
+        '''
+        n = self.counts.sum()
+        labels = np.asarray(self.classes, dtype=np.float64)
+        sum_x = self.sums.sum(axis=0)
+        sum_xx = self.squares.sum(axis=0)
+        sum_xy = np.dot(labels, self.sums)
+        sum_y = np.dot(labels, self.counts)
+        sum_yy = np.dot(labels ** 2, self.counts)
+        cov = sum_xy - sum_x * sum_y / n
+        var_x = sum_xx - sum_x ** 2 / n
+        var_y = sum_yy - sum_y ** 2 / n
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corr = cov / np.sqrt(var_x * var_y)
+        return pd.Series(corr, index=self.columns)
+
+    def scores(self, method='f'):
+        '''
+        Scores of the features, one of 'f', 'chi2', 'mi' or 'corr'
+        '''
+        if method not in METHODS:
+            raise ValueError('Unknown method: %s' % method)
+        ans = getattr(self, method)()
+        return ans[0] if type(ans) is tuple else ans
+
+def feature_scores(X, y=None, method='f', n_jobs=1, block_size=10000,
+                                                        ascending=False):
+    '''
+    Univariate scores of the features
+
+    Parameters
+    ----------
+        X: pd.DataFrame, np.array, scipy.sparse matrix or an iterable of
+                    (X, y) chunks
+        y: pd.Series or np.array, classes (None for chunks)
+        method: str, 'f' (ANOVA F), 'chi2', 'mi' (mutual information of the
+                    non zero indicator) or 'corr' (correlation with the target)
+        n_jobs: int, number of blocks of columns in parallel
+        block_size: int, number of columns of each block
+        ascending: boolean, sort the returned Series on this direction
+
+    Returns
+    -------
+        pandas.Series
+    '''
+    scores = FeatureScores()
+    chunks = [(X, y)] if y is not None else X
+    for X_chunk, y_chunk in chunks:
+        scores.update(X_chunk, y_chunk, n_jobs=n_jobs, block_size=block_size)
+    return scores.scores(method).order(ascending=ascending)
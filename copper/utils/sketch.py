@@ -0,0 +1,370 @@
+from __future__ import division
+import hashlib
+import numpy as np
+import pandas as pd
+'''
+Mergeable sketches and statistics of the columns of a DataFrame: update them
+with chunks of rows (e.g. pd.read_csv(..., chunksize=)) and merge the
+sketches of different chunks or workers.
+'''
+
+def _mix(h):
+    ''' splitmix64 finalizer: spreads the bits of uint64 values
+    '''
+    h = h + np.uint64(0x9E3779B97F4A7C15)
+    h = (h ^ (h >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return h ^ (h >> np.uint64(31))
+
+def hash_values(series):
+    '''
+    64 bits hash of the not null values of a Series, the same between
+    processes (python's hash of strings is not). Integers are hashed on
+    their int64 bytes (exact for all the values) and so are the integral
+    floats, so 1 and 1.0 have the same hash on every chunk.
+
+    Returns
+    -------
+        np.array of uint64
+    '''
+    series = series.dropna()
+    if series.dtype.kind not in 'biuf':
+        labels, uniques = pd.factorize(series.values)
+        digests = [hashlib.md5(str(value).encode('utf-8')).digest()[:8]
+                                                    for value in uniques]
+        hashes = np.frombuffer(b''.join(digests), dtype=np.uint64)
+        return hashes[labels]
+    values = series.values
+    if values.dtype.kind in 'biu':
+        return _mix(values.astype(np.int64).view(np.uint64))
+    values = values.astype(np.float64)
+    # mixed twice so their bits are not hashed like the same int64 bits
+    ans = _mix(_mix(values.view(np.uint64)))
+    integral = (values == np.floor(values)) & (np.abs(values) < 2. ** 63)
+    ans[integral] = _mix(values[integral].astype(np.int64).view(np.uint64))
+    return ans
+
+def _bit_length(x):
+    ''' Number of bits of each uint64 (0 for 0), exact for all the values
+    '''
+    high = (x >> np.uint64(32)).astype(np.float64)
+    low = (x & np.uint64(0xFFFFFFFF)).astype(np.float64)
+    return np.where(high > 0, 32 + np.frexp(high)[1], np.frexp(low)[1])
+
+class HyperLogLog(object):
+    '''
+    Approximate number of distinct values (excluding NA) of each column.
+    The relative standard error is about 1.04 / sqrt(2 ** precision)
+
+    Parameters
+    ----------
+        error: float, target relative standard error, sets the precision
+                    (memory of 2 ** precision bytes per column)
+    '''
+    def __init__(self, error=0.01):
+        self.precision = int(np.clip(np.ceil(np.log2((1.04 / error) ** 2)), 4, 18))
+        self.columns = []
+        self.registers = np.zeros((0, 2 ** self.precision), dtype=np.uint8)
+
+    def _add_columns(self, columns):
+        new = [col for col in columns if col not in self.columns]
+        if new:
+            self.columns = self.columns + new
+            self.registers = np.vstack((self.registers,
+                    np.zeros((len(new), self.registers.shape[1]), dtype=np.uint8)))
+
+    def update(self, frame):
+        '''
+        Adds the values of a DataFrame (or Series) to the sketch
+        '''
+        if type(frame) is pd.Series:
+            frame = pd.DataFrame({frame.name: frame})
+        self._add_columns(frame.columns)
+        p = np.uint64(self.precision)
+        for col in frame.columns:
+            h = hash_values(frame[col])
+            buckets = (h >> (np.uint64(64) - p)).astype(np.intp)
+            # position of the first 1 bit of the rest of the hash
+            rank = 65 - _bit_length(h << p)
+            rank = np.minimum(rank, 65 - self.precision).astype(np.uint8)
+            np.maximum.at(self.registers[self.columns.index(col)], buckets, rank)
+        return self
+
+    def merge(self, other):
+        '''
+        Adds the values of another HyperLogLog of the same precision
+        '''
+        if other.precision != self.precision:
+            raise ValueError('Can not merge sketches of different precision')
+        self._add_columns(other.columns)
+        rows = [self.columns.index(col) for col in other.columns]
+        self.registers[rows] = np.maximum(self.registers[rows], other.registers)
+        return self
+
+    def count(self):
+        '''
+        Estimated number of distinct values of each column
+
+        Returns
+        -------
+            pandas.Series
+        '''
+        m = self.registers.shape[1]
+        alpha = 0.7213 / (1 + 1.079 / m)
+        registers = self.registers.astype(np.float64)
+        estimate = alpha * m * m / np.power(2.0, -registers).sum(axis=1)
+        # small range correction: linear counting of the empty registers
+        zeros = (self.registers == 0).sum(axis=1)
+        linear = m * np.log(m / np.maximum(zeros, 1))
+        small = (estimate <= 2.5 * m) & (zeros > 0)
+        estimate[small] = linear[small]
+        return pd.Series(np.round(estimate), index=self.columns)
+
+class QuantileSketch(object):
+    '''
+    Approximate quantiles of each numeric column (merging t-digest).
+    The values are summarized by centroids (mean, weight); sorted values
+    are grouped with an arcsin scale so the centroids are small on the
+    tails and large around the median. Quantiles are interpolated between
+    the centroids and are exact (linear interpolation like pandas) while
+    the values have not been compressed.
+
+    Parameters
+    ----------
+        delta: int, compression: about delta centroids per column are kept,
+                    more is more accurate
+    '''
+    def __init__(self, delta=200):
+        self.delta = delta
+        self.columns = []
+        self.centroids = {}
+        self.limits = {}
+
+    def _compress(self, means, weights):
+        order = np.argsort(means, kind='mergesort')
+        means, weights = means[order], weights[order]
+        total = weights.sum()
+        center = (np.cumsum(weights) - weights / 2) / total
+        scale = self.delta / (2 * np.pi) * np.arcsin(2 * center - 1)
+        groups = np.floor(scale - scale[0]).astype(int)
+        new_weights = np.bincount(groups, weights=weights)
+        used = new_weights > 0
+        new_means = np.bincount(groups, weights=means * weights)[used] / new_weights[used]
+        return new_means, new_weights[used]
+
+    def _add(self, col, means, weights, low, high):
+        if col not in self.centroids:
+            self.columns.append(col)
+            self.centroids[col] = (np.zeros(0), np.zeros(0))
+            self.limits[col] = (np.inf, -np.inf)
+        old_means, old_weights = self.centroids[col]
+        means = np.concatenate((old_means, means))
+        weights = np.concatenate((old_weights, weights))
+        if len(means) > 5 * self.delta:
+            means, weights = self._compress(means, weights)
+        self.centroids[col] = (means, weights)
+        self.limits[col] = (min(self.limits[col][0], low), max(self.limits[col][1], high))
+
+    def update(self, frame):
+        '''
+        Adds the values of the numeric columns of a DataFrame (or a Series)
+        '''
+        if type(frame) is pd.Series:
+            frame = pd.DataFrame({frame.name: frame})
+        for col in frame.columns:
+            if frame[col].dtype.kind in 'biuf':
+                values = frame[col].values.astype(np.float64)
+                values = values[~np.isnan(values)]
+                if len(values):
+                    self._add(col, values, np.ones(len(values)),
+                                                values.min(), values.max())
+        return self
+
+    def merge(self, other):
+        '''
+        Adds the values of another QuantileSketch
+        '''
+        for col in other.columns:
+            means, weights = other.centroids[col]
+            self._add(col, means, weights, *other.limits[col])
+        return self
+
+    def quantile(self, q):
+        '''
+        Approximate quantiles
+
+        Parameters
+        ----------
+            q: float or list of floats, between 0 and 1
+
+        Returns
+        -------
+            pandas.Series (one q) or pandas.DataFrame (q x columns)
+        '''
+        qs = np.atleast_1d(np.asarray(q, dtype=np.float64))
+        ans = pd.DataFrame(index=qs, columns=self.columns, dtype=np.float64)
+        for col in self.columns:
+            means, weights = self.centroids[col]
+            order = np.argsort(means, kind='mergesort')
+            means, weights = means[order], weights[order]
+            total = weights.sum()
+            if total == 1:
+                ans[col] = means[0]
+                continue
+            # rank of the center of each centroid, scaled to [0, 1]
+            centers = (np.cumsum(weights) - (weights + 1) / 2) / (total - 1)
+            low, high = self.limits[col]
+            centers = np.concatenate(([0], centers, [1]))
+            means = np.concatenate(([low], means, [high]))
+            ans[col] = np.interp(qs, centers, means)
+        return ans.xs(qs[0]) if np.isscalar(q) else ans
+
+class MissingStats(object):
+    '''
+    Number of missing values of each column and, optionally, the number of
+    rows where each pair of columns is missing together. Both come from a
+    single isnull pass over each chunk.
+
+    Parameters
+    ----------
+        cooccurrence: boolean, also count the pairs of missing columns
+    '''
+    def __init__(self, cooccurrence=True):
+        self.columns = None
+        self.rows = 0
+        self.counts = None
+        self.pairs = None
+        self.track_pairs = cooccurrence
+
+    def _pairs(self, null, cols=None):
+        '''
+        Rows missing both of every column (only the ones with missing
+        values) and each of the cols, default all the columns
+        '''
+        ans = np.zeros((null.shape[1], null.shape[1] if cols is None else len(cols)),
+                                                                dtype=np.int64)
+        nonzero = np.nonzero(null.any(axis=0))[0]
+        right = null[:, nonzero] if cols is None else null[:, cols]
+        if len(nonzero):
+            product = np.dot(null[:, nonzero].T.astype(np.float64),
+                                                right.astype(np.float64))
+            if cols is None:
+                ans[np.ix_(nonzero, nonzero)] = np.round(product)
+            else:
+                ans[nonzero] = np.round(product)
+        return ans
+
+    def update(self, frame):
+        '''
+        Adds a chunk of rows. Columns missing on the chunk (but seen on the
+        first chunk) count as missing
+        '''
+        if type(frame) is pd.Series:
+            frame = pd.DataFrame({frame.name: frame})
+        if self.columns is None:
+            self.columns = list(frame.columns)
+            self.counts = np.zeros(len(self.columns), dtype=np.int64)
+            if self.track_pairs:
+                self.pairs = np.zeros((len(self.columns), len(self.columns)),
+                                                                dtype=np.int64)
+        else:
+            frame = frame.reindex(columns=self.columns)
+        null = frame.isnull().values
+        self.rows += len(null)
+        self.counts += null.sum(axis=0)
+        if self.track_pairs:
+            self.pairs += self._pairs(null)
+        return self
+
+    def refresh(self, frame, cols):
+        '''
+        Recalculates the stats of some columns of the (single) frame
+        summarized, after those columns change
+        '''
+        positions = [self.columns.index(col) for col in cols]
+        if not self.track_pairs:
+            self.counts[positions] = frame[cols].isnull().values.sum(axis=0)
+            return self
+        # the pairs of the changed columns need every column
+        null = frame[self.columns].isnull().values
+        self.counts[positions] = null[:, positions].sum(axis=0)
+        pairs = self._pairs(null, positions)
+        self.pairs[:, positions] = pairs
+        self.pairs[positions, :] = pairs.T
+        return self
+
+    def merge(self, other):
+        '''
+        Adds the stats of another MissingStats of the same columns. If only
+        one of them counts the pairs the result has only the counts
+        '''
+        if other.columns is None:
+            return self
+        if self.columns is None:
+            self.columns = list(other.columns)
+            self.counts = np.zeros(len(self.columns), dtype=np.int64)
+            if self.track_pairs:
+                self.pairs = np.zeros((len(self.columns), len(self.columns)),
+                                                                dtype=np.int64)
+        elif list(other.columns) != self.columns:
+            raise ValueError('Can not merge the stats of different columns')
+        self.track_pairs = self.track_pairs and other.track_pairs
+        self.counts += other.counts
+        if self.track_pairs:
+            self.pairs += other.pairs
+        else:
+            self.pairs = None
+        self.rows += other.rows
+        return self
+
+    def _check_pairs(self):
+        if self.pairs is None:
+            raise ValueError('The pairs are not counted, use cooccurrence=True')
+
+    def count(self):
+        '''
+        Number of missing values of each column
+
+        Returns
+        -------
+            pandas.Series
+        '''
+        return pd.Series(self.counts, index=self.columns)
+
+    def percent(self):
+        '''
+        Percent of missing values of each column
+
+        Returns
+        -------
+            pandas.Series
+        '''
+        return pd.Series(self.counts / self.rows, index=self.columns)
+
+    def cooccurrence(self):
+        '''
+        Number of rows where each pair of columns is missing together
+        (the diagonal is the number of missing values of each column)
+
+        Returns
+        -------
+            pandas.DataFrame
+        '''
+        self._check_pairs()
+        return pd.DataFrame(self.pairs, index=self.columns, columns=self.columns)
+
+    def corr(self):
+        '''
+        Correlation between the missing indicators of each pair of columns
+
+        Returns
+        -------
+            pandas.DataFrame
+        '''
+        self._check_pairs()
+        n = self.rows
+        counts = self.counts.astype(np.float64)
+        spread = np.sqrt(counts * (n - counts))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corr = (n * self.pairs - np.outer(counts, counts)) / np.outer(spread, spread)
+        return pd.DataFrame(corr, index=self.columns, columns=self.columns)
@@ -33,6 +33,35 @@ def grid(values, train_scores, test_scores, log=False):
                 plt.plot(values, test_scores[:, i], alpha=0.4, lw=2, c='g')
     plt.ylim([0,1.05])
 
+def learning_curve(sizes, train_scores, test_scores):
+    '''
+    Draws the mean train (dashed) and test scores of each classifier, the
+    test band is one standard deviation over the folds
+
+    Parameters
+    ----------
+        sizes: np.array, numbers of training rows
+        train_scores, test_scores: dicts {name: np.array (sizes x folds)},
+                        see copper.utils.ml.learning_curve
+
+    Return
+    ------
+        nothing, figure is ready to be shown
+    '''
+    names = sorted(test_scores.keys())
+    colors = cycle(cm.rainbow(np.linspace(0, 1, len(names))))
+    for name in names:
+        color = next(colors)
+        train_mean = train_scores[name].mean(axis=1)
+        test_mean = test_scores[name].mean(axis=1)
+        test_std = test_scores[name].std(axis=1)
+        plt.plot(sizes, train_mean, '--', c=color, lw=2, label='train: %s' % name)
+        plt.plot(sizes, test_mean, c=color, lw=2, label='test: %s' % name)
+        plt.fill_between(sizes, test_mean - test_std, test_mean + test_std,
+                                                    color=color, alpha=0.2)
+    plt.legend(loc='best')
+    plt.ylim([0,1.05])
+
 def histogram(series, bins=20, legend=True, ret_list=False):
     '''
     Draws a histogram for the selected column on matplotlib